@@ -1,4 +1,5 @@
 import asyncio
+import weakref
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
@@ -6,6 +7,9 @@ from pydantic import BaseModel
 from alexandria.chatstore.openai import OpenAIChatCompletion
 from alexandria.docstore.docstore import DocStore
 from alexandria.docstore.router import get_docstore
+from alexandria.vectorstore.idregistry import shared_id_registry
+from alexandria.vectorstore.providers.federatedvectorstore import FederatedMember, FederatedVectorStore
+from alexandria.vectorstore.registry import LIBRARY_REGISTRY
 from alexandria.vectorstore.router import get_vecstore
 from alexandria.vectorstore.vectorstore import VectorStore
 from handler.embedding.router import get_vectorize
@@ -13,8 +17,9 @@ from handler.embedding.vectorize import Vectorize, embed_bundle
 from handler.utils import hash_components, hash_string
 from models.api import Settings
 from models.conversation import Conversation, MultipleConversation, SingleConversation
+from models.document import DocumentFilter
 from models.generic import Bundle
-from server.constants import VECTORSTORE_CONV_SAVE_ROOT_FOR_USER, VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN
+from server.constants import EMBEDDING_CACHE_ROOT, ID_REGISTRY_SAVE_PATH, LOCAL_IDF_SAVE_PATH, VECTORSTORE_CONV_SAVE_ROOT_FOR_USER, VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN
 
 
 """
@@ -42,9 +47,15 @@ class ChatStore:
         self.transient = transient
         self.docstore = None
         self.vecstore = None
+        self.session_vecstore = None
+        self.library_docstore = None
         self.chat_vecstore = None
         self.chat_model = None
         self.chunk_size = settings.chunk_size
+        self.relevance_threshold = settings.relevance_threshold
+        self.settings = settings
+        self._library_key: Optional[tuple] = None
+        self._library_release: Optional[weakref.finalize] = None
         self._setup_storage(holdings, settings)
         self._setup_chat_model(settings)
         self.conversations: Optional[Conversation] = None
@@ -69,18 +80,46 @@ class ChatStore:
     def _setup_storage(self, holdings, settings: Settings):
         if self.transient:
             self._setup_temp_storage(holdings)
+            if settings.federated:
+                # the session's uploads are searched along with the admin library
+                self.library_docstore = get_docstore(session_id=self.session_id, transient=False)
+                self._acquire_library(settings)
         else:
             self.docstore = get_docstore(session_id=self.session_id,
                                          transient=self.transient)
-            self.vecstore = get_vecstore(session_id=self.session_id,
-                                         transient=self.transient,
-                                         vecstore=settings.vectorstore,
-                                         restore_root=VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN)
+            self._acquire_library(settings)
+        # one chat store per session, not worth shard workers of its own
+        chat_vectorstore = "naive" if settings.vectorstore == "sharded" else settings.vectorstore
         self.chat_vecstore = get_vecstore(session_id=self.session_id,
                                           transient=self.transient,
-                                          vecstore=settings.vectorstore,
-                                          restore_root=VECTORSTORE_CONV_SAVE_ROOT_FOR_USER)
-        self.vectorize = get_vectorize(settings)
+                                          vecstore=chat_vectorstore,
+                                          restore_root=VECTORSTORE_CONV_SAVE_ROOT_FOR_USER,
+                                          **settings.vecstore_kwargs())
+        # conv_ids are hex strings, stored under dense int64 ids so that every vector store accepts them
+        self.chat_vecstore.id_registry = shared_id_registry(ID_REGISTRY_SAVE_PATH)
+        self.vectorize = get_vectorize(settings, cache_root=EMBEDDING_CACHE_ROOT, idf_path=LOCAL_IDF_SAVE_PATH)
+
+    def _acquire_library(self, settings: Settings):
+        """
+        Takes a shared reference to the admin library from the process-wide registry instead of loading a private
+        copy; the reference is given back when this ChatStore is collected or the library files change.
+        """
+        if self._library_release is not None:
+            self._library_release()
+        key, vecstore = LIBRARY_REGISTRY.acquire(vecstore=settings.vectorstore,
+                                                 restore_root=VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN,
+                                                 **settings.vecstore_kwargs())
+        self._library_key = key
+        self._library_release = weakref.finalize(self, LIBRARY_REGISTRY.release, key)
+        if self.library_docstore is None:
+            self.vecstore = vecstore
+            return
+        self.vecstore = FederatedVectorStore([FederatedMember("session", self.session_vecstore, self.docstore),
+                                              FederatedMember("library", vecstore, self.library_docstore)])
+
+    def _refresh_library(self):
+        if self._library_key is not None and not LIBRARY_REGISTRY.is_current(self._library_key):
+            self._acquire_library(self.settings)
 
     def _setup_temp_storage(self, holdings: Dict[str, Any]):
         if "_docstore" not in holdings or "_vecstore" not in holdings:
@@ -89,6 +128,7 @@ class ChatStore:
         vecstore: VectorStore = holdings.get("_vecstore")
         self.docstore = docstore
         self.vecstore = vecstore
+        self.session_vecstore = vecstore
 
     async def _embed_text(self, s: str) -> List[float]:
         return await self.vectorize.embed_text(s)
@@ -115,7 +155,8 @@ class ChatStore:
         bundle = MultipleConversation(theme=self.session_id,
                                       contents=conv_list,
                                       embedding=None)
-        bundle = await embed_bundle(bundle, self.vectorize, prompt_template=prompt_template)
+        bundle = await embed_bundle(bundle, self.vectorize, prompt_template=prompt_template,
+                                    batch_size=self.settings.embedding_batch_size)
         return bundle
 
     def _get_chain(self, 
@@ -146,7 +187,7 @@ class ChatStore:
                                           max_trace=max_trace))
         return chains
     
-    async def eloquence(self, query):
+    async def eloquence(self, query, top_k: int = 3, filter: Optional[DocumentFilter] = None):
         STANDARD_PROMPT_TEMPLATE = {"request": "USER",
                                     "response": "ASSISTANT",
                                     "context": "SOURCES"}
@@ -154,6 +195,7 @@ class ChatStore:
 Answer ONLY with the facts listed in the list of SOURCES below. If there isn't enough information below, say you don't know. Do not generate answers that don't use the sources below. If asking a clarifying question to the user would help, ask the question.
 Each source has a name followed by colon and the actual information, always include the source name for each fact you use in the response. Use square brakets to reference the source, e.g. [info1.txt]. Don't combine sources, list each source separately, e.g. [info1.txt][info2.pdf].
         """
+        self._refresh_library()
         curr_conv = SingleConversation(conv_id=hash_components(query, str(datetime.utcnow().timestamp)),
                                        request=query)
         conv = Conversation(curr_conv=curr_conv)
@@ -164,7 +206,7 @@ Each source has a name followed by colon and the actual information, always incl
             self.conversations = conv
         self.conversations.update_dict(existed=self.conv_dict)
         emb_query = await self._get_query_pair(query)
-        valid_srcs = await self._get_relevant_docs(emb_query)
+        valid_srcs = await self._get_relevant_docs(emb_query, k=top_k, filter=filter)
         valid_docs_texts = [str(x) for x in valid_srcs]
         prev_convs, previous_conv_ids = await self._get_previous_convs(max_trace=2)
         relv_convs, relevant_conv_ids = await self._get_relevant_convs(emb_query)
@@ -200,13 +242,18 @@ Each source has a name followed by colon and the actual information, always incl
                                     "response": "ASSISTANT RESPONSE",
                                     "context": None}
         vector = await self.embed_single_conv(conversation, prompt_template=STANDARD_PROMPT_TEMPLATE)
-        self.chat_vecstore._add(vectors=[vector], ids=[conversation.conv_id])
+        ids = self.chat_vecstore._conversation_ids([conversation])
+        self.chat_vecstore.id_registry.flush()
+        self.chat_vecstore._add(vectors=[vector], ids=ids)
 
     async def _get_relevant_convs(self, vectors: List[List[float]]):
         relv_conv_ids = await self.chat_vecstore._query(vectors, k=3)
         if not relv_conv_ids:
             return [], []
-        valid_conv_ids = list(set(relv_conv_ids[0]).union(set(relv_conv_ids[1])))
+        dense_ids = set(relv_conv_ids[0]).union(set(relv_conv_ids[1]))
+        # conversations of other sessions sharing the store are not in conv_dict
+        valid_conv_ids = [id for id in self.chat_vecstore.id_registry.external_of(list(dense_ids))
+                          if id in self.conv_dict]
         relv_convs = [(self.conv_dict[id].request, self.conv_dict[id].response) for id in valid_conv_ids]
         return relv_convs, valid_conv_ids
     
@@ -229,19 +276,40 @@ Each source has a name followed by colon and the actual information, always incl
         conv_chains.reverse()
         return conv_chains, ids
 
-    async def _get_relevant_docs(self, emb_query):
-        chunk_ids = await self.vecstore._query(emb_query)
-        chunk_query, chunk_pair = chunk_ids
-        valid_chunks = list(set(chunk_query).union(set(chunk_pair)))
-        chunk_map = self.vecstore.reverse_doc_map()
-        if not chunk_map:
+    async def _get_relevant_docs(self, emb_query, k: int = 3, filter: Optional[DocumentFilter] = None):
+        if isinstance(self.vecstore, FederatedVectorStore):
+            return await self._get_federated_docs(emb_query, k=k, filter=filter)
+        hits = await self.vecstore._query_with_scores(emb_query,
+                                                      k=k,
+                                                      threshold=self.relevance_threshold,
+                                                      filter=filter)
+        # union of the hits of both query vectors, best score first
+        best: Dict[int, float] = {}
+        for chunk, score in (hit for per_query in hits for hit in per_query):
+            best[chunk] = max(score, best.get(chunk, score))
+        valid_chunks = sorted(best, key=best.get, reverse=True)
+        if not self.vecstore.metadata:
             raise ValueError("chunk-doc mapping not initialized")
-        valid_docs_chunks_ids = [(chunk_map[chunk], chunk) for chunk in valid_chunks if chunk in chunk_map]
+        valid_docs_chunks_ids = self.vecstore.docs_of_chunks(valid_chunks)
         valid_docs_chunks = await self.docstore.retrieve(valid_docs_chunks_ids)
         return [Src(src=chunk.metadata.doc_metadata.version.version_url,
                     text=chunk.text) 
                     for chunk in valid_docs_chunks]
 
+    async def _get_federated_docs(self, emb_query, k: int = 3, filter: Optional[DocumentFilter] = None):
+        hits = await self.vecstore.search_routed(emb_query,
+                                                 k=k,
+                                                 threshold=self.relevance_threshold,
+                                                 filter=filter)
+        # chunk ids are only unique within a member, hits are keyed by both
+        best: Dict[tuple, float] = {}
+        for member, chunk, score in (hit for per_query in hits for hit in per_query):
+            best[(member, chunk)] = max(score, best.get((member, chunk), score))
+        valid_chunks = await self.vecstore.retrieve(sorted(best, key=best.get, reverse=True))
+        return [Src(src=chunk.metadata.doc_metadata.version.version_url,
+                    text=chunk.text)
+                    for _, chunk in valid_chunks]
+
     async def _get_query_pair(self, query):
         bundle_embed = await self.embed_chain_conv(conversations=self.conversations,
                                                    chrono=False,
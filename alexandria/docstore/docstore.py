@@ -1,10 +1,17 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Tuple
+from alexandria.vectorstore.idregistry import IdRegistry
 from handler.chunkify import get_document_chunks
+from handler.dedup import NearDuplicateIndex
 
-from models.document import DocumentChunk, MultipleDocuments, SingleDocument
+from models.document import DocumentChunk, MultipleDocuments, SingleDocument, SingleDocumentWithChunks
 
 class DocStore(ABC):
+    # collapses near-duplicate chunks onto canonical ones when set, see `handler.dedup`
+    dedup: Optional[NearDuplicateIndex] = None
+    # gives chunks dense int64 ids instead of their hashes when set, see `alexandria.vectorstore.idregistry`
+    id_registry: Optional[IdRegistry] = None
+
     async def upsert(
             self, 
             documents: List[SingleDocument], 
@@ -13,7 +20,12 @@ class DocStore(ABC):
             chunk_token_len: Optional[int] = None
     ) -> MultipleDocuments:
         bundle = await self.squash(documents, session_id, transient)
-        bundle.contents = get_document_chunks(bundle.contents, chunk_token_len)
+        bundle.contents = get_document_chunks(bundle.contents, chunk_token_len, self.dedup, self.id_registry)
+        if self.id_registry is not None:
+            # before anything refers to the new ids
+            self.id_registry.flush()
+        if self.dedup is not None:
+            self.dedup.save()
         assert isinstance(bundle.contents, List)
         _bundle = await self._upsert(bundle)
         if bundle.theme != _bundle.theme:
@@ -53,4 +65,11 @@ class DocStore(ABC):
         self,
         doc_chunk_ids: List[Tuple[str, int]]
     ) -> List[DocumentChunk]:
-        raise NotImplemented
\ No newline at end of file
+        raise NotImplemented
+
+    @abstractmethod
+    async def documents(self) -> List[SingleDocumentWithChunks]:
+        """
+        Returns every document of the store with its chunks, e.g. to embed the whole library again.
+        """
+        raise NotImplementedError
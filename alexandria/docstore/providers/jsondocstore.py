@@ -169,4 +169,13 @@ class JsonDocStore(DocStore):
             for chunk in o.chunks:
                 if chunk_id == chunk.chunk_id:
                     chunks.append(chunk)
-        return chunks
\ No newline at end of file
+        return chunks
+
+    async def documents(self) -> List[SingleDocumentWithChunks]:
+        documents = []
+        for name in sorted(os.listdir(self.doc_root)):
+            if not name.endswith(".json") or name == "index.json":
+                continue
+            with open(os.path.join(self.doc_root, name), "r") as f:
+                documents.append(SingleDocumentWithChunks.parse_obj(json.load(f)))
+        return documents
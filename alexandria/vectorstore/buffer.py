@@ -0,0 +1,461 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+def select_topk(similarities: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Selects the k highest scores per row with `argpartition` and returns their columns and scores, best first.
+    """
+    n = similarities.shape[1]
+    if k < n:
+        indices = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(n), similarities.shape)
+    top = np.take_along_axis(similarities, indices, axis=1)
+    order = np.argsort(-top, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+class VectorBuffer:
+    # arrays holding one entry per row, grown and compacted together
+    ROW_ARRAYS = ("matrix", "alive")
+
+    def __init__(self,
+                 dim: Optional[int] = None,
+                 capacity: int = 1024,
+                 compact_threshold: float = 0.3,
+                 compact_min_dead: int = 1024,
+                 unit_norm: bool = True):
+        """
+        Initializes an append-only, contiguous float32 vector buffer.
+
+        Rows are never rewritten once appended: re-adding an id appends a new row and tombstones the old one,
+        removing an id only flips its bit in the tombstone bitmap. Both are O(1) (amortized for appends, the
+        matrix capacity doubles when full). Dead rows are dropped by a background compaction once their
+        fraction passes `compact_threshold`.
+
+        Readers never take the lock. Every write ends by publishing an immutable snapshot (the row count and the
+        row arrays) with a single reference assignment; appends only touch rows past the published count, and the
+        tombstone bitmap is copied before a write flips bits of published rows, so a search keeps seeing the
+        version it started with while writers build the next one.
+
+        Args:
+        - dim: An optional integer representing the dimensionality of the vectors, inferred on first add if None.
+        - capacity: An integer representing the number of rows allocated up front.
+        - compact_threshold: A float representing the fraction of dead rows that triggers compaction.
+        - compact_min_dead: An integer representing the minimum number of dead rows before compacting.
+        - unit_norm: A boolean indicating whether appended vectors are L2-normalized; `search` assumes they are.
+        """
+        self.d: Optional[int] = dim
+        self.initial_capacity: int = max(1, capacity)
+        self.compact_threshold: float = compact_threshold
+        self.compact_min_dead: int = compact_min_dead
+        self.unit_norm: bool = unit_norm
+        self.matrix: Optional[np.ndarray] = None
+        self.alive: np.ndarray = np.zeros(0, dtype=bool)
+        self.ids: List[Hashable] = []
+        self.index: Dict[Hashable, int] = {}
+        self.size: int = 0
+        self.dead: int = 0
+        self._lock = threading.RLock()
+        # serializes compactions, each one reconciles against the arrays it snapshotted
+        self._compact_lock = threading.Lock()
+        self._compacting: Optional[threading.Thread] = None
+        # writes inside `writing()` publish once, when it exits
+        self._deferred: int = 0
+        # rows the id map pointed at before an id was re-added or removed, since the last compaction
+        self._shadow: Dict[Hashable, List[int]] = {}
+        # the version readers see: (row count, live row count, row arrays, row-to-id list, id-to-row map, shadow)
+        self._snapshot: tuple = (0, 0, {}, [], {}, {})
+        if dim is not None:
+            self._allocate(dim, self.initial_capacity)
+        self._publish()
+
+    @classmethod
+    def from_arrays(cls, matrix: np.ndarray, ids: Any, **kwargs) -> "VectorBuffer":
+        """
+        Adopts an already L2-normalized matrix (e.g. a read-only memory map) as the buffer's storage without
+        copying it. The first append past its end moves the rows into a growable in-memory allocation.
+        """
+        buffer = cls(**kwargs)
+        ids = list(ids.tolist() if isinstance(ids, np.ndarray) else ids)
+        assert matrix.ndim == 2 and matrix.shape[0] == len(ids), "matrix and ids to be adopted not aligned"
+        buffer.d = matrix.shape[1]
+        if matrix.shape[0] == 0:
+            return buffer
+        buffer.matrix = matrix
+        buffer.alive = np.ones(matrix.shape[0], dtype=bool)
+        buffer._adopt(matrix)
+        buffer.ids = ids
+        buffer.index = {id: row for row, id in enumerate(ids)}
+        buffer.size = matrix.shape[0]
+        # ids repeated in the adopted rows: the last occurrence wins
+        buffer.dead = buffer.size - len(buffer.index)
+        if buffer.dead:
+            buffer.alive[:] = False
+            buffer.alive[list(buffer.index.values())] = True
+        buffer._publish()
+        return buffer
+
+    def live(self) -> Tuple[np.ndarray, List[Hashable]]:
+        """
+        Returns the live rows and their ids. No copy is made while the buffer holds no dead rows.
+        """
+        matrix, alive, ids = self.view()
+        if alive.all():
+            return matrix, list(ids[:matrix.shape[0]])
+        rows = np.flatnonzero(alive)
+        return matrix[rows], [ids[row] for row in rows.tolist()]
+
+    def __len__(self) -> int:
+        return self._snapshot[1]
+
+    def __contains__(self, id: Hashable) -> bool:
+        return self._row_of(id, self._snapshot) is not None
+
+    def _publish(self):
+        """
+        Makes the current arrays the version readers see. Called with the lock held, at the end of every write.
+        """
+        if self._deferred:
+            return
+        arrays = {name: getattr(self, name) for name in self.ROW_ARRAYS}
+        self._snapshot = (self.size, self.size - self.dead, arrays, self.ids, self.index, self._shadow)
+
+    @contextmanager
+    def writing(self):
+        """
+        Groups several adds and removals into one published version, e.g. the removal of a document's old chunks
+        and the insertion of the new ones, so that no reader sees the document half replaced.
+        """
+        with self._lock:
+            self._deferred += 1
+            try:
+                yield self
+            finally:
+                self._deferred -= 1
+                self._publish()
+
+    def _writable_alive(self):
+        """
+        Copies the tombstone bitmap before flipping bits of published rows, once per version.
+        """
+        if self.alive is self._snapshot[2].get("alive"):
+            self.alive = self.alive.copy()
+
+    def snapshot(self) -> tuple:
+        """
+        Returns the published version as (row count, live row count, row arrays, row-to-id list, id-to-row map,
+        shadow map).
+        """
+        return self._snapshot
+
+    def _unmap(self, id: Hashable, row: int):
+        """
+        Records a published row of an id before the id map is pointed away from it. Called with the lock held.
+        """
+        if row < self._snapshot[0]:
+            self._shadow.setdefault(id, []).append(row)
+
+    @staticmethod
+    def _row_of(id: Hashable, snapshot: tuple) -> Optional[int]:
+        """
+        Returns the live row holding id in the given snapshot, None if there is none.
+
+        The id map and the shadow map are shared with the writers until the next compaction replaces both, the
+        id map always pointing at the newest row of an id and the shadow map holding the rows it pointed at
+        before. At most one row per id is alive in any snapshot, so the first of them alive in it is the answer.
+        The id map is read first: a writer records the shadow before changing the id map.
+        """
+        n, _, arrays, _, index, shadow = snapshot
+        alive = arrays["alive"]
+        row = index.get(id)
+        if row is not None and row < n and alive[row]:
+            return row
+        for row in shadow.get(id, ()):
+            if row < n and alive[row]:
+                return row
+        return None
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _new_rows(self, name: str, capacity: int) -> np.ndarray:
+        if name == "alive":
+            return np.zeros(capacity, dtype=bool)
+        return np.empty((capacity, self.d), dtype=np.float32)
+
+    def _adopt(self, matrix: np.ndarray):
+        """
+        Hook for subclasses deriving their own row arrays from an adopted matrix.
+        """
+        pass
+
+    def _write_rows(self, start: int, vectors: np.ndarray):
+        self.matrix[start:start + vectors.shape[0]] = vectors
+
+    def _allocate(self, dim: int, capacity: int):
+        self.d = dim
+        for name in self.ROW_ARRAYS:
+            setattr(self, name, self._new_rows(name, capacity))
+
+    def _reserve(self, extra: int):
+        if self.matrix is None:
+            self._allocate(self.d, max(self.initial_capacity, extra))
+            return
+        needed = self.size + extra
+        capacity = self.matrix.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in self.ROW_ARRAYS:
+            rows = self._new_rows(name, capacity)
+            rows[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, rows)
+
+    def add(self, vectors: Any, ids: List[Hashable]):
+        """
+        Appends L2-normalized vectors with their ids; an id that is already present gets its old row tombstoned.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        assert vectors.shape[0] == len(ids), "vectors and ids to be inserted not aligned"
+        if vectors.shape[0] == 0:
+            return
+        with self._lock:
+            if self.d is None:
+                self.d = vectors.shape[1]
+            assert vectors.shape[1] == self.d, "vector dimension not aligned with buffer"
+            self._reserve(vectors.shape[0])
+            start = self.size
+            self._write_rows(start, self.normalize(vectors) if self.unit_norm else vectors)
+            self.alive[start:start + vectors.shape[0]] = True
+            for offset, id in enumerate(ids):
+                row = self.index.get(id)
+                if row is not None:
+                    self._unmap(id, row)
+                    self._writable_alive()
+                    self.alive[row] = False
+                    self.dead += 1
+                self.index[id] = start + offset
+                self.ids.append(id)
+            self.size += vectors.shape[0]
+            self._publish()
+        self._maybe_compact()
+
+    def remove(self, ids: List[Hashable]) -> int:
+        """
+        Tombstones the rows of the given ids and returns how many were found.
+        """
+        cnt = 0
+        with self._lock:
+            for id in ids:
+                row = self.index.get(id)
+                if row is None:
+                    continue
+                self._unmap(id, row)
+                del self.index[id]
+                self._writable_alive()
+                self.alive[row] = False
+                cnt += 1
+            self.dead += cnt
+            self._publish()
+        if cnt:
+            self._maybe_compact()
+        return cnt
+
+    def view(self, snapshot=None) -> Tuple[np.ndarray, np.ndarray, List[Hashable]]:
+        """
+        Returns the used part of the matrix, its liveness mask and the row-to-id list from the published snapshot
+        (or the given one), without locking or copying. The mask is read-only: writers copy it before tombstoning
+        published rows.
+        """
+        n, _, arrays, ids, _, _ = snapshot or self._snapshot
+        if arrays.get("matrix") is None:
+            return np.empty((0, self.d or 0), dtype=np.float32), np.zeros(0, dtype=bool), []
+        alive = arrays["alive"][:n]
+        alive.flags.writeable = False
+        return arrays["matrix"][:n], alive, ids
+
+    def view_rows(self, ids: Any, snapshot=None) -> Tuple[np.ndarray, np.ndarray, List[Hashable]]:
+        """
+        Like `view`, but returns the live rows holding the given ids (those present) instead of a liveness mask.
+        """
+        snapshot = snapshot or self._snapshot
+        n, _, arrays, row_ids, _, _ = snapshot
+        if arrays.get("matrix") is None:
+            return np.empty((0, self.d or 0), dtype=np.float32), np.empty(0, dtype=np.int64), []
+        rows = (self._row_of(id, snapshot) for id in ids)
+        return arrays["matrix"][:n], np.fromiter((row for row in rows if row is not None), dtype=np.int64), row_ids
+
+    def search(self,
+               queries: np.ndarray,
+               k: Optional[int],
+               threshold: Optional[float] = None,
+               allowed_ids: Optional[np.ndarray] = None,
+               snapshot: Optional[tuple] = None) -> List[List[Tuple[Hashable, float]]]:
+        """
+        Scores every query against the pre-normalized rows in a single matrix multiply and selects the
+        k most similar live rows per query with `argpartition`, ordered by descending cosine similarity.
+        Rows scoring below `threshold` are dropped; with k None every row above it is returned. With
+        `allowed_ids` only the rows of those ids are scored, so a narrow filter still yields k results.
+        The published version is searched, or the given snapshot of an earlier one.
+        """
+        snapshot = snapshot or self._snapshot
+        if snapshot[1] == 0:
+            return [[] for _ in range(queries.shape[0])]
+        if allowed_ids is not None:
+            _, rows, _ = self.view_rows(allowed_ids.tolist(), snapshot)
+            return self.search_rows(queries, k, threshold, rows, snapshot)
+        candidates, alive, ids = self.view(snapshot)
+        similarities = self.normalize(queries) @ candidates.T
+        similarities[:, ~alive] = -np.inf
+        return self._select(similarities, k, threshold, snapshot[1], None, ids)
+
+    def search_rows(self,
+                    queries: np.ndarray,
+                    k: Optional[int],
+                    threshold: Optional[float],
+                    rows: np.ndarray,
+                    snapshot: tuple) -> List[List[Tuple[Hashable, float]]]:
+        """
+        Like `search`, but only scores the given live rows of a snapshot.
+        """
+        _, _, arrays, ids, _, _ = snapshot
+        if rows.shape[0] == 0:
+            return [[] for _ in range(queries.shape[0])]
+        similarities = self.normalize(queries) @ arrays["matrix"][rows].T
+        return self._select(similarities, k, threshold, rows.shape[0], rows, ids)
+
+    @staticmethod
+    def _select(similarities: np.ndarray,
+                k: Optional[int],
+                threshold: Optional[float],
+                n_alive: int,
+                rows: Optional[np.ndarray],
+                ids: List[Hashable]) -> List[List[Tuple[Hashable, float]]]:
+        if threshold is not None:
+            similarities[similarities < threshold] = -np.inf
+        k = n_alive if k is None else min(k, n_alive)
+        if k <= 0:
+            return [[] for _ in range(similarities.shape[0])]
+        indices, top = select_topk(similarities, k)
+        if rows is not None:
+            indices = rows[indices]
+        return [[(ids[i], score) for i, score in zip(row, scores) if score != -np.inf]
+                for row, scores in zip(indices.tolist(), top.tolist())]
+
+    def get(self, id: Hashable) -> Optional[np.ndarray]:
+        snapshot = self._snapshot
+        row = self._row_of(id, snapshot)
+        return None if row is None else snapshot[2]["matrix"][row]
+
+    def items(self):
+        """
+        Yields (id, vector) pairs of all live rows.
+        """
+        matrix, alive, ids = self.view()
+        for row in np.flatnonzero(alive):
+            yield ids[row], matrix[row]
+
+    def _should_compact(self) -> bool:
+        return self.dead >= self.compact_min_dead and self.dead > self.compact_threshold * self.size
+
+    def _maybe_compact(self):
+        with self._lock:
+            if not self._should_compact():
+                return
+            if self._compacting is not None and self._compacting.is_alive():
+                return
+            self._compacting = threading.Thread(target=self.compact, daemon=True)
+            self._compacting.start()
+
+    def compact(self) -> Dict[str, float]:
+        """
+        Rebuilds the buffer without dead rows. The O(N·d) copy runs outside the lock from a snapshot, rows
+        appended or tombstoned meanwhile are reconciled under the lock before the new arrays are swapped in.
+        """
+        with self._compact_lock:
+            return self._compact()
+
+    def _compact(self) -> Dict[str, float]:
+        started = time.perf_counter()
+        with self._lock:
+            n = self.size
+            src = {name: getattr(self, name) for name in self.ROW_ARRAYS}
+            src_ids = self.ids
+            alive = self._retained(self.alive[:n].copy(), src)
+            before = self._nbytes()
+        if src["matrix"] is None:
+            return {"reclaimed_rows": 0, "reclaimed_bytes": 0, "elapsed": 0.0}
+        keep = np.flatnonzero(alive)
+        m = keep.shape[0]
+        capacity = min(src["matrix"].shape[0], max(self.initial_capacity, 2 * m))
+        rows = {}
+        for name in self.ROW_ARRAYS:
+            rows[name] = self._new_rows(name, capacity)
+            rows[name][:m] = src[name][keep]
+        ids = [src_ids[row] for row in keep.tolist()]
+        index = {id: row for row, id in enumerate(ids)}
+        with self._lock:
+            # rows tombstoned while copying
+            died = np.flatnonzero(alive & ~self.alive[:n])
+            if died.shape[0]:
+                died = np.searchsorted(keep, died)
+                rows["alive"][died] = False
+                for row in died.tolist():
+                    index.pop(ids[row], None)
+            # rows appended while copying
+            size = m + self.size - n
+            if size > capacity:
+                capacity = 2 * size
+                for name in self.ROW_ARRAYS:
+                    grown = self._new_rows(name, capacity)
+                    grown[:m] = rows[name][:m]
+                    rows[name] = grown
+            for name in self.ROW_ARRAYS:
+                rows[name][m:size] = getattr(self, name)[n:self.size]
+            ids.extend(self.ids[n:self.size])
+            for row in np.flatnonzero(rows["alive"][m:size]).tolist():
+                index[ids[m + row]] = m + row
+            reclaimed = self.size - size
+            for name in self.ROW_ARRAYS:
+                setattr(self, name, rows[name])
+            self.ids, self.index = ids, index
+            self._shadow = {}
+            self.size = size
+            self.dead = int(size - self.alive[:size].sum())
+            self._compacted()
+            self._publish()
+            after = self._nbytes()
+        elapsed = time.perf_counter() - started
+        print(f"vector buffer compacted: {reclaimed} dead row(s) dropped, "
+              f"{before - after} bytes reclaimed in {elapsed:.3f}s")
+        return {"reclaimed_rows": reclaimed, "reclaimed_bytes": before - after, "elapsed": elapsed}
+
+    def _retained(self, alive: np.ndarray, arrays: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Hook for subclasses dropping more rows than the dead ones when compacting; returns the rows to keep.
+        """
+        return alive
+
+    def _compacted(self):
+        """
+        Hook for subclasses rebuilding their own per-row state after a compaction, called with the lock held.
+        """
+        pass
+
+    def _nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ROW_ARRAYS if getattr(self, name) is not None)
+
+    def wait_compaction(self):
+        thread = self._compacting
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+
+
+class IdRegistry:
+    def __init__(self, path: Optional[str] = None):
+        """
+        Initializes a registry mapping external ids (48-bit chunk hashes, hex conversation ids, ...) to dense int64
+        ids 0, 1, 2, ... in order of first registration, and back.
+
+        Dense ids are never reused or reassigned, so the registry is persisted as an append-only log with one JSON
+        encoded external id per line: line n holds the external id of dense id n. A line torn by a crash is cut off
+        when the log is loaded again.
+
+        Args:
+        - path: An optional string representing the path of the log, the registry is kept in memory only if None.
+        """
+        self.path: Optional[str] = path
+        self.external: List[Hashable] = []
+        self.dense: Dict[Hashable, int] = {}
+        self.flushed: int = 0
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.external)
+
+    def __contains__(self, id: Hashable) -> bool:
+        return id in self.dense
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            print(f"id registry {self.path} has a torn tail of {len(data) - end} byte(s), truncating")
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].decode().splitlines():
+            id = json.loads(line)
+            self.dense[id] = len(self.external)
+            self.external.append(id)
+        self.flushed = len(self.external)
+
+    def assign(self, ids: List[Hashable]) -> np.ndarray:
+        """
+        Returns the dense ids of the given external ids, registering those seen for the first time.
+        """
+        with self._lock:
+            dense = np.empty(len(ids), dtype=np.int64)
+            for i, id in enumerate(ids):
+                row = self.dense.get(id)
+                if row is None:
+                    row = len(self.external)
+                    self.dense[id] = row
+                    self.external.append(id)
+                dense[i] = row
+            return dense
+
+    def lookup(self, ids: List[Hashable]) -> np.ndarray:
+        """
+        Returns the dense ids of the given external ids, -1 for those never registered.
+        """
+        with self._lock:
+            return np.fromiter((self.dense.get(id, -1) for id in ids), dtype=np.int64, count=len(ids))
+
+    def external_of(self, dense_ids: List[int]) -> List[Optional[Hashable]]:
+        """
+        Returns the external id of each dense id, None for ids out of range (e.g. -1 padding).
+        """
+        n = len(self.external)
+        return [self.external[id] if 0 <= id < n else None for id in dense_ids]
+
+    def flush(self) -> int:
+        """
+        Appends the ids registered since the last flush to the log and fsyncs it. Returns how many were written.
+        """
+        if self.path is None:
+            return 0
+        with self._lock:
+            pending = self.external[self.flushed:]
+            if not pending:
+                return 0
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'ab') as f:
+                f.write("".join(json.dumps(id) + "\n" for id in pending).encode())
+                f.flush()
+                os.fsync(f.fileno())
+            self.flushed += len(pending)
+            return len(pending)
+
+
+_SHARED: Dict[str, IdRegistry] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_id_registry(path: str) -> IdRegistry:
+    """
+    Returns the process-wide registry persisted at path, so every store resolving ids against the same log
+    shares one dense id space.
+    """
+    path = os.path.normpath(path)
+    with _SHARED_LOCK:
+        registry = _SHARED.get(path)
+        if registry is None:
+            registry = IdRegistry(path)
+            _SHARED[path] = registry
+        return registry
@@ -0,0 +1,225 @@
+import os
+from datetime import datetime
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+
+from alexandria.vectorstore.persistence import replace_file
+from models.document import DocumentFilter
+
+# created_at of records without a creation date
+NO_DATE = np.iinfo(np.int64).min
+
+
+class MetadataColumns:
+    def __init__(self, capacity: int = 1024):
+        """
+        Initializes a compact, column-oriented store of the metadata a search can be filtered by: the document id,
+        the author and the creation time of each vector id. Strings are dictionary-encoded into int32 codes and
+        dates are stored as int64 epoch seconds, so evaluating a filter is a handful of vectorized comparisons.
+        The id-to-row map and the doc column double as the chunk-to-document reverse index, kept up to date by
+        every upsert and removal, so resolving the document of a hit is O(1).
+
+        Args:
+        - capacity: An integer representing the number of rows allocated up front.
+        """
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.doc = np.empty(capacity, dtype=np.int32)
+        self.author = np.empty(capacity, dtype=np.int32)
+        self.created_at = np.empty(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.size: int = 0
+        self.rows: Dict[int, int] = {}
+        self.vocab: Dict[str, Dict[Optional[str], int]] = {"doc": {}, "author": {}}
+        # code to value, the inverse of vocab["doc"]
+        self.doc_names: List[Optional[str]] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _encode(self, column: str, value: Optional[str]) -> int:
+        vocab = self.vocab[column]
+        code = vocab.get(value)
+        if code is None:
+            code = len(vocab)
+            vocab[value] = code
+            if column == "doc":
+                self.doc_names.append(value)
+        return code
+
+    @staticmethod
+    def _timestamp(value: Optional[datetime]) -> int:
+        return NO_DATE if value is None else int(value.timestamp())
+
+    def _reserve(self, extra: int):
+        capacity = self.ids.shape[0]
+        if self.size + extra <= capacity:
+            return
+        while capacity < self.size + extra:
+            capacity *= 2
+        for column in ("ids", "doc", "author", "created_at", "alive"):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def upsert(self,
+               ids: List[int],
+               doc_ids: List[Optional[str]],
+               authors: List[Optional[str]],
+               created_ats: List[Optional[datetime]]):
+        assert len(ids) == len(doc_ids) == len(authors) == len(created_ats), "metadata to be inserted not aligned"
+        self.remove(ids)
+        self._reserve(len(ids))
+        for id, doc_id, author, created_at in zip(ids, doc_ids, authors, created_ats):
+            row = self.size
+            self.ids[row] = id
+            self.doc[row] = self._encode("doc", doc_id)
+            self.author[row] = self._encode("author", author)
+            self.created_at[row] = self._timestamp(created_at)
+            self.alive[row] = True
+            # the same id may come twice in a batch, e.g. a chunk shared by two documents, the last row wins
+            previous = self.rows.get(id)
+            if previous is not None:
+                self.alive[previous] = False
+            self.rows[id] = row
+            self.size += 1
+
+    def export(self, ids: List[int]) -> List[list]:
+        """
+        Returns the [id, doc id, author, created_at epoch seconds] row of each given id recorded, for `apply`.
+        """
+        authors = sorted(self.vocab["author"], key=self.vocab["author"].get)
+        rows = []
+        for id in ids:
+            row = self.rows.get(id)
+            if row is not None:
+                rows.append([int(id), self.doc_names[self.doc[row]], authors[self.author[row]],
+                             int(self.created_at[row])])
+        return rows
+
+    def apply(self, rows: List[list]):
+        """
+        Upserts rows exported by `export`, e.g. replayed from a write-ahead log.
+        """
+        if not rows:
+            return
+        ids = [row[0] for row in rows]
+        self.upsert(ids, [row[1] for row in rows], [row[2] for row in rows], [None] * len(rows))
+        for id, row in zip(ids, rows):
+            self.created_at[self.rows[id]] = row[3]
+
+    def remove(self, ids: List[Hashable]) -> int:
+        cnt = 0
+        for id in ids:
+            row = self.rows.pop(id, None)
+            if row is not None:
+                self.alive[row] = False
+                cnt += 1
+        return cnt
+
+    def move(self, ids: List[int], doc_ids: List[str]):
+        """
+        Reassigns the given vector ids to other documents, keeping their author and creation time.
+        """
+        assert len(ids) == len(doc_ids), "ids and documents to be moved to not aligned"
+        self._reserve(len(ids))
+        for id, doc_id in zip(ids, doc_ids):
+            old = self.rows.get(id)
+            if old is None:
+                continue
+            row = self.size
+            self.ids[row] = id
+            self.doc[row] = self._encode("doc", doc_id)
+            self.author[row] = self.author[old]
+            self.created_at[row] = self.created_at[old]
+            self.alive[row] = True
+            self.alive[old] = False
+            self.rows[id] = row
+            self.size += 1
+
+    def doc_of(self, ids: List[Hashable]) -> List[Optional[str]]:
+        """
+        Returns the document id of each given vector id, None for ids not recorded.
+        """
+        doc_ids = []
+        for id in ids:
+            row = self.rows.get(id)
+            doc_ids.append(None if row is None else self.doc_names[self.doc[row]])
+        return doc_ids
+
+    def select(self, filter: DocumentFilter) -> np.ndarray:
+        """
+        Evaluates a filter over the columns and returns the matching vector ids as an int64 array. Every condition
+        set on the filter must hold; doc_ids and authors match any of the listed values.
+
+        Safe to call while an upsert runs on another thread: the row count and the columns are read once, rows
+        below that count are never rewritten and a growing column is copied into a new array.
+        """
+        n, ids, doc, author, created_at = self.size, self.ids, self.doc, self.author, self.created_at
+        mask = self.alive[:n].copy()
+        if filter.doc_ids is not None:
+            codes = [self.vocab["doc"].get(d) for d in filter.doc_ids]
+            mask &= np.isin(doc[:n], [code for code in codes if code is not None])
+        if filter.authors is not None:
+            codes = [self.vocab["author"].get(a) for a in filter.authors]
+            mask &= np.isin(author[:n], [code for code in codes if code is not None])
+        if filter.start_date is not None or filter.final_date is not None:
+            created_at = created_at[:n]
+            mask &= created_at != NO_DATE
+            if filter.start_date is not None:
+                mask &= created_at >= self._timestamp(filter.start_date)
+            if filter.final_date is not None:
+                mask &= created_at <= self._timestamp(filter.final_date)
+        return ids[:n][mask]
+
+    def save(self, path: str):
+        live = np.flatnonzero(self.alive[:self.size])
+        vocabs = {}
+        for column, vocab in self.vocab.items():
+            # code order, None is stored as an empty string flagged by position
+            values = sorted(vocab, key=vocab.get)
+            vocabs[f"{column}_vocab"] = np.array(["" if v is None else v for v in values], dtype=str)
+            vocabs[f"{column}_vocab_none"] = np.array([v is None for v in values], dtype=bool)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     ids=self.ids[live],
+                     doc=self.doc[live],
+                     author=self.author[live],
+                     created_at=self.created_at[live],
+                     **vocabs)
+        replace_file(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "MetadataColumns":
+        columns = cls()
+        if not os.path.isfile(path):
+            return columns
+        with np.load(path) as data:
+            n = data["ids"].shape[0]
+            columns._reserve(n)
+            columns.ids[:n] = data["ids"]
+            columns.doc[:n] = data["doc"]
+            columns.author[:n] = data["author"]
+            columns.created_at[:n] = data["created_at"]
+            columns.alive[:n] = True
+            columns.size = n
+            for column in columns.vocab:
+                values = data[f"{column}_vocab"].tolist()
+                nones = data[f"{column}_vocab_none"].tolist()
+                columns.vocab[column] = {None if none else v: code
+                                         for code, (v, none) in enumerate(zip(values, nones))}
+            columns.doc_names = sorted(columns.vocab["doc"], key=columns.vocab["doc"].get)
+        columns.rows = {id: row for row, id in enumerate(columns.ids[:n].tolist())}
+        return columns
+
+    @classmethod
+    def from_doc_map(cls, doc_map: Dict[str, List[int]]) -> "MetadataColumns":
+        """
+        Backfills the doc_id column of a library saved before metadata was recorded; authors and dates stay unknown.
+        """
+        columns = cls()
+        for doc_id, chunk_ids in doc_map.items():
+            columns.upsert(chunk_ids, [doc_id] * len(chunk_ids), [None] * len(chunk_ids), [None] * len(chunk_ids))
+        return columns
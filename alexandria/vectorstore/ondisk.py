@@ -0,0 +1,415 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer, select_topk
+from alexandria.vectorstore.persistence import FORMAT_VERSION, array_path, matrix_paths, replace_file, write_json
+
+
+def _save_array(path: str, arr: np.ndarray):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    replace_file(tmp_path, path)
+
+
+def train_centroids(matrix: np.ndarray,
+                    nlist: int,
+                    sample_size: int = 100_000,
+                    iterations: int = 10,
+                    block_rows: int = 1 << 16,
+                    seed: int = 0) -> np.ndarray:
+    """
+    Runs spherical k-means on a random sample of the (L2-normalized) rows and returns nlist unit centroids.
+    Only the sample is held in memory, so the matrix may be a memory map larger than RAM.
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    sample = np.sort(rng.choice(n, size=min(n, max(nlist, sample_size)), replace=False))
+    sample = np.asarray(matrix[sample], dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign_lists(sample, centroids, block_rows)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        empty = np.flatnonzero(np.bincount(lists, minlength=nlist) == 0)
+        # lists left empty are reseeded with random sample rows
+        sums[empty] = sample[rng.choice(sample.shape[0], size=empty.shape[0])]
+        centroids = VectorBuffer.normalize(sums)
+    return centroids
+
+
+def default_nlist(n: int, nlist: Optional[int] = None, train_size: int = 100_000) -> int:
+    """
+    Returns the number of inverted lists of an index of n rows: nlist if given, about 4·sqrt(n) otherwise, at most
+    one per 39 training rows so that k-means has enough points per centroid.
+    """
+    return max(1, min(nlist or int(4 * np.sqrt(n)), n, max(1, train_size // 39)))
+
+
+def assign_lists(matrix: np.ndarray, centroids: np.ndarray, block_rows: int = 1 << 16) -> np.ndarray:
+    """
+    Returns the inverted list (most similar centroid) of every row, computed block by block.
+    """
+    lists = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], block_rows):
+        block = np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+        lists[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+
+def _write_ivf(base: str,
+               centroids: np.ndarray,
+               lists: np.ndarray,
+               fetch: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]],
+               block_rows: int):
+    """
+    Writes the rows of a virtual stream grouped by inverted list, with the files of `write_matrix` (so that the
+    rows can be read back as a plain binary index) plus the centroids, the list offsets and an id-sorted lookup.
+    `fetch` returns the vectors and ids at the given positions of the stream; at most block_rows are fetched at once.
+    """
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    paths = matrix_paths(base)
+    n, dim = lists.shape[0], centroids.shape[1]
+    order = np.argsort(lists, kind="stable")
+    matrix_tmp, ids_tmp = paths["matrix"] + ".tmp", paths["ids"] + ".tmp"
+    matrix = np.lib.format.open_memmap(matrix_tmp, mode="w+", dtype=np.float32, shape=(n, dim))
+    ids = np.lib.format.open_memmap(ids_tmp, mode="w+", dtype=np.int64, shape=(n,))
+    for start in range(0, n, block_rows):
+        vectors, block_ids = fetch(order[start:start + block_rows])
+        matrix[start:start + vectors.shape[0]] = vectors
+        ids[start:start + vectors.shape[0]] = block_ids
+    matrix.flush()
+    ids.flush()
+    # id-sorted lookup, so that ids are resolved by binary search over memory maps
+    keys = np.asarray(ids)
+    by_id = np.argsort(keys, kind="stable")
+    _save_array(array_path(base, "keys"), keys[by_id])
+    _save_array(array_path(base, "key_rows"), by_id.astype(np.int64))
+    del matrix, ids, keys
+    replace_file(matrix_tmp, paths["matrix"])
+    replace_file(ids_tmp, paths["ids"])
+    _save_array(array_path(base, "centroids"), centroids.astype(np.float32))
+    offsets = np.zeros(centroids.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lists, minlength=centroids.shape[0]), out=offsets[1:])
+    _save_array(array_path(base, "offsets"), offsets)
+    removed_path = array_path(base, "removed")
+    if os.path.isfile(removed_path):
+        os.remove(removed_path)
+    write_json(paths["header"], {"version": FORMAT_VERSION,
+                                 "dtype": "float32",
+                                 "id_dtype": "int64",
+                                 "count": int(n),
+                                 "dim": int(dim),
+                                 "arrays": [],
+                                 "normalized": True,
+                                 "layout": "ivf",
+                                 "nlist": int(centroids.shape[0])})
+
+
+class DiskIVF:
+    def __init__(self,
+                 base: str,
+                 ram_budget: int = 256 << 20,
+                 nprobe: int = 16):
+        """
+        Opens an inverted-file index written by `build`. Only the centroids, the list offsets and a tombstone
+        bitmap are loaded; the rows, their ids and the id lookup stay on disk and are read through memory maps,
+        a probed list at a time. Lists read by queries are kept in an LRU cache while it fits the RAM budget, so
+        hot lists are served from memory and cold ones from the page cache or the disk.
+
+        Args:
+        - base: A string representing the path of the index files without extension.
+        - ram_budget: An integer representing the bytes the index may hold in memory, resident arrays included.
+        - nprobe: An integer representing how many inverted lists are scanned per query.
+        """
+        self.base: str = base
+        self.ram_budget: int = ram_budget
+        self.nprobe: int = nprobe
+        paths = matrix_paths(base)
+        import json
+        with open(paths["header"], 'r') as f:
+            self.header: Dict = json.load(f)
+        if self.header.get("layout") != "ivf" or self.header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"no on-disk IVF index at {base}")
+        self.count: int = self.header["count"]
+        self.d: int = self.header["dim"]
+        mmap_mode = 'r' if self.count > 0 else None
+        self.matrix: np.ndarray = np.load(paths["matrix"], mmap_mode=mmap_mode)
+        self.ids: np.ndarray = np.load(paths["ids"], mmap_mode=mmap_mode)
+        self.keys: np.ndarray = np.load(array_path(base, "keys"), mmap_mode=mmap_mode)
+        self.key_rows: np.ndarray = np.load(array_path(base, "key_rows"), mmap_mode=mmap_mode)
+        self.centroids: np.ndarray = np.load(array_path(base, "centroids"))
+        self.offsets: np.ndarray = np.load(array_path(base, "offsets"))
+        self.removed: np.ndarray = np.zeros(self.count, dtype=bool)
+        removed_path = array_path(base, "removed")
+        if os.path.isfile(removed_path):
+            self.removed = np.unpackbits(np.load(removed_path), count=self.count).astype(bool)
+        self.n_removed: int = int(self.removed.sum())
+        self.dirty: bool = False
+        self._cache: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._cached_bytes: int = 0
+        resident = sum(arr.nbytes for arr in (self.centroids, self.offsets, self.removed))
+        self.cache_budget: int = max(0, ram_budget - resident)
+        if resident > ram_budget:
+            print(f"on-disk index needs {resident} resident bytes, more than its RAM budget of {ram_budget}")
+        self.stats: Dict[str, int] = {"queries": 0, "lists": 0, "cache_hits": 0, "pages": 0}
+        self.last_pages: List[int] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls,
+              base: str,
+              matrix: np.ndarray,
+              ids: np.ndarray,
+              nlist: Optional[int] = None,
+              train_size: int = 100_000,
+              block_rows: int = 1 << 16,
+              **kwargs) -> "DiskIVF":
+        """
+        Trains the centroids on a sample of an L2-normalized matrix (e.g. the memory map of a saved binary index)
+        and writes its rows grouped by inverted list at base, streaming block_rows at a time.
+
+        Args:
+        - base: A string representing the path of the index files without extension.
+        - matrix: A numpy array of shape (N, d), which may be a memory map larger than RAM.
+        - ids: A numpy array of the N int64 ids.
+        - nlist: An optional integer representing the number of inverted lists, about 4·sqrt(N) if None.
+        - train_size: An integer representing how many rows k-means is trained on.
+        - block_rows: An integer representing how many rows are held in memory at a time.
+        - kwargs: The arguments of `DiskIVF`.
+        """
+        n = matrix.shape[0]
+        if n == 0:
+            raise ValueError("no vectors to build an on-disk index from")
+        nlist = default_nlist(n, nlist, train_size)
+        centroids = train_centroids(matrix, nlist, sample_size=train_size, block_rows=block_rows)
+        lists = assign_lists(matrix, centroids, block_rows)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        def fetch(positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            # read in storage order, so that a memory map is scanned forward
+            by_position = np.argsort(positions, kind="stable")
+            vectors = np.empty((positions.shape[0], matrix.shape[1]), dtype=np.float32)
+            vectors[by_position] = matrix[positions[by_position]]
+            return vectors, ids[positions]
+
+        _write_ivf(base, centroids, lists, fetch, block_rows)
+        print(f"on-disk index of {n} vector(s) in {nlist} list(s) written to {base}.npy")
+        return cls(base, **kwargs)
+
+    def rebuild(self,
+                base: str,
+                matrix: np.ndarray,
+                ids: List[int],
+                block_rows: int = 1 << 16,
+                retrain: bool = False,
+                nlist: Optional[int] = None,
+                train_size: int = 100_000) -> "DiskIVF":
+        """
+        Writes a new index at base holding the live rows of this one and the given new rows. Rows are assigned to
+        the existing centroids, or, with retrain, to centroids trained anew on a sample of all of them, resized to
+        the grown row count (see `default_nlist`). Rows are streamed block by block, the old index stays readable.
+        """
+        removed = self.removed
+        live = np.flatnonzero(~removed)
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.d)
+        new_ids = np.asarray(ids, dtype=np.int64)
+        n_old = live.shape[0]
+        n = n_old + matrix.shape[0]
+
+        def fetch(positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            vectors = np.empty((positions.shape[0], self.d), dtype=np.float32)
+            out_ids = np.empty(positions.shape[0], dtype=np.int64)
+            old = positions < n_old
+            rows = live[positions[old]]
+            vectors[old] = self.matrix[rows]
+            out_ids[old] = self.ids[rows]
+            vectors[~old] = matrix[positions[~old] - n_old]
+            out_ids[~old] = new_ids[positions[~old] - n_old]
+            return vectors, out_ids
+
+        centroids = self.centroids
+        if retrain:
+            rng = np.random.default_rng(0)
+            sample, _ = fetch(np.sort(rng.choice(n, size=min(n, train_size), replace=False)))
+            centroids = train_centroids(sample, default_nlist(n, nlist, train_size), sample_size=sample.shape[0],
+                                        block_rows=block_rows)
+            lists = np.empty(n, dtype=np.int32)
+            for start in range(0, n, block_rows):
+                vectors, _ = fetch(np.arange(start, min(n, start + block_rows)))
+                lists[start:start + vectors.shape[0]] = np.argmax(vectors @ centroids.T, axis=1)
+        else:
+            old_lists = np.repeat(np.arange(self.centroids.shape[0], dtype=np.int32), np.diff(self.offsets))[live]
+            lists = np.concatenate([old_lists, assign_lists(matrix, centroids, block_rows)])
+        _write_ivf(base, centroids, lists, fetch, block_rows)
+        print(f"on-disk index rebuilt with {n_old} kept and {matrix.shape[0]} new vector(s) in "
+              f"{centroids.shape[0]} list(s){' retrained' if retrain else ''} at {base}.npy")
+        return DiskIVF(base, ram_budget=self.ram_budget, nprobe=self.nprobe)
+
+    def __len__(self) -> int:
+        return self.count - self.n_removed
+
+    def rows_of(self, ids: List[Hashable], removed: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Returns the rows holding the given ids (those present) that are live in the tombstone bitmap removed, the
+        published one if None, by binary search over the id lookup.
+        """
+        removed = self.removed if removed is None else removed
+        if self.count == 0 or len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, ids), self.count - 1)
+        found = self.keys[pos] == ids
+        rows = np.asarray(self.key_rows[pos[found]], dtype=np.int64)
+        return rows[~removed[rows]]
+
+    def tombstone(self, ids: List[Hashable], removed: np.ndarray) -> int:
+        """
+        Tombstones the rows of the given ids in removed, a private copy of the published bitmap that readers do not
+        see until it is published with `publish_removed`, and returns how many were found.
+        """
+        assert removed is not self.removed, "published tombstones are immutable"
+        rows = self.rows_of(ids, removed)
+        removed[rows] = True
+        return int(rows.shape[0])
+
+    def publish_removed(self, removed: np.ndarray):
+        """
+        Makes a tombstone bitmap the one searches see, with a single reference assignment.
+        """
+        if removed is self.removed:
+            return
+        self.n_removed = int(removed.sum())
+        self.removed = removed
+        self.dirty = True
+
+    def remove(self, ids: List[Hashable]) -> int:
+        """
+        Tombstones the rows of the given ids on a copy of the bitmap, published once all are flipped, and returns
+        how many were found.
+        """
+        removed = self.removed.copy()
+        cnt = self.tombstone(ids, removed)
+        if cnt:
+            self.publish_removed(removed)
+        return cnt
+
+    def save_removed(self):
+        if self.dirty:
+            _save_array(array_path(self.base, "removed"), np.packbits(self.removed))
+            self.dirty = False
+
+    def _pages(self, arr: np.ndarray, start: np.ndarray, end: np.ndarray) -> int:
+        """
+        Returns the number of pages the row ranges [start, end) of a memory-mapped array span.
+        """
+        offset = getattr(arr, "offset", 0)
+        row_bytes = arr.itemsize * (arr.shape[1] if arr.ndim > 1 else 1)
+        first = (offset + start * row_bytes) // mmap.PAGESIZE
+        last = (offset + end * row_bytes - 1) // mmap.PAGESIZE
+        return int(np.sum(last - first + 1))
+
+    def _read_list(self, l: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """
+        Returns the rows, vectors and ids of an inverted list, and the pages read from the memory maps for it
+        (none when the list was cached).
+        """
+        start, end = int(self.offsets[l]), int(self.offsets[l + 1])
+        rows = np.arange(start, end)
+        with self._lock:
+            cached = self._cache.get(l)
+            if cached is not None:
+                self._cache.move_to_end(l)
+                self.stats["cache_hits"] += 1
+                return rows, cached[0], cached[1], 0
+        vectors, ids = np.array(self.matrix[start:end]), np.array(self.ids[start:end])
+        bounds = np.array([start]), np.array([end])
+        pages = self._pages(self.matrix, *bounds) + self._pages(self.ids, *bounds) if end > start else 0
+        nbytes = vectors.nbytes + ids.nbytes
+        with self._lock:
+            if nbytes <= self.cache_budget and l not in self._cache:
+                while self._cached_bytes + nbytes > self.cache_budget:
+                    _, (old_vectors, old_ids) = self._cache.popitem(last=False)
+                    self._cached_bytes -= old_vectors.nbytes + old_ids.nbytes
+                self._cache[l] = (vectors, ids)
+                self._cached_bytes += nbytes
+        return rows, vectors, ids, pages
+
+    def search(self,
+               queries: np.ndarray,
+               k: Optional[int],
+               threshold: Optional[float] = None,
+               allowed_ids: Optional[np.ndarray] = None,
+               nprobe: Optional[int] = None,
+               removed: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Scores each query against the rows of its `nprobe` closest inverted lists (or only the rows of allowed_ids
+        when given), skipping the rows tombstoned in removed (the bitmap published when the search starts if
+        None), and returns its top-k (id, score) pairs by cosine similarity. The pages each query read from disk
+        are kept in `last_pages` and added to `stats`.
+        """
+        removed = self.removed if removed is None else removed
+        queries = VectorBuffer.normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        results, pages_per_query = [], []
+        if self.count == 0:
+            return [[] for _ in range(queries.shape[0])]
+        if allowed_ids is not None:
+            rows = np.sort(self.rows_of(allowed_ids.tolist(), removed))
+            vectors, ids = np.asarray(self.matrix[rows]), np.asarray(self.ids[rows])
+            pages = self._pages(self.matrix, rows, rows + 1) + self._pages(self.ids, rows, rows + 1)
+            for query in queries:
+                results.append(self._select(vectors @ query, ids, k, threshold))
+                pages_per_query.append(pages)
+        else:
+            nprobe = min(nprobe or self.nprobe, self.centroids.shape[0])
+            probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+            for query, lists in zip(queries, probes):
+                pages, scores, hit_ids = 0, [], []
+                for l in lists.tolist():
+                    rows, vectors, ids, read = self._read_list(l)
+                    pages += read
+                    live = ~removed[rows]
+                    scores.append((vectors @ query)[live])
+                    hit_ids.append(ids[live])
+                    with self._lock:
+                        self.stats["lists"] += 1
+                results.append(self._select(np.concatenate(scores), np.concatenate(hit_ids), k, threshold))
+                pages_per_query.append(pages)
+        with self._lock:
+            self.stats["queries"] += queries.shape[0]
+            self.stats["pages"] += sum(pages_per_query)
+            self.last_pages = pages_per_query
+        return results
+
+    @staticmethod
+    def _select(scores: np.ndarray,
+                ids: np.ndarray,
+                k: Optional[int],
+                threshold: Optional[float]) -> List[Tuple[int, float]]:
+        if threshold is not None:
+            keep = scores >= threshold
+            scores, ids = scores[keep], ids[keep]
+        n = scores.shape[0]
+        k = n if k is None else min(k, n)
+        if k <= 0:
+            return []
+        top, top_scores = select_topk(scores[None, :], k)
+        return list(zip(ids[top[0]].tolist(), top_scores[0].tolist()))
+
+    def page_report(self) -> Dict[str, float]:
+        """
+        Reports the pages read per query, the share of probed lists served from the cache and its memory use.
+        """
+        with self._lock:
+            queries = max(1, self.stats["queries"])
+            return {"queries": self.stats["queries"],
+                    "pages_per_query": self.stats["pages"] / queries,
+                    "cache_hit_rate": self.stats["cache_hits"] / max(1, self.stats["lists"]),
+                    "cached_lists": len(self._cache),
+                    "cached_bytes": self._cached_bytes,
+                    "cache_budget": self.cache_budget}
@@ -0,0 +1,182 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def replace_file(tmp_path: str, path: str):
+    """
+    Flushes a fully written temporary file to disk and atomically renames it over `path`.
+    """
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_json(path: str, obj: Any):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    replace_file(tmp_path, path)
+
+
+def matrix_paths(base: str) -> Dict[str, str]:
+    """
+    Returns the paths of the header and of the files written without a generation, by older versions of
+    `write_matrix` and by layouts that are written once under a fresh base (see `alexandria.vectorstore.ondisk`).
+    """
+    return {"header": f"{base}.header.json",
+            "matrix": f"{base}.npy",
+            "ids": f"{base}.ids.npy"}
+
+
+def array_path(base: str, name: str) -> str:
+    return f"{base}.{name}.npy"
+
+
+def has_matrix(base: str) -> bool:
+    return os.path.isfile(matrix_paths(base)["header"])
+
+
+def _read_header(base: str) -> Optional[Dict[str, Any]]:
+    path = matrix_paths(base)["header"]
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _data_files(base: str, header: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Returns the paths of the matrix, the ids and every per-row array a header refers to, keyed by "matrix", "ids"
+    and the array names.
+    """
+    root = os.path.dirname(base)
+    files = header.get("files")
+    if files is None:
+        # written before generations were recorded
+        paths = matrix_paths(base)
+        files = {"matrix": paths["matrix"], "ids": paths["ids"]}
+        files.update({name: array_path(base, name) for name in header.get("arrays", [])})
+        return files
+    return {key: os.path.join(root, name) for key, name in files.items()}
+
+
+def matrix_files(base: str) -> List[str]:
+    """
+    Returns every file of the matrix written at base: its header, the files the header refers to and those of the
+    generation it replaced, still kept for readers that opened it.
+    """
+    header = _read_header(base)
+    if header is None:
+        return []
+    root = os.path.dirname(base)
+    return [matrix_paths(base)["header"]] + list(_data_files(base, header).values()) \
+        + [os.path.join(root, name) for name in header.get("retired", [])]
+
+
+def _write_array(path: str, arr: np.ndarray):
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_matrix(base: str,
+                 matrix: np.ndarray,
+                 ids: np.ndarray,
+                 arrays: Optional[Dict[str, np.ndarray]] = None,
+                 **extra: Any) -> Dict[str, Any]:
+    """
+    Writes a float32 matrix and its int64 ids as raw `.npy` files next to a small versioned JSON header.
+    Every write goes to new files named after its generation (`<base>.g<n>.npy`, ...), flushed to disk before the
+    header naming them is atomically renamed into place, so readers and crashes see either the previous version
+    or the new one, never new vectors paired with old ids. The files of the previous generation are kept until the
+    next write, so that a reader that just read the previous header can still open them; processes that map them
+    keep reading the old inodes anyway.
+
+    Args:
+    - base: A string representing the path of the files without extension, e.g. `<save_root>/vectors`.
+    - matrix: A numpy array of shape (N, d) to be stored as float32.
+    - ids: A numpy array or list of N integer ids to be stored as int64.
+    - arrays: An optional dictionary of other per-row arrays, each written to `<base>.g<n>.<name>.npy` as is.
+    - extra: Additional JSON-serializable fields recorded in the header.
+
+    Returns:
+    - The header written.
+    """
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    assert matrix.ndim == 2 and matrix.shape[0] == ids.shape[0], "matrix and ids to be written not aligned"
+    previous = _read_header(base)
+    generation = 0 if previous is None else previous.get("generation", -1) + 1
+    stem = f"{os.path.basename(base)}.g{generation}"
+    files = {"matrix": f"{stem}.npy", "ids": f"{stem}.ids.npy"}
+    data = [(files["matrix"], matrix), (files["ids"], ids)]
+    for name, arr in (arrays or {}).items():
+        assert arr.shape[0] == ids.shape[0], f"{name} to be written not aligned with ids"
+        files[name] = f"{stem}.{name}.npy"
+        data.append((files[name], np.ascontiguousarray(arr)))
+    root = os.path.dirname(base)
+    for name, arr in data:
+        _write_array(os.path.join(root, name), arr)
+    retired = []
+    if previous is not None:
+        retired = [os.path.relpath(path, root or ".") for path in _data_files(base, previous).values()]
+    header = {"version": FORMAT_VERSION,
+              "dtype": "float32",
+              "id_dtype": "int64",
+              "count": int(matrix.shape[0]),
+              "dim": int(matrix.shape[1]),
+              "arrays": sorted(arrays or {}),
+              "generation": generation,
+              "files": files,
+              "retired": retired}
+    header.update(extra)
+    write_json(matrix_paths(base)["header"], header)
+    if previous is not None:
+        for name in previous.get("retired", []):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and name not in files.values():
+                os.remove(path)
+    return header
+
+
+def read_matrix(base: str,
+                mmap: bool = True) -> Optional[Tuple[np.ndarray, np.ndarray, Dict[str, Any]]]:
+    """
+    Reads a matrix written by `write_matrix`, from the files its header names. With `mmap` the vectors are
+    memory-mapped read-only, so loading is near-instant and the pages are shared by every process mapping the
+    same file.
+
+    Returns:
+    - A tuple of (matrix, ids, header), or None if nothing has been written at base.
+    """
+    header = _read_header(base)
+    if header is None:
+        return None
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError(f"unsupported vector file version {header.get('version')} at {base}")
+    files = _data_files(base, header)
+    # numpy cannot map a zero-length payload
+    matrix = np.load(files["matrix"], mmap_mode='r' if mmap and header["count"] > 0 else None)
+    ids = np.load(files["ids"])
+    if matrix.shape != (header["count"], header["dim"]) or ids.shape != (header["count"],):
+        raise ValueError(f"vector files at {base} do not match their header")
+    return matrix, ids, header
+
+
+def read_array(base: str, name: str, header: Dict[str, Any]) -> Optional[np.ndarray]:
+    """
+    Reads a per-row array written along a matrix by `write_matrix`, or None if the header does not list it.
+    """
+    if name not in header.get("arrays", []):
+        return None
+    arr = np.load(_data_files(base, header)[name])
+    if arr.shape[0] != header["count"]:
+        raise ValueError(f"{name} array at {base} does not match its header")
+    return arr
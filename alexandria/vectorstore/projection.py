@@ -0,0 +1,153 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer, select_topk
+from alexandria.vectorstore.persistence import replace_file
+
+# vectors collected at full dimension before a store trains its projection on them
+DEFAULT_TRAIN_SIZE = 4096
+# target dimensions the recall table of a trained projection is reported for, besides the one in use
+REPORTED_DIMS = (64, 128, 192, 256, 384, 512, 768)
+
+
+def fit_components(sample: np.ndarray, dim: int, kind: str = "pca", seed: int = 0) -> np.ndarray:
+    """
+    Returns a (d, dim) matrix with orthonormal columns projecting d-dimensional vectors onto dim dimensions.
+
+    Args:
+    - sample: A numpy array of shape (N, d) representing the vectors to fit on, ignored for "rotation".
+    - dim: An integer representing the target dimension, below d.
+    - kind: A string representing the projection, "pca" (the leading eigenvectors of the uncentered second
+        moment of the sample, which best preserve inner products on average) or "rotation" (a random
+        orthonormal basis, data-independent).
+    - seed: An integer seeding the random rotation.
+    """
+    d = sample.shape[1]
+    if not 0 < dim < d:
+        raise ValueError(f"projection to {dim} dimension(s) out of range for {d}-dimensional vectors")
+    if kind == "rotation":
+        gaussian = np.random.default_rng(seed).standard_normal((d, dim))
+        components, _ = np.linalg.qr(gaussian)
+        return components.astype(np.float32)
+    if kind != "pca":
+        raise ValueError(f"projection {kind} not allowed")
+    sample = np.asarray(sample, dtype=np.float64)
+    # eigh returns ascending eigenvalues, the leading components come last
+    _, vectors = np.linalg.eigh(sample.T @ sample)
+    return np.ascontiguousarray(vectors[:, ::-1][:, :dim], dtype=np.float32)
+
+
+def recall_by_dim(components: np.ndarray,
+                  base: np.ndarray,
+                  queries: np.ndarray,
+                  dims: List[int],
+                  k: int = 10) -> Dict[int, float]:
+    """
+    Returns, for each target dimension, the fraction of the exact full-dimension cosine top-k of the queries over
+    base that a cosine search over base projected onto the first `dim` columns of components also returns.
+    Leading columns of both projections are projections themselves, so one fit serves every dimension.
+    """
+    normalize = VectorBuffer.normalize
+    base, queries = normalize(np.asarray(base, dtype=np.float32)), normalize(np.asarray(queries, dtype=np.float32))
+    k = min(k, base.shape[0])
+    truth, _ = select_topk(queries @ base.T, k)
+    truth = [set(row) for row in truth.tolist()]
+    projected_base, projected_queries = base @ components, queries @ components
+    recalls = {}
+    for dim in dims:
+        approx, _ = select_topk(normalize(projected_queries[:, :dim]) @ normalize(projected_base[:, :dim]).T, k)
+        hits = sum(len(t & set(a)) for t, a in zip(truth, approx.tolist()))
+        recalls[dim] = hits / (k * len(truth))
+    return recalls
+
+
+class Projection:
+    def __init__(self, components: np.ndarray, kind: str, recall: Optional[Dict[int, float]] = None, k: int = 10):
+        """
+        Initializes a linear projection of stored embeddings onto fewer dimensions, applied to every vector on
+        upsert and to every query, so that search compute and memory shrink by d / dim.
+
+        Args:
+        - components: A numpy array of shape (d, dim) with orthonormal columns.
+        - kind: A string representing how the components were obtained, "pca" or "rotation".
+        - recall: An optional dictionary of the recall@k against full-dimension search measured at training time,
+            by target dimension.
+        - k: An integer representing the k of that recall.
+        """
+        self.components: np.ndarray = np.ascontiguousarray(components, dtype=np.float32)
+        self.kind: str = kind
+        self.recall: Dict[int, float] = recall or {}
+        self.k: int = k
+
+    @property
+    def d(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def train(cls,
+              sample: np.ndarray,
+              dim: int,
+              kind: str = "pca",
+              k: int = 10,
+              n_queries: int = 256,
+              seed: int = 0) -> "Projection":
+        """
+        Fits a projection on a sample of the library and measures, on held-out sample vectors used as queries,
+        the recall@k it keeps against full-dimension search, for `dim` and the usual smaller and larger targets.
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        n_queries = min(n_queries, sample.shape[0] // 4)
+        picked = rng.permutation(sample.shape[0])
+        queries, base = sample[picked[:n_queries]], sample[picked[n_queries:]]
+        dims = sorted({d for d in REPORTED_DIMS if d < sample.shape[1]} | {dim})
+        components = fit_components(base, max(dims), kind, seed)
+        recall = recall_by_dim(components, base, queries, dims, k) if n_queries else {}
+        projection = cls(components[:, :dim], kind, recall, k)
+        print(f"{kind} projection from {projection.d} to {dim} dimension(s) trained on {sample.shape[0]} vector(s)"
+              + (f", recall@{k} {recall[dim]:.3f} against full dimension" if recall else ""))
+        return projection
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32) @ self.components
+
+    def report(self) -> Dict[str, float]:
+        """
+        Reports the dimensions, the compute and memory reduction and the recall@k against full-dimension search
+        measured at training time, for the dimension in use and the other candidates.
+        """
+        report = {"kind": self.kind, "d": self.d, "dim": self.dim, "reduction": self.d / self.dim}
+        report.update({f"recall@{self.k}[{dim}]": recall for dim, recall in sorted(self.recall.items())})
+        return report
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     components=self.components,
+                     kind=np.array(self.kind),
+                     k=np.array(self.k),
+                     recall_dims=np.array(list(self.recall), dtype=np.int64),
+                     recall=np.array(list(self.recall.values()), dtype=np.float64))
+        replace_file(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Projection"]:
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            recall = dict(zip(data["recall_dims"].tolist(), data["recall"].tolist()))
+            return cls(data["components"], str(data["kind"]), recall, int(data["k"]))
+
+
+def projection_path(index_base: str) -> str:
+    """
+    Returns where the projection of an index is saved, next to its files: `<save_root>/vectors.projection.npz`.
+    """
+    return f"{os.path.splitext(index_base)[0]}.projection.npz"
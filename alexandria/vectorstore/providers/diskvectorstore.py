@@ -0,0 +1,268 @@
+import glob
+import heapq
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer
+from alexandria.vectorstore.ondisk import DiskIVF
+from alexandria.vectorstore.persistence import has_matrix, read_matrix, write_json, write_matrix
+from alexandria.vectorstore.providers.naivevectorstore import NaiveVectorStore
+from models.document import DocumentFilter
+
+
+class DiskVectorStore(NaiveVectorStore):
+    INDEX_NAME = "ivf"
+    MANIFEST_NAME = "manifest.json"
+    DELTA_NAME = "delta"
+
+    def __init__(self,
+                 session_id: int,
+                 transient: bool,
+                 restore_index_from: Optional[str] = None,
+                 restore_map_from: Optional[str] = None,
+                 restore_meta_from: Optional[str] = None,
+                 ram_budget: int = 256 << 20,
+                 nprobe: int = 16,
+                 nlist: Optional[int] = None,
+                 build_min: int = 65536,
+                 merge_fraction: float = 0.05,
+                 retrain_factor: float = 4.0,
+                 train_size: int = 100_000,
+                 compact_threshold: float = 0.3
+                 ):
+        """
+        Initializes a vector store for libraries larger than RAM. The bulk of the vectors is kept in an on-disk
+        inverted-file index (see `DiskIVF`) read through memory maps, with only its centroids, list offsets,
+        tombstones and a cache of hot lists in memory. Upserted vectors go to an in-memory delta buffer first and
+        are folded into a new generation of the on-disk index at save time, once the delta is large enough.
+
+        Args:
+        - session_id: An integer representing the session this store belongs to.
+        - transient: A boolean indicating whether the store belongs to a transient session.
+        - restore_index_from: An optional string representing the directory of a previously saved index.
+        - restore_map_from: An optional string representing the path to a previously saved doc map.
+        - restore_meta_from: An optional string representing the path to previously saved chunk metadata.
+        - ram_budget: An integer representing the bytes the on-disk index may hold in memory.
+        - nprobe: An integer representing how many inverted lists are scanned per query.
+        - nlist: An optional integer representing the number of inverted lists of a new index, about 4·sqrt(N)
+            if None.
+        - build_min: An integer representing the number of vectors from which a first on-disk index is built.
+        - merge_fraction: A float representing the size of the delta, relative to the on-disk index, past which
+            the delta is folded into it.
+        - retrain_factor: A float representing how many times the row count the centroids were trained on the
+            library may grow to before a fold retrains them, with as many more lists as the growth calls for.
+        - train_size: An integer representing how many rows k-means is trained on.
+        - compact_threshold: A float representing the fraction of dead rows that triggers compaction in the delta.
+        """
+        self.ram_budget: int = ram_budget
+        self.nprobe: int = nprobe
+        self.nlist: Optional[int] = nlist
+        self.build_min: int = build_min
+        self.merge_fraction: float = merge_fraction
+        self.retrain_factor: float = retrain_factor
+        self.train_size: int = train_size
+        # the version readers see, published with one assignment: (on-disk index or None, its tombstone bitmap,
+        # delta buffer, published snapshot of the delta)
+        self._version: Tuple[Optional[DiskIVF], Optional[np.ndarray], Optional[VectorBuffer], tuple] = \
+            (None, None, None, ())
+        # tombstones of the on-disk index flipped by the write group under way, published when it ends
+        self._staged_removed: Optional[np.ndarray] = None
+        self._write_depth: int = 0
+        self.generation: int = 0
+        # number of rows the centroids of the on-disk index were trained on
+        self.trained: int = 0
+        super().__init__(session_id=session_id,
+                         transient=transient,
+                         restore_index_from=restore_index_from,
+                         restore_map_from=restore_map_from,
+                         restore_meta_from=restore_meta_from,
+                         compact_threshold=compact_threshold)
+
+    @property
+    def disk(self) -> Optional[DiskIVF]:
+        return self._version[0]
+
+    def _generation_base(self, root: str, generation: int) -> str:
+        return os.path.join(root, f"ivf-{generation}")
+
+    def _setup_index(self):
+        self.buffer = VectorBuffer(compact_threshold=self.compact_threshold)
+        disk = None
+        root = self.restore_index_from
+        if root is not None and os.path.isfile(os.path.join(root, self.MANIFEST_NAME)):
+            import json
+            with open(os.path.join(root, self.MANIFEST_NAME), 'r') as f:
+                manifest = json.load(f)
+            self.generation = manifest["generation"]
+            disk = DiskIVF(self._generation_base(root, self.generation), ram_budget=self.ram_budget, nprobe=self.nprobe)
+            # manifests written before retraining was tracked count the first build as trained on the whole index
+            self.trained = manifest.get("trained", disk.count)
+            print(f"on-disk index of {len(disk)} vector(s) opened, "
+                  f"{disk.cache_budget} bytes left to cache its lists")
+        if root is not None:
+            restored = read_matrix(os.path.join(root, self.DELTA_NAME))
+            # an empty delta has no dimension, the buffer takes it from its first rows
+            if restored is not None and restored[0].shape[0] > 0:
+                matrix, ids, _ = restored
+                self.buffer = VectorBuffer.from_arrays(matrix, ids, compact_threshold=self.compact_threshold)
+        self._publish(disk)
+
+    @classmethod
+    def migrate_naive(cls, index_base: str, disk_root: str, **kwargs) -> bool:
+        """
+        Builds an on-disk index under disk_root from a binary index saved by `NaiveVectorStore` at index_base,
+        once. The saved matrix is memory-mapped and streamed, so it may be larger than RAM.
+
+        Returns:
+        - True if an index was built.
+        """
+        if not has_matrix(index_base) or os.path.isfile(os.path.join(disk_root, cls.MANIFEST_NAME)):
+            return False
+        matrix, ids, _ = read_matrix(index_base)
+        if matrix.shape[0] == 0:
+            return False
+        DiskIVF.build(os.path.join(disk_root, "ivf-0"), matrix, ids, **kwargs)
+        write_json(os.path.join(disk_root, cls.MANIFEST_NAME), {"generation": 0, "trained": int(matrix.shape[0])})
+        print(f"binary index {index_base} moved to an on-disk index under {disk_root}")
+        return True
+
+    def _publish(self, disk: Optional[DiskIVF]):
+        """
+        Makes the on-disk index, its tombstones and the delta as they stand the version readers see.
+        """
+        self._version = (disk, None if disk is None else disk.removed, self.buffer, self.buffer.snapshot())
+
+    @contextmanager
+    def _writing(self):
+        """
+        Returns a context in which the tombstones flipped on disk and the rows added to or removed from the delta
+        by one upsert are published together, as one version: a search never sees a document with its old rows
+        hidden and its new rows not visible yet, or the other way round.
+        """
+        if self.buffer is None:
+            raise ValueError("vector buffer not initialized")
+        with self.buffer.writing():
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+        if self._write_depth == 0:
+            disk = self._version[0]
+            if disk is not None and self._staged_removed is not None:
+                disk.publish_removed(self._staged_removed)
+            self._staged_removed = None
+            self._publish(disk)
+
+    def _tombstone(self, ids: List[int]) -> int:
+        """
+        Tombstones ids on a private copy of the bitmap of the on-disk index, made once per write group.
+        """
+        disk = self._version[0]
+        if disk is None:
+            return 0
+        if self._staged_removed is None:
+            self._staged_removed = disk.removed.copy()
+        return disk.tombstone(ids, self._staged_removed)
+
+    def _remove_existed(self, ids: Optional[List[int]]) -> int:
+        if not ids:
+            return 0
+        self.metadata.remove(ids)
+        with self._writing():
+            return self.buffer.remove(ids) + self._tombstone(ids)
+
+    def _add(self, vectors: List[List[float]], ids: List[int]):
+        assert len(vectors) == len(ids), "vectors and ids to be inserted not aligned"
+        with self._writing():
+            # the new rows shadow those stored on disk
+            self._tombstone(ids)
+            self.buffer.add(vectors, ids)
+
+    def _find_topk(self,
+                   queries: np.ndarray,
+                   k: Optional[int],
+                   threshold: Optional[float] = None,
+                   allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        disk, removed, buffer, snapshot = self._version
+        delta = buffer.search(queries, k, threshold, allowed_ids, snapshot=snapshot)
+        if disk is None:
+            return delta
+        stored = disk.search(queries, k, threshold, allowed_ids, removed=removed)
+        results = []
+        for hits in zip(stored, delta):
+            merged = heapq.merge(*hits, key=lambda hit: hit[1], reverse=True)
+            results.append(list(merged) if k is None else [hit for _, hit in zip(range(k), merged)])
+        return results
+
+    def _search_scores(self,
+                       vectors: List[List[float]],
+                       k: Optional[int] = 3,
+                       threshold: Optional[float] = None,
+                       filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        allowed_ids = None if filter is None else self.metadata.select(filter)
+        return self._find_topk(queries, k, threshold, allowed_ids)
+
+    def quantization_report(self, queries: np.ndarray, k: int = 3) -> Dict[str, float]:
+        raise ValueError("vector store is not quantized")
+
+    def page_report(self) -> Dict[str, float]:
+        """
+        Reports the pages the on-disk index read per query so far and how its list cache performs.
+        """
+        if self.disk is None:
+            raise ValueError("no on-disk index built yet")
+        report = self.disk.page_report()
+        print(f"{report['pages_per_query']:.1f} page(s) read per query over {report['queries']} queries, "
+              f"{report['cache_hit_rate']:.1%} of probed lists cached")
+        return report
+
+    def _should_merge(self, disk: Optional[DiskIVF], buffer: VectorBuffer) -> bool:
+        if disk is None:
+            return len(buffer) >= self.build_min
+        # a rebuild also reclaims the rows tombstoned on disk
+        return max(len(buffer), disk.n_removed) >= max(1.0, self.merge_fraction * disk.count)
+
+    def _save_index(self, save_root: str):
+        """
+        Folds a large enough delta into a new generation of the on-disk index, written next to the current one
+        and switched to by rewriting the manifest, otherwise saves the delta and the on-disk tombstones as they are.
+        """
+        root = os.path.join(save_root, self.INDEX_NAME)
+        os.makedirs(root, exist_ok=True)
+        disk, _, buffer, _ = self._version
+        delta_base = os.path.join(root, self.DELTA_NAME)
+        if self._should_merge(disk, buffer):
+            matrix, ids = buffer.live()
+            ids = np.asarray(ids, dtype=np.int64)
+            generation = self.generation + 1 if disk is not None else self.generation
+            base = self._generation_base(root, generation)
+            if disk is None:
+                disk = DiskIVF.build(base, matrix, ids, nlist=self.nlist, train_size=self.train_size,
+                                     ram_budget=self.ram_budget, nprobe=self.nprobe)
+                self.trained = disk.count
+            else:
+                disk.save_removed()
+                n = len(disk) + len(ids)
+                # lists trained on a much smaller library grow long, the centroids are trained anew and resized
+                retrain = n > self.retrain_factor * self.trained
+                disk = disk.rebuild(base, matrix, ids, retrain=retrain, nlist=self.nlist, train_size=self.train_size)
+                if retrain:
+                    self.trained = disk.count
+            write_json(os.path.join(root, self.MANIFEST_NAME), {"generation": generation, "trained": self.trained})
+            self.buffer = VectorBuffer(compact_threshold=self.compact_threshold)
+            self._publish(disk)
+            # open memory maps keep reading the files of older generations until they are released
+            for path in glob.glob(os.path.join(root, "ivf-*")):
+                if not os.path.basename(path).startswith(f"ivf-{generation}."):
+                    os.remove(path)
+            self.generation = generation
+        elif disk is not None:
+            disk.save_removed()
+        matrix, ids = self.buffer.live()
+        write_matrix(delta_base, matrix, np.asarray(ids, dtype=np.int64), normalized=True)
+        print(f"on-disk index and a delta of {len(self.buffer)} vector(s) written to {root}")
@@ -0,0 +1,13 @@
+# settings accepted by FaissVectorStore, kept apart from it so that they can be validated without importing faiss
+
+ALLOWED_INDEX_TYPE = {
+    r"Flat",
+    r"HNSW\d+",
+    r"IVF\d+,Flat",
+    r"IVF\d+,PQ\d+(x\d+)?",
+}
+# metric name -> name of the faiss metric constant
+ALLOWED_METRIC = {
+    "L2": "METRIC_L2",
+    "cosine": "METRIC_INNER_PRODUCT",
+}
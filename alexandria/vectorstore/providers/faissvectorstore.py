@@ -1,17 +1,27 @@
+import asyncio
 import os
+import re
 import json
+import threading
+import time
 import faiss
 import numpy as np
-from typing import Dict, List, Optional
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
+from alexandria.vectorstore.buffer import VectorBuffer, select_topk
+from alexandria.vectorstore.metadata import MetadataColumns
+from alexandria.vectorstore.persistence import replace_file, write_json
+from alexandria.vectorstore.providers import faissconstants
+from alexandria.vectorstore.projection import DEFAULT_TRAIN_SIZE, Projection, projection_path
 from alexandria.vectorstore.vectorstore import VectorStore
-from models.conversation import MultipleConversation, SingleConversation
-from models.document import DocumentChunkWithEmbedding, SingleDocumentWithChunks
+from alexandria.vectorstore.wal import OP_ADD, OP_DOCS, OP_REMOVE, WriteAheadLog
+from models.document import DocumentFilter, SingleDocumentWithChunks
 from models.generic import Bundle
 
 class FaissVectorStore(VectorStore):
-    ALLOWED_INDEX_TYPE = {
-        "Flat",
-    }
+    WAL_NAME = "vectors.wal"
+    ALLOWED_INDEX_TYPE = faissconstants.ALLOWED_INDEX_TYPE
+    ALLOWED_METRIC = {name: getattr(faiss, constant) for name, constant in faissconstants.ALLOWED_METRIC.items()}
     def __init__(self,
                  dim: int,
                  session_id: int,
@@ -19,7 +29,20 @@ class FaissVectorStore(VectorStore):
                  index_key: str = "Flat",
                  restore_index_from: Optional[str] = None,
                  restore_map_from: Optional[str] = None,
+                 restore_meta_from: Optional[str] = None,
                  cuda: bool = False,
+                 metric: str = "L2",
+                 nprobe: Optional[int] = None,
+                 ef_search: Optional[int] = None,
+                 train_size: Optional[int] = None,
+                 checkpoint_bytes: int = 64 * 1024 * 1024,
+                 compact_threshold: float = 0.3,
+                 compact_min_dead: int = 1024,
+                 merge_min: int = 4096,
+                 merge_fraction: float = 0.05,
+                 projection_dim: Optional[int] = None,
+                 projection_kind: str = "pca",
+                 projection_train_size: int = DEFAULT_TRAIN_SIZE,
         ):
         """
         Initializes a new instance of the FaissVectorStore class.
@@ -28,26 +51,104 @@ class FaissVectorStore(VectorStore):
         - dim: An integer representing the dimensionality of the embeddings.
         - session_id: A string representing the session ID.
         - transient: A boolean flag indicating whether the embeddings should be stored permanently or temporarily.
-        - index_key: A string representing the type of index to use (allowed values: "Flat").
+        - index_key: A string representing the type of index to use (allowed values: "Flat", "HNSW32", "IVF<nlist>,Flat",
+          "IVF<nlist>,PQ<m>").
         - restore_index_from: An optional string representing the path to a previously saved index.
         - restore_map_from: An optional string representing the path to a previously saved map.
+        - restore_meta_from: An optional string representing the path to previously saved chunk metadata.
         - cuda: A boolean flag indicating whether to use GPU for computations.
+        - metric: A string representing the distance, "L2" or "cosine" (inner product over L2-normalized vectors, the
+          same scores as NaiveVectorStore).
+        - nprobe: An optional integer representing the default number of inverted lists visited by IVF searches.
+        - ef_search: An optional integer representing the default candidate list size of HNSW searches.
+        - train_size: An optional integer representing how many vectors to collect before training an index that
+          requires it (IVF, PQ); defaults to 39 vectors per centroid.
+        - checkpoint_bytes: An integer representing the write-ahead log size past which serializing writes a new
+          snapshot of the whole index instead of appending to the log.
+        - compact_threshold: A float representing the fraction of tombstoned vectors that triggers a background
+          compaction.
+        - compact_min_dead: An integer representing the minimum number of tombstoned vectors before compacting.
+        - merge_min: An integer representing the number of vectors the delta segment collects before being merged
+          into the index.
+        - merge_fraction: A float representing the size of the delta segment, relative to the index, past which it
+          is merged once it holds more than merge_min vectors.
+        - projection_dim: An optional integer representing the dimension vectors are projected onto before being
+          indexed (see `Projection`), None to index them as they are.
+        - projection_kind: A string representing the projection, "pca" or "rotation".
+        - projection_train_size: An integer representing how many vectors the delta segment collects, at full
+          dimension, before the projection is trained on them and the first merge builds a projected index.
+
+        Searches never wait for writers. Upserts append to a small brute-forced delta segment and tombstone the
+        copies they replace; once the delta is large enough it is merged into a copy of the index, which is then
+        published together with an empty delta by a single reference assignment. A search works on the version
+        (index, delta rows, tombstones) published when it started, none of which is mutated afterwards.
         """
+        if not any(re.fullmatch(pattern, index_key) for pattern in self.ALLOWED_INDEX_TYPE):
+            raise ValueError(f"index key {index_key} not allowed")
+        if metric not in self.ALLOWED_METRIC:
+            raise ValueError(f"metric {metric} not allowed")
+        if projection_dim is not None and projection_dim >= dim:
+            print(f"projection to {projection_dim} dimension(s) would not reduce {dim}, skipped")
+            projection_dim = None
         self.d: int = dim
+        self.projection_dim: Optional[int] = projection_dim
+        self.projection_kind: str = projection_kind
+        self.projection_train_size: int = projection_train_size
+        # dimension of the indexed vectors, below d when they are projected
+        self.index_d: int = projection_dim or dim
         self.session_id: int = session_id
         self.transient: bool = transient
         self.index_key: str = index_key
         self.restore_index_from: Optional[str] = restore_index_from
         self.restore_map_from: Optional[str] = restore_map_from
+        self.restore_meta_from: Optional[str] = restore_meta_from
         self.cuda: bool = cuda
+        self.metric: str = metric
+        self.nprobe: Optional[int] = nprobe
+        self.ef_search: Optional[int] = ef_search
+        self.train_size: int = train_size or self._default_train_size()
         self.index: Optional[faiss.Index] = None
+        # vectors added since the last merge, in the same space as the index (normalized for cosine)
+        self.delta: Optional[VectorBuffer] = None
+        # sorted ids physically stored in the index, tombstoned ones included
+        self._main_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self.merge_min: int = merge_min
+        self.merge_fraction: float = merge_fraction
+        self.checkpoint_bytes: int = checkpoint_bytes
+        self._pending_log: List[bytes] = []
+        self._journal_root: Optional[str] = None
+        self._replaying: bool = False
+        self.compact_threshold: float = compact_threshold
+        self.compact_min_dead: int = compact_min_dead
+        # ids removed from the trained index but still physically stored in it, see `_remove_existed`
+        self.tombstones: Set[int] = set()
+        self._tombstone_sel: Optional[tuple] = None
+        # serializes writers only; searches read the published version
+        self._lock = threading.RLock()
+        self._deferred: int = 0
+        # delta rows kept out of an HNSW graph until compaction drops their tombstoned copies, see `_merge`
+        self._held: int = 0
+        self._version: Optional[tuple] = None
+        self._compacting: Optional[threading.Thread] = None
         self.doc_map: Optional[Dict[str, List[str]]] = None
+        self.metadata: Optional[MetadataColumns] = None
         self.device = None
+        # before the index, replaying the write-ahead log updates them too
+        self._setup_doc_map()
+        self._setup_metadata()
         try:
             self._setup_index()
         except Exception as e:
             print(f"Initializing index failure: {e}")
-        self._setup_doc_map()
+
+    def _default_train_size(self) -> int:
+        match = re.match(r"IVF(\d+)", self.index_key)
+        if match is None:
+            return 0
+        size = 39 * int(match.group(1))
+        if "PQ" in self.index_key:
+            size = max(size, 256)
+        return size
     
     def _setup_doc_map(self):
         """
@@ -61,30 +162,283 @@ class FaissVectorStore(VectorStore):
         else:
             self.doc_map = {}
 
+    def _new_index(self, index_key: str, dim: Optional[int] = None) -> faiss.Index:
+        index = faiss.index_factory(dim or self.index_d, index_key, self.ALLOWED_METRIC[self.metric])
+        if self.cuda and faiss.get_num_gpus() > 0:
+            raise NotImplemented
+            self.device = faiss.StandardGpuResources()
+            index = faiss.index_cpu_to_gpu(self.device, 0, index)
+        if not index_key.startswith("IVF"):
+            # only inverted-file indexes take ids natively
+            index = faiss.IndexIDMap2(index)
+        else:
+            self._with_direct_map(index)
+        return index
+
+    @staticmethod
+    def _with_direct_map(index: faiss.Index):
+        # id -> entry hashtable, so that an IVF index can tell whether it holds an id
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
     def _setup_index(self):
         """
         Sets up the index instance variable, which is a FAISS index object used to store and retrieve embeddings. If
         a path to a previously saved index is provided, it reads the index from the file. If not, it creates a new index
         using the specified index key. If a GPU is available and cuda is True, it uses the GPU for computations.
+        Indexes that need training are trained on the delta segment once it collected `train_size` vectors, until
+        then the delta serves searches alone. A delta saved next to the index (the staging index) is loaded back.
+        The same goes for a projection: the delta keeps full-dimension vectors until it is trained, and a
+        projection saved with the index is loaded back. An index saved at full dimension stays so.
         """       
+        if self.restore_index_from is not None:
+            self.projection = Projection.load(projection_path(self.restore_index_from))
+            if self.projection is not None:
+                self.index_d = self.projection.dim
         if self.restore_index_from is not None and os.path.isfile(self.restore_index_from):
-            index = faiss.read_index(self.restore_from)
+            index = faiss.read_index(self.restore_index_from)
+            if self.index_key.startswith("IVF"):
+                self._with_direct_map(index)
+            if self.projection is None and index.d == self.d and self.index_d != self.d:
+                print(f"FAISS index saved with {self.d} dimension(s), kept unprojected")
+                self.projection_dim, self.index_d = None, self.d
             self.index = index
         else:
-            index = faiss.index_factory(self.d, self.index_key)
-            if self.cuda and faiss.get_num_gpus() > 0:
-                raise NotImplemented
-                self.device = faiss.StandardGpuResources()
-                index = faiss.index_cpu_to_gpu(self.device, 0, index)
-            if self.index_key == "Flat":
-                index = faiss.IndexIDMap2(index)
-            self.index = index
-        assert self.index.d == self.d, "Initializing index failure: dimension not aligned"     
+            self.index = self._new_index(self.index_key)
+        assert self.index.d == self.index_d, "Initializing index failure: dimension not aligned"     
+        self._main_ids = np.sort(self._stored_ids(self.index))
+        self.delta = self._new_delta()
+        staging_path = self._staging_path(self.restore_index_from)
+        if staging_path is not None and os.path.isfile(staging_path):
+            staging = faiss.read_index(staging_path)
+            if staging.ntotal:
+                self.delta.add(staging.index.reconstruct_n(0, staging.ntotal),
+                               faiss.vector_to_array(staging.id_map).astype(np.int64).tolist())
+        tombstones_path = self._tombstones_path(self.restore_index_from)
+        if tombstones_path is not None and os.path.isfile(tombstones_path):
+            self.tombstones = set(np.load(tombstones_path).tolist())
+        self._publish()
+        if self.restore_index_from is not None:
+            root = os.path.dirname(self.restore_index_from)
+            projection = self.projection
+            self._replay(WriteAheadLog(os.path.join(root, self.WAL_NAME)))
+            if self.projection is projection:
+                # a projection trained while replaying is not in the snapshot, the next save must write one
+                self._journal_root = os.path.normpath(root)
+
+    def _new_delta(self) -> VectorBuffer:
+        dim = self.d if self._projection_pending() else self.index_d
+        return VectorBuffer(dim=dim, unit_norm=False, compact_threshold=self.compact_threshold)
+
+    def _projection_pending(self) -> bool:
+        return self.projection_dim is not None and self.projection is None
+
+    def _reduced(self, vectors: np.ndarray, dim: Optional[int]) -> np.ndarray:
+        """
+        Like `_projected`, normalizing projected vectors again for cosine indexes.
+        """
+        reduced = self._projected(vectors, dim)
+        if reduced is not vectors and self.metric == "cosine":
+            faiss.normalize_L2(reduced)
+        return reduced
+
+    def _train_projection(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Trains the projection on the full-dimension vectors of the delta segment and returns them projected.
+        The next serialization writes a snapshot, as the log holds full-dimension records until then.
+        """
+        self.projection = Projection.train(matrix, self.projection_dim, self.projection_kind)
+        self._journal_root = None
+        return self._reduced(np.array(matrix, dtype=np.float32, order="C"), self.index_d)
+
+    def projection_report(self) -> Dict[str, float]:
+        """
+        Reports the dimensions the vectors are indexed with and the recall@k against full-dimension search the
+        projection kept on the delta segment it was trained on, for its dimension and other candidates.
+        """
+        if self.projection is None:
+            raise ValueError("vector store is not projected")
+        report = self.projection.report()
+        print(f"vectors indexed with {report['dim']} of {report['d']} dimension(s) ({report['reduction']:.1f}x), "
+              + ", ".join(f"{key} {value:.3f}" for key, value in report.items() if key.startswith("recall")))
+        return report
+
+    @staticmethod
+    def _stored_ids(index: faiss.Index) -> np.ndarray:
+        if index.ntotal == 0:
+            return np.empty(0, dtype=np.int64)
+        if isinstance(index, faiss.IndexIDMap2):
+            return faiss.vector_to_array(index.id_map).astype(np.int64)
+        invlists = faiss.extract_index_ivf(index).invlists
+        return np.concatenate([faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).astype(np.int64)
+                               for l in range(invlists.nlist)])
+
+    def _publish(self):
+        """
+        Makes the current index, delta rows and tombstone selector the version searches see, in one reference
+        assignment. Called with the lock held at the end of every write; nothing it references is mutated later.
+        """
+        if self._deferred:
+            return
+        self._version = (self.index, self.delta.snapshot(), self._tombstone_selector())
+
+    @contextmanager
+    def _writing(self):
+        """
+        Groups the removals and insertions of one upsert into a single published version.
+        """
+        with self._lock:
+            self._deferred += 1
+            try:
+                yield
+            finally:
+                self._deferred -= 1
+                self._publish()
+
+    def _replay(self, wal: WriteAheadLog):
+        """
+        Re-applies the write-ahead log on top of the loaded snapshot, doc map and metadata. Additions are replayed
+        as upserts and document changes overwrite whole entries, so replaying records that the snapshot already
+        contains (a crash between snapshot and log reset) is harmless.
+        """
+        self._replaying = True
+        try:
+            cnt = 0
+            for op, ids, vectors in wal.replay():
+                cnt += 1
+                if op == OP_DOCS:
+                    self.doc_map.update(vectors["docs"])
+                    self.metadata.apply(vectors["meta"])
+                    self._refs = None
+                    continue
+                self._remove_existed(ids)
+                if op == OP_ADD:
+                    self._add(vectors, ids)
+        finally:
+            self._replaying = False
+        if cnt:
+            print(f"replayed {cnt} record(s) from {wal.path}")
+
+    @staticmethod
+    def _staging_path(index_path: Optional[str]) -> Optional[str]:
+        if index_path is None:
+            return None
+        root, ext = os.path.splitext(index_path)
+        return f"{root}.staging{ext}"
+
+    @staticmethod
+    def _tombstones_path(index_path: Optional[str]) -> Optional[str]:
+        if index_path is None:
+            return None
+        return f"{os.path.splitext(index_path)[0]}.tombstones.npy"
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        # always a private copy, normalization works in place
+        vectors = np.array(vectors, dtype=np.float32, order="C")
+        if self.metric == "cosine":
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def _in_main(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Returns which of the given ids have a live (stored and not tombstoned) copy in the index.
+        """
+        if self._main_ids.shape[0] == 0:
+            return np.zeros(ids.shape[0], dtype=bool)
+        pos = np.minimum(np.searchsorted(self._main_ids, ids), self._main_ids.shape[0] - 1)
+        stored = self._main_ids[pos] == ids
+        if self.tombstones:
+            stored &= ~np.isin(ids, np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones)))
+        return stored
+
+    def _should_merge(self) -> bool:
+        n = len(self.delta)
+        if self._projection_pending():
+            return n >= max(self.projection_train_size, self.train_size)
+        if not self.index.is_trained:
+            return n >= self.train_size
+        return n >= max(self.merge_min, self.merge_fraction * self.index.ntotal)
+
+    def _merge(self, drop_tombstones: bool = False, with_delta: bool = True) -> int:
+        """
+        Builds the next index from a copy of the current one (or a freshly trained one, once enough vectors were
+        collected for an index that needs training) plus the delta rows, and swaps it in with an empty delta.
+        With with_delta False the delta is left as is and only tombstones are dropped.
+        Tombstoned vectors are dropped from the copy along the way, except from HNSW graphs which have to be rebuilt
+        for it: those keep their tombstones until compaction, and delta rows whose id has a tombstoned copy stay in
+        the new delta until then, since the tombstone would hide them in the graph too.
+        Called with the lock held; the caller publishes.
+
+        Returns:
+        - An integer representing the number of tombstoned vectors dropped.
+        """
+        matrix, ids = self.delta.live() if with_delta else (None, [])
+        ids = np.asarray(ids, dtype=np.int64)
+        if with_delta and self._projection_pending():
+            matrix = self._train_projection(matrix)
+        if self.index.is_trained:
+            index = faiss.clone_index(self.index)
+            if self.index_key.startswith("IVF"):
+                self._with_direct_map(index)
+        else:
+            index = self._new_index(self.index_key)
+            print(f"training {self.index_key} index on {matrix.shape[0]} vector(s)")
+            index.train(matrix)
+        main_ids, dropped = self._main_ids, 0
+        held = np.zeros(ids.shape[0], dtype=bool)
+        if self.tombstones:
+            tombstones = np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+            if drop_tombstones or not self.index_key.startswith("HNSW"):
+                index, dropped = self._physical_remove(index, tombstones)
+                main_ids = main_ids[~np.isin(main_ids, tombstones)]
+                self.tombstones = set()
+                self._tombstone_sel = None
+                self._held = 0
+            else:
+                held = np.isin(ids, tombstones)
+                self._held = int(held.sum())
+        if ids.shape[0] > held.sum():
+            index.add_with_ids(np.ascontiguousarray(matrix[~held]), ids[~held])
+            main_ids = np.union1d(main_ids, ids[~held])
+        self.index, self._main_ids = index, main_ids
+        if with_delta:
+            self.delta = self._new_delta()
+            if held.any():
+                self.delta.add(matrix[held], ids[held].tolist())
+        return dropped
+
+    def _search_params(self,
+                       index: faiss.Index,
+                       nprobe: Optional[int],
+                       ef_search: Optional[int],
+                       sel: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+        nprobe = nprobe or self.nprobe
+        ef_search = ef_search or self.ef_search
+        if index.is_trained and self.index_key.startswith("IVF") and (nprobe or sel):
+            params = faiss.SearchParametersIVF(sel=sel)
+            if nprobe:
+                params.nprobe = nprobe
+            return params
+        if index.is_trained and self.index_key.startswith("HNSW") and (ef_search or sel):
+            params = faiss.SearchParametersHNSW(sel=sel)
+            if ef_search:
+                params.efSearch = ef_search
+            return params
+        if sel is not None:
+            return faiss.SearchParameters(sel=sel)
+        return None
 
     def _remove_existed(self, ids: Optional[np.ndarray | List[int]]):
         """
         Removes embeddings with chunk IDs that already exist in the index. The ids parameter can be a list of IDs or a numpy
         array of integer values. If ids is None or an empty list, the method returns 0.
+
+        Ids in the delta segment are dropped from it; removing from the index only tombstones the ids: they are
+        filtered out of every search through an IDSelector and physically dropped by the next merge or `compact`,
+        which runs in the background once enough accumulated. `remove_ids` rewrites the whole index (and HNSW
+        graphs do not support it at all), so one removal per upserted batch would make ingesting revised documents
+        quadratic.
         
         Args:
         - ids: A numpy array or list of integer values representing the IDs to remove from the index.
@@ -98,20 +452,118 @@ class FaissVectorStore(VectorStore):
             ids = np.asarray(ids, dtype=np.int64)
         if ids.shape[0] == 0:
             return 0
-        return self.index.remove_ids(ids)
+        with self._lock:
+            if not self._replaying:
+                self._pending_log.append(WriteAheadLog.encode(OP_REMOVE, ids))
+            if self.metadata is not None:
+                self.metadata.remove(ids.tolist())
+            cnt = self.delta.remove(ids.tolist())
+            removed = np.unique(ids[self._in_main(ids)]).tolist()
+            if removed:
+                self.tombstones.update(removed)
+                self._tombstone_sel = None
+            cnt += len(removed)
+            self._publish()
+        if removed:
+            self._maybe_compact()
+        return cnt
+
+    def _tombstone_selector(self) -> Optional[tuple]:
+        # rebuilt only after the tombstones changed; the batch selector must outlive the one negating it
+        if not self.tombstones:
+            return None
+        if self._tombstone_sel is None:
+            batch = faiss.IDSelectorBatch(np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones)))
+            self._tombstone_sel = (batch, faiss.IDSelectorNot(batch))
+        return self._tombstone_sel
+
+    def _physical_remove(self, index: faiss.Index, ids: np.ndarray) -> Tuple[faiss.Index, int]:
+        if self.index_key.startswith("HNSW"):
+            return self._rebuild(index, ids)
+        if self.index_key.startswith("IVF"):
+            # the hashtable direct map only removes through an array selector
+            return index, index.remove_ids(faiss.IDSelectorArray(ids))
+        return index, index.remove_ids(faiss.IDSelectorBatch(ids))
+
+    def _rebuild(self, index: faiss.Index, ids: np.ndarray) -> Tuple[faiss.Index, int]:
+        """
+        Rebuilds an HNSW index without the given ids; its graph cannot drop nodes.
+        """
+        n = index.ntotal
+        all_ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+        keep = ~np.isin(all_ids, ids)
+        vectors = index.index.reconstruct_n(0, n)[keep]
+        rebuilt = self._new_index(self.index_key)
+        rebuilt.add_with_ids(vectors, all_ids[keep])
+        return rebuilt, n - int(keep.sum())
+
+    def _should_compact(self) -> bool:
+        return self._held > 0 or (len(self.tombstones) >= self.compact_min_dead
+                                  and len(self.tombstones) > self.compact_threshold * self.index.ntotal)
+
+    def _maybe_compact(self):
+        with self._lock:
+            if self._replaying or not self._should_compact():
+                return
+            if self._compacting is not None and self._compacting.is_alive():
+                return
+            self._compacting = threading.Thread(target=self.compact, daemon=True)
+            self._compacting.start()
+
+    def compact(self) -> Dict[str, float]:
+        """
+        Physically drops the tombstoned vectors from the index, rebuilding it for HNSW. The next index is built from
+        a copy while searches keep using the current one; writes wait for it.
+
+        Returns:
+        - A dictionary with the number of vectors dropped, the bytes reclaimed and the seconds elapsed.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            if not self.tombstones or not self.index.is_trained:
+                return {"reclaimed_vectors": 0, "reclaimed_bytes": 0, "elapsed": 0.0}
+            before = faiss.serialize_index(self.index).nbytes
+            reclaimed = self._merge(drop_tombstones=True, with_delta=False)
+            self._publish()
+            after = faiss.serialize_index(self.index).nbytes
+        elapsed = time.perf_counter() - started
+        print(f"FAISS index compacted: {reclaimed} tombstoned vector(s) dropped, "
+              f"{before - after} bytes reclaimed in {elapsed:.3f}s")
+        return {"reclaimed_vectors": reclaimed, "reclaimed_bytes": before - after, "elapsed": elapsed}
+
+    def wait_compaction(self):
+        thread = self._compacting
+        if thread is not None:
+            thread.join()
 
     def _add(self, vectors: List[List[float]], ids: List[int]):
         """
-        Adds embeddings and their corresponding IDs to the index. It converts the input lists to numpy arrays and calls
-        the add_with_ids method of the FAISS index object.
+        Adds embeddings and their corresponding IDs to the delta segment, tombstoning the copies of those IDs in the
+        index, and merges the delta into the index once it is large enough.
         
         Args:
         - vectors: A list of lists of float values representing the embeddings to add to the index.
         - ids: A list of integer values representing the IDs of the embeddings to add to the index.
         """
-        vectors: np.ndarray = np.asarray(vectors, dtype=np.float32)
         ids: np.ndarray = np.asarray(ids, dtype=np.int64)
-        self.index.add_with_ids(vectors, ids)
+        if ids.shape[0] == 0:
+            return
+        vectors: np.ndarray = self._prepare(vectors)
+        with self._lock:
+            vectors = self._reduced(vectors, self.delta.d)
+            if not self._replaying:
+                self._pending_log.append(WriteAheadLog.encode(OP_ADD, ids, vectors))
+            # the new copy in the delta shadows the one in the index
+            stale = np.unique(ids[self._in_main(ids)]).tolist()
+            if stale:
+                self.tombstones.update(stale)
+                self._tombstone_sel = None
+            self.delta.add(vectors, ids.tolist())
+            if self._should_merge():
+                self._merge()
+            self._publish()
+        if stale or self._held:
+            self._maybe_compact()
 
     async def _upsert(
             self, 
@@ -121,68 +573,230 @@ class FaissVectorStore(VectorStore):
         Updates or inserts embeddings and their corresponding IDs into the index. It extracts the embeddings and their
         IDs from the input bundle, removes the embeddings with versioned IDs that already exist in the index, and adds
         the new embeddings to the index. It also updates the map instance variable with the new IDs.
+        The work runs on a worker thread, so the event loop keeps serving queries meanwhile.
         
         Args:
         - bundle: A Bundle object representing the embeddings to update or insert into the index.
         """
-        session_id = int(bundle.theme)
-        if self.transient:
-            assert session_id == self.session_id, "session_id not matched a recorded one"
-        contents = bundle.contents
-        versioned_sub_ids: List[int] = []
-        updated_sub_ids: List[int] = []
-        updated_embeddings: List[List[float]] = []
-        for elem in contents:
-            if isinstance(elem, SingleDocumentWithChunks):
-                doc_id = elem.doc_id
-                subs = elem.chunks
-                versioned_sub_ids.extend(self.doc_map.get(doc_id, []))
-                self.doc_map.update({doc_id: []})
-            elif isinstance(elem, SingleConversation):
-                subs = [elem]
-            else:
-                raise ValueError
-            for sub in subs:
-                if isinstance(sub, DocumentChunkWithEmbedding):
-                    self.doc_map.get(doc_id).append(sub.chunk_id)
-                    updated_sub_ids.append(sub.chunk_id)
-                    updated_embeddings.append(sub.embedding)
-                elif isinstance(sub, SingleConversation):
-                    updated_sub_ids.append(hash(sub))
-                    assert isinstance(bundle, MultipleConversation)
-                    updated_embeddings.append(bundle.embedding.embeddings.get(sub))
-                else:
-                    raise ValueError
-        existed_cnt = self._remove_existed(versioned_sub_ids)
-        print(f"removed found {existed_cnt} existed id(s)")
-        self._add(updated_embeddings, updated_sub_ids)
-
-    async def _query(self, vectors: List[List[float]], k: int = 3) -> List[List[int]]:
-        """
-        Query the index to find the k most similar records to the input vectors.
+        await asyncio.to_thread(self._apply_upsert, bundle)
+
+    def _apply_upsert(self, bundle: Bundle):
+        # under the writer lock, published as one version
+        with self._writing():
+            session_id = int(bundle.theme)
+            if self.transient:
+                assert session_id == self.session_id, "session_id not matched a recorded one"
+            doc_ids = [elem.doc_id for elem in bundle.contents if isinstance(elem, SingleDocumentWithChunks)]
+            # chunks the documents referred to before, some of which may be handed over to another document
+            previous = [id for doc_id in doc_ids for id in self.doc_map.get(doc_id, [])]
+            versioned_sub_ids, updated_sub_ids, updated_embeddings, updated_meta = self._collect_upsert(bundle)
+            existed_cnt = self._remove_existed(versioned_sub_ids)
+            print(f"removed found {existed_cnt} existed id(s)")
+            self._add(updated_embeddings, updated_sub_ids)
+            if updated_meta:
+                self.metadata.upsert(*map(list, zip(*updated_meta)))
+            if doc_ids and not self._replaying:
+                touched = previous + [row[0] for row in updated_meta]
+                self._pending_log.append(WriteAheadLog.encode_docs({
+                    "docs": {doc_id: self.doc_map[doc_id] for doc_id in doc_ids},
+                    "meta": self.metadata.export(list(dict.fromkeys(touched))),
+                }))
+
+    def _to_scores(self, distances: np.ndarray) -> np.ndarray:
+        # inner products already are similarities, L2 distances are negated so that higher is closer
+        return distances if self.metric == "cosine" else -distances
+
+    async def _query_with_scores(self,
+                                 vectors: List[List[float]],
+                                 k: Optional[int] = 3,
+                                 threshold: Optional[float] = None,
+                                 nprobe: Optional[int] = None,
+                                 ef_search: Optional[int] = None,
+                                 filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Query the index to find the k most similar records to the input vectors, along with their scores.
         Args:
             vectors: A list of vectors to query the index with.
-            k: The number of most similar records to return.
+            k: The number of most similar records to return, or None to return every record above threshold.
+            threshold: The minimum score (cosine similarity, or negated squared L2 distance) of a returned record.
+            nprobe: Overrides the number of inverted lists visited for this query (IVF indexes).
+            ef_search: Overrides the candidate list size for this query (HNSW indexes).
+            filter: Restricts the search to records whose metadata matches, applied during the scan through an IDSelector.
         Returns:
-            A list of the IDs of the k most similar records for each query vector.
+            A list of (ID, score) pairs of the most similar records for each query vector, padding IDs excluded.
+        """
+        vectors: np.ndarray = self._prepare(vectors)
+        return self._search(vectors, k, threshold, nprobe, ef_search, filter)
+
+    def _search_scores(self,
+                       vectors: List[List[float]],
+                       k: Optional[int] = 3,
+                       threshold: Optional[float] = None,
+                       filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        return self._search(self._prepare(vectors), k, threshold, None, None, filter)
+
+    def _search(self,
+                vectors: np.ndarray,
+                k: Optional[int],
+                threshold: Optional[float],
+                nprobe: Optional[int],
+                ef_search: Optional[int],
+                filter: Optional[DocumentFilter]) -> List[List[Tuple[int, float]]]:
+        """
+        Searches the index and the delta segment of the published version, without taking the lock, and merges
+        the two result lists of every query by score.
+        """
+        index, delta, tombstone_sel = self._version
+        allowed = None if filter is None else self.metadata.select(filter)
+        main = self._search_index(index, tombstone_sel, vectors, k, threshold, nprobe, ef_search, allowed)
+        fresh = self._search_delta(delta, vectors, k, threshold, allowed)
+        results = []
+        for hits, more in zip(main, fresh):
+            if more:
+                hits = sorted(hits + more, key=lambda x: x[1], reverse=True)
+            results.append(hits if k is None else hits[:k])
+        return results
+
+    def _search_index(self,
+                      index: faiss.Index,
+                      tombstone_sel: Optional[tuple],
+                      vectors: np.ndarray,
+                      k: Optional[int],
+                      threshold: Optional[float],
+                      nprobe: Optional[int],
+                      ef_search: Optional[int],
+                      allowed: Optional[np.ndarray]) -> List[List[Tuple[int, float]]]:
+        if k is None and threshold is None:
+            raise ValueError("range search needs a threshold")
+        if index.ntotal == 0 or (allowed is not None and allowed.shape[0] == 0):
+            return [[] for _ in range(vectors.shape[0])]
+        vectors = self._reduced(vectors, index.d)
+        # selectors are referenced by pointer only, they must stay alive until the search returns
+        sel = None if tombstone_sel is None else tombstone_sel[1]
+        batch = None if allowed is None else faiss.IDSelectorBatch(allowed)
+        if batch is not None:
+            # an id re-added since the last merge is allowed but its copy in the index is tombstoned
+            sel = batch if sel is None else faiss.IDSelectorAnd(batch, sel)
+        params = self._search_params(index, nprobe, ef_search, sel)
+        if k is None:
+            radius = threshold if self.metric == "cosine" else -threshold
+            lims, distances, idx = index.range_search(vectors, radius, params=params)
+            scores = self._to_scores(distances)
+            results = []
+            for i in range(vectors.shape[0]):
+                hits = zip(idx[lims[i]:lims[i + 1]].tolist(), scores[lims[i]:lims[i + 1]].tolist())
+                results.append(sorted(hits, key=lambda x: x[1], reverse=True))
+            return results
+        distances, idx = index.search(vectors, k, params=params)
+        scores = self._to_scores(distances)
+        return [[(id, score) for id, score in zip(row_ids, row_scores)
+                 if id != -1 and (threshold is None or score >= threshold)]
+                for row_ids, row_scores in zip(idx.tolist(), scores.tolist())]
+
+    def _search_delta(self,
+                      delta: tuple,
+                      vectors: np.ndarray,
+                      k: Optional[int],
+                      threshold: Optional[float],
+                      allowed: Optional[np.ndarray]) -> List[List[Tuple[int, float]]]:
+        """
+        Scores the queries against every live row of a delta snapshot by brute force, with the metric of the index.
         """
-        vectors: np.ndarray = np.asarray(vectors, dtype=np.float32)
-        _, idx = self.index.search(vectors, k)
-        return idx.tolist()
+        if delta[1] == 0:
+            return [[] for _ in range(vectors.shape[0])]
+        if allowed is None:
+            matrix, alive, ids = self.delta.view(delta)
+            rows = np.flatnonzero(alive)
+        else:
+            matrix, rows, ids = self.delta.view_rows(allowed.tolist(), delta)
+        if rows.shape[0] == 0:
+            return [[] for _ in range(vectors.shape[0])]
+        vectors = self._reduced(vectors, matrix.shape[1])
+        candidates = matrix[rows]
+        scores = vectors @ candidates.T
+        if self.metric != "cosine":
+            # negated squared L2 distances, like `_to_scores`
+            scores = 2 * scores - np.square(vectors).sum(axis=1)[:, None] - np.square(candidates).sum(axis=1)[None, :]
+        if threshold is not None:
+            scores[scores < threshold] = -np.inf
+        top, top_scores = select_topk(scores, rows.shape[0] if k is None else min(k, rows.shape[0]))
+        return [[(ids[row], score) for row, score in zip(rows[cols].tolist(), row_scores) if score != -np.inf]
+                for cols, row_scores in zip(top, top_scores.tolist())]
     
     async def serializing(self, save_root: str, is_doc: bool):
-        os.makedirs(save_root, exist_ok=True)
+        """
+        Persists the changes since the last call. If save_root holds the snapshot this store was loaded from (or last
+        checkpointed to), the pending records are appended to its write-ahead log, so the cost depends on the batch
+        size rather than on the index size. A new snapshot is written once the log grows past `checkpoint_bytes`.
+        The doc map and chunk metadata of the upserted documents are logged along with their vectors; with is_doc
+        set, the snapshot includes them in full (mappings.json and metadata.npz).
+        """
+        await asyncio.to_thread(self._serialize, save_root, is_doc)
+
+    def _serialize(self, save_root: str, is_doc: bool):
+        with self._lock:
+            if self.index is None:
+                raise ValueError("FAISS index has not been initialized")
+            os.makedirs(save_root, exist_ok=True)
+            if self.id_registry is not None:
+                # dense ids must be durable before an index refers to them
+                self.id_registry.flush()
+            wal = WriteAheadLog(os.path.join(save_root, self.WAL_NAME))
+            pending_bytes = sum(len(record) for record in self._pending_log)
+            if self._journal_root == os.path.normpath(save_root) \
+                and wal.size() + pending_bytes < self.checkpoint_bytes:
+                wal.append(self._pending_log)
+                print(f"{len(self._pending_log)} record(s) appended to {wal.path}")
+            else:
+                self.checkpoint(save_root, is_doc)
+            self._pending_log = []
+
+    def checkpoint(self, save_root: str, is_doc: bool = True):
+        """
+        Writes a full snapshot of the index (and the delta segment, as a flat staging index) through a temporary file
+        and an atomic rename, then drops the write-ahead log it supersedes.
+        Tombstones are saved next to the snapshot rather than compacted away, so checkpointing stays a plain write.
+        With is_doc set, the doc map and chunk metadata are written too, before the log they supersede is dropped.
+        """
+        with self._lock:
+            self._checkpoint(save_root, is_doc)
+
+    def _checkpoint(self, save_root: str, is_doc: bool = True):
         index_save_to = os.path.join(save_root, "vectors.index")
-        if self.index is not None:
-            faiss.write_index(self.index, index_save_to)
-            print(f"FAISS index written to {index_save_to}")
-        else:
-            raise ValueError("FAISS index has not been initialized")
+        staging_save_to = self._staging_path(index_save_to)
+        tombstones_save_to = self._tombstones_path(index_save_to)
+        if self.projection is not None:
+            # before the index, which is only searchable with it
+            self.projection.save(projection_path(index_save_to))
+        if len(self.delta):
+            matrix, ids = self.delta.live()
+            staging = self._new_index("Flat", matrix.shape[1])
+            staging.add_with_ids(np.ascontiguousarray(matrix), np.asarray(ids, dtype=np.int64))
+            faiss.write_index(staging, staging_save_to + ".tmp")
+            replace_file(staging_save_to + ".tmp", staging_save_to)
+            print(f"FAISS staging index of {staging.ntotal} unmerged vector(s) written to {staging_save_to}")
+        faiss.write_index(self.index, index_save_to + ".tmp")
+        replace_file(index_save_to + ".tmp", index_save_to)
+        print(f"FAISS index written to {index_save_to}")
+        if not len(self.delta) and os.path.isfile(staging_save_to):
+            os.remove(staging_save_to)
+        # after the index: until the log is reset, its removals cover a crash in between
+        if self.tombstones:
+            with open(tombstones_save_to + ".tmp", 'wb') as f:
+                np.save(f, np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones)))
+            replace_file(tombstones_save_to + ".tmp", tombstones_save_to)
+        elif os.path.isfile(tombstones_save_to):
+            os.remove(tombstones_save_to)
         if is_doc:
             if self.doc_map:
                 map_save_to = os.path.join(save_root, "mappings.json")
-                with open(map_save_to, 'w') as f:
-                    json.dump(self.doc_map, f)
+                write_json(map_save_to, self.doc_map)
                 print(f"document ID mapping written to {map_save_to}")
+                meta_save_to = os.path.join(save_root, "metadata.npz")
+                self.metadata.save(meta_save_to)
+                print(f"chunk metadata written to {meta_save_to}")
             else:
-                print(f"document mapping has not been initialized")
\ No newline at end of file
+                print(f"document mapping has not been initialized")
+        WriteAheadLog(os.path.join(save_root, self.WAL_NAME)).reset()
+        self._journal_root = os.path.normpath(save_root)
+        self._pending_log = []
@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from alexandria.vectorstore.vectorstore import VectorStore
+from models.document import DocumentFilter
+from models.generic import Bundle
+
+
+class FederatedMember(NamedTuple):
+    name: str
+    vecstore: VectorStore
+    # the DocStore holding the chunks the vector store refers to
+    docstore: Any
+    weight: float = 1.0
+
+
+class FederatedVectorStore(VectorStore):
+
+    def __init__(self, members: List[FederatedMember]):
+        """
+        Initializes a read-only vector store searching several stores at once, e.g. the admin library and the
+        uploads of a session. A batch of query vectors is sent to every member concurrently, each member's scores
+        are mapped onto cosine similarity (so that L2 and cosine indexes can be compared), scaled by the member's
+        weight, and the per-member lists merged into one top-k. Hits remember their member, so that their chunks
+        are retrieved from the right DocStore.
+
+        Args:
+        - members: A list of `FederatedMember`, one per store searched.
+        """
+        if not members:
+            raise ValueError("a federated vector store needs at least one member")
+        self.members: List[FederatedMember] = members
+
+    @staticmethod
+    def _is_l2(vecstore: VectorStore) -> bool:
+        return getattr(vecstore, "metric", None) == "L2"
+
+    def _normalized(self, member: FederatedMember, score: float) -> float:
+        """
+        Maps a member's native score onto cosine similarity: for unit-norm vectors the negated squared L2
+        distance equals 2·cos - 2.
+        """
+        cosine = 1.0 + score / 2.0 if self._is_l2(member.vecstore) else score
+        return member.weight * cosine
+
+    def _native_threshold(self, member: FederatedMember, threshold: Optional[float]) -> Optional[float]:
+        if threshold is None:
+            return None
+        cosine = threshold / member.weight
+        return 2.0 * cosine - 2.0 if self._is_l2(member.vecstore) else cosine
+
+    @staticmethod
+    def _search_member(vecstore: VectorStore, vectors, k, threshold, filter) -> List[List[Tuple[int, float]]]:
+        # the stores search synchronously, so worker threads run members side by side without an event loop each
+        return vecstore._search_scores(vectors, k=k, threshold=threshold, filter=filter)
+
+    async def search_routed(self,
+                            vectors: List[List[float]],
+                            k: Optional[int] = 3,
+                            threshold: Optional[float] = None,
+                            filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, int, float]]]:
+        """
+        Like `_query_with_scores`, but returns (member index, id, normalized score) triples, so that each hit can be
+        routed back to the store and the DocStore it came from.
+        """
+        answers = await asyncio.gather(*(
+            asyncio.to_thread(self._search_member, member.vecstore, vectors, k,
+                              self._native_threshold(member, threshold), filter)
+            for member in self.members))
+        results = []
+        for per_member in zip(*answers):
+            routed = [[(m, id, self._normalized(self.members[m], score)) for id, score in hits]
+                      for m, hits in enumerate(per_member)]
+            merged = heapq.merge(*routed, key=lambda hit: hit[2], reverse=True)
+            results.append(list(merged) if k is None else [hit for _, hit in zip(range(k), merged)])
+        return results
+
+    async def _query_with_scores(self,
+                                 vectors: List[List[float]],
+                                 k: Optional[int] = 3,
+                                 threshold: Optional[float] = None,
+                                 filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        routed = await self.search_routed(vectors, k=k, threshold=threshold, filter=filter)
+        return [[(id, score) for _, id, score in hits] for hits in routed]
+
+    async def retrieve(self, hits: List[Tuple[int, int]]) -> List[Tuple[int, Any]]:
+        """
+        Retrieves the chunks of (member index, chunk id) hits from the DocStore of each member, all members at
+        once, and returns (member index, chunk) pairs in the order of the hits (chunks not found are skipped).
+        """
+        by_member: Dict[int, List[int]] = {}
+        for m, chunk_id in hits:
+            by_member.setdefault(m, []).append(chunk_id)
+        members = list(by_member)
+        doc_chunk_ids = {m: self.members[m].vecstore.docs_of_chunks(by_member[m]) for m in members}
+        retrieved = await asyncio.gather(*(self.members[m].docstore.retrieve(doc_chunk_ids[m]) for m in members))
+        chunks: Dict[Tuple[int, int], Any] = {}
+        for m, found in zip(members, retrieved):
+            for chunk in found:
+                chunks[(m, chunk.chunk_id)] = chunk
+        return [(m, chunks[(m, chunk_id)]) for m, chunk_id in hits if (m, chunk_id) in chunks]
+
+    async def _upsert(self, bundle: Bundle):
+        raise ValueError("federated vector store is read-only, upsert into one of its members")
+
+    def _add(self, vectors: List[List[float]], ids: List[int]):
+        raise ValueError("federated vector store is read-only, add to one of its members")
+
+    async def serializing(self, save_root: str, is_doc: bool):
+        raise ValueError("federated vector store is read-only, serialize its members")
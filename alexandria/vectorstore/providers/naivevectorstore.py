@@ -1,31 +1,55 @@
+import asyncio
 import os
+import threading
 import numpy as np
-from scipy.spatial.distance import cosine
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+from alexandria.vectorstore.buffer import VectorBuffer
+from alexandria.vectorstore.metadata import MetadataColumns
+from alexandria.vectorstore.persistence import has_matrix, read_array, read_matrix, write_matrix
+from alexandria.vectorstore.projection import DEFAULT_TRAIN_SIZE, Projection, projection_path
+from alexandria.vectorstore.quantization import QuantizedVectorBuffer
 from alexandria.vectorstore.vectorstore import VectorStore
-from models.conversation import MultipleConversation, SingleConversation
-from models.document import DocumentChunkWithEmbedding, SingleDocumentWithChunks
+from models.document import DocumentFilter
 from models.generic import Bundle
 
 class NaiveVectorStore(VectorStore):
+    INDEX_NAME = "vectors"
+    LEGACY_INDEX_NAME = "vectors.json"
+
     def __init__(self,
                  session_id: int,
                  transient: bool,
                  restore_index_from: Optional[str] = None,
-                 restore_map_from: Optional[str] = None
+                 restore_map_from: Optional[str] = None,
+                 restore_meta_from: Optional[str] = None,
+                 compact_threshold: float = 0.3,
+                 quantization: Optional[str] = None,
+                 rerank_factor: int = 4,
+                 spill_dir: Optional[str] = None,
+                 projection_dim: Optional[int] = None,
+                 projection_kind: str = "pca",
+                 projection_train_size: int = DEFAULT_TRAIN_SIZE
                  ):
         self.session_id: int = session_id
         self.transient: bool = transient
         self.restore_index_from: Optional[str] = restore_index_from
         self.restore_map_from: Optional[str] = restore_map_from
-        self.raw_storage: Optional[Dict[int, List[float]]] = None
+        self.restore_meta_from: Optional[str] = restore_meta_from
+        self.compact_threshold: float = compact_threshold
+        self.quantization: Optional[str] = quantization
+        self.rerank_factor: int = rerank_factor
+        self.spill_dir: Optional[str] = spill_dir
+        self.projection_dim: Optional[int] = projection_dim
+        self.projection_kind: str = projection_kind
+        self.projection_train_size: int = projection_train_size
+        self.buffer: Optional[VectorBuffer] = None
         self.doc_map: Optional[Dict[str, List[str]]] = None
-        self.chunk_map: Optional[Dict[str, str]] = None
-        self.storage: Optional[np.ndarray] = None
-        self.stored_ids: Optional[List[int]] = None
-        self.has_queried_since_update: bool = False
+        self.metadata: Optional[MetadataColumns] = None
+        # serializes writers; readers search the buffer's published snapshot without it
+        self._write_lock = threading.Lock()
         self._setup_index()
         self._setup_doc_map()
+        self._setup_metadata()
 
     def _setup_doc_map(self):
         if self.restore_map_from is not None and os.path.isfile(self.restore_map_from):
@@ -34,120 +58,247 @@ class NaiveVectorStore(VectorStore):
                 self.doc_map = json.load(f)
         else:
             self.doc_map = {}
-        self.chunk_map = self.reverse_doc_map()
 
     def _setup_index(self):
-        self.raw_storage: Dict[int, List[float]] = {}
-        self.storage = None
-        self.stored_ids = None
-        if self.restore_index_from is not None and os.path.isfile(self.restore_index_from):
-            import json
-            with open(self.restore_index_from, 'r') as f:
-                self.raw_storage: Dict[int, List[float]] = json.load(f, 
-                                                                     object_hook=lambda d: {int(k): v for k, v in d.items()})
-        
+        """
+        Sets up the vector buffer. If a previously saved binary index exists at `restore_index_from` (a path
+        without extension, see `alexandria.vectorstore.persistence`), its matrix is memory-mapped and adopted
+        as is, so nothing is parsed or copied at startup.
+
+        With `quantization` set, only float16 or int8 codes of the vectors are kept in memory and the float32 rows
+        stay on disk for re-ranking (see `QuantizedVectorBuffer`). Codes saved with the index are reused when
+        they were made with the same quantization.
+
+        With `projection_dim` set, vectors are stored projected onto that many dimensions (see `Projection`). The
+        projection saved with the index is loaded back; a full-dimension index is projected once at load, with a
+        projection trained on a sample of it, and a new one once `projection_train_size` vectors were added.
+        """
+        self.buffer = self._new_buffer()
+        if self.restore_index_from is None:
+            return
+        self.projection = Projection.load(projection_path(self.restore_index_from))
+        restored = read_matrix(self.restore_index_from)
+        if restored is not None:
+            matrix, ids, header = restored
+            kwargs = {}
+            if self.quantization is not None and header.get("quantization") == self.quantization:
+                kwargs.update(scale=header.get("scale"), codes=read_array(self.restore_index_from, "codes", header))
+            if self._projection_pending() and matrix.shape[0] >= self.projection_train_size \
+                    and self.projection_dim < matrix.shape[1]:
+                sample = np.random.default_rng(0).choice(matrix.shape[0], self.projection_train_size, replace=False)
+                self.projection = Projection.train(matrix[np.sort(sample)], self.projection_dim, self.projection_kind)
+            if self.projection is not None and matrix.shape[1] == self.projection.d:
+                print(f"projecting {matrix.shape[0]} stored vector(s) onto {self.projection.dim} dimension(s)")
+                matrix, kwargs = VectorBuffer.normalize(self.projection.apply(matrix)), {}
+            self.buffer = self._new_buffer(matrix, ids, **kwargs)
+
+    def _new_buffer(self,
+                    matrix: Optional[np.ndarray] = None,
+                    ids: Optional[List[int]] = None,
+                    **kwargs) -> VectorBuffer:
+        buffer_cls = VectorBuffer
+        kwargs.update(compact_threshold=self.compact_threshold)
+        if self.quantization is not None:
+            buffer_cls = QuantizedVectorBuffer
+            kwargs.update(quantization=self.quantization, rerank_factor=self.rerank_factor, spill_dir=self.spill_dir)
+        if matrix is None:
+            return buffer_cls(**kwargs)
+        return buffer_cls.from_arrays(matrix, ids, **kwargs)
+
+    def _projection_pending(self) -> bool:
+        return self.projection_dim is not None and self.projection is None
+
+    def _maybe_train_projection(self, vectors: np.ndarray):
+        """
+        Once the vectors stored so far and the given ones reach `projection_train_size`, trains the projection on
+        them and swaps in a buffer holding the stored vectors projected. The projection is set before the buffer,
+        so a search seeing the new buffer projects its queries. Called by writers, outside of a write group.
+        """
+        if not self._projection_pending() or len(self.buffer) + vectors.shape[0] < self.projection_train_size:
+            return
+        if self.projection_dim >= vectors.shape[1]:
+            print(f"projection to {self.projection_dim} dimension(s) would not reduce {vectors.shape[1]}, skipped")
+            self.projection_dim = None
+            return
+        matrix, ids = self.buffer.live()
+        sample = VectorBuffer.normalize(vectors)
+        if ids:
+            sample = np.concatenate([matrix, sample])
+        projection = Projection.train(sample, self.projection_dim, self.projection_kind)
+        buffer = self._new_buffer(VectorBuffer.normalize(projection.apply(matrix)), ids) if ids else self._new_buffer()
+        self.projection = projection
+        self.buffer = buffer
+
+    @staticmethod
+    def migrate_json(json_path: str, index_base: str) -> bool:
+        """
+        Converts a legacy `vectors.json` index into the binary format once and renames the JSON file to
+        `vectors.json.migrated` so it is not picked up again.
+
+        Returns:
+        - True if a legacy index was migrated.
+        """
+        if not os.path.isfile(json_path) or has_matrix(index_base):
+            return False
+        import json
+        with open(json_path, 'r') as f:
+            raw_storage: Dict[int, List[float]] = json.load(f, 
+                                                            object_hook=lambda d: {int(k): v for k, v in d.items()})
+        ids = np.fromiter(raw_storage.keys(), dtype=np.int64, count=len(raw_storage))
+        matrix = np.asarray(list(raw_storage.values()), dtype=np.float32).reshape(len(raw_storage), -1)
+        write_matrix(index_base, VectorBuffer.normalize(matrix), ids, normalized=True)
+        os.replace(json_path, json_path + ".migrated")
+        print(f"JSON index {json_path} migrated to a binary index at {index_base}")
+        return True
 
     def _remove_existed(self, ids: Optional[List[int]]) -> int:
-        if self.raw_storage is None:
-            raise ValueError("raw storage (dict-like) not initialized")
+        if self.buffer is None:
+            raise ValueError("vector buffer not initialized")
         if not ids:
             return 0
-        cnt = 0
-        for id in ids:
-            _ = self.raw_storage.pop(id, None)
-            if _:
-                cnt += 1
-        if cnt != 0:
-            self.has_queried_since_update = False
-        return cnt
+        self.metadata.remove(ids)
+        return self.buffer.remove(ids)
     
     def _add(self, vectors: List[List[float]], ids: List[int]):
-        if self.raw_storage is None:
-            raise ValueError("raw storage (dict-like) not initialized")
+        if self.buffer is None:
+            raise ValueError("vector buffer not initialized")
         assert len(vectors) == len(ids), "vectors and ids to be inserted not aligned"
-        for id, vector in zip(ids, vectors):
-            self.raw_storage.update({id: vector})
-        self.has_queried_since_update = False
+        if len(ids) == 0:
+            return
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        self._maybe_train_projection(vectors)
+        self.buffer.add(self._projected(vectors, None if self.projection is None else self.projection.dim), ids)
 
-    def __cosine_similarity(self, q: np.ndarray, v: np.ndarray) -> float:
-        return 1 - cosine(q, v)
-    
-    def _find_topk(self, query: np.ndarray, k: int):
-        candidates = self.storage
-        ids = self.stored_ids
-        if candidates is None:
-            raise ValueError("storage (ndarray-like) not initialized")
-        similarities = np.apply_along_axis(lambda v: self.__cosine_similarity(query, v),
-                                           axis=1,
-                                           arr=candidates)
-        indices = np.argpartition(-similarities, min(similarities.shape[0] - 1, k))[:k]
-        _subset = sorted([(i, similarities[i]) for i in indices], key=lambda x: x[1], reverse=True)
-        return [ids[x[0]] for x in _subset]
+    def _find_topk(self,
+                   queries: np.ndarray,
+                   k: Optional[int],
+                   threshold: Optional[float] = None,
+                   allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        buffer = self.buffer
+        if buffer is None:
+            raise ValueError("vector buffer not initialized")
+        return buffer.search(self._projected(queries, buffer.d), k, threshold, allowed_ids)
+
+    def quantization_report(self, queries: np.ndarray, k: int = 3) -> Dict[str, float]:
+        """
+        Reports the memory the quantized codes save and the recall@k of the quantized search against an exact
+        float32 search over the same rows, for a sample of query vectors.
+        """
+        if not isinstance(self.buffer, QuantizedVectorBuffer):
+            raise ValueError("vector store is not quantized")
+        report = self.buffer.memory_report()
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        report[f"recall@{k}"] = self.buffer.recall_at_k(self._projected(queries, self.buffer.d), k)
+        print(f"{self.quantization} codes save {report['saved_bytes']} bytes "
+              f"({report['ratio']:.1f}x), recall@{k} {report[f'recall@{k}']:.3f}")
+        return report
+
+    def projection_report(self) -> Dict[str, float]:
+        """
+        Reports the dimensions the vectors are stored with and the recall@k against full-dimension search the
+        projection kept on the library sample it was trained on, for its dimension and other candidates.
+        """
+        if self.projection is None:
+            raise ValueError("vector store is not projected")
+        report = self.projection.report()
+        print(f"vectors stored with {report['dim']} of {report['d']} dimension(s) ({report['reduction']:.1f}x), "
+              + ", ".join(f"{key} {value:.3f}" for key, value in report.items() if key.startswith("recall")))
+        return report
+
+    def _writing(self):
+        """
+        Returns a context in which the removals and insertions of one upsert are published as a single version.
+        """
+        if self.buffer is None:
+            raise ValueError("vector buffer not initialized")
+        return self.buffer.writing()
 
     async def _upsert(self, bundle: Bundle):
+        """
+        Applies the upsert on a worker thread, so queries keep being served by the event loop while it runs.
+        """
+        await asyncio.to_thread(self._locked, self._apply_upsert, bundle)
+
+    def _locked(self, write, *args):
+        with self._write_lock:
+            return write(*args)
+
+    def _apply_upsert(self, bundle: Bundle):
         session_id = int(bundle.theme)
         if self.transient:
             assert session_id == self.session_id
-        contents = bundle.contents
-        versioned_sub_ids: List[int] = []
-        updated_sub_ids: List[int] = []
-        updated_embeddings: List[List[float]] = []
-        for elem in contents:
-            if isinstance(elem, SingleDocumentWithChunks):
-                doc_id = elem.doc_id
-                subs = elem.chunks
-                versioned_sub_ids.extend(self.doc_map.get(doc_id, []))
-                self.doc_map.update({doc_id: []})
-            elif isinstance(elem, SingleConversation):
-                subs = [elem]
-            else:
-                raise ValueError
-            for sub in subs:
-                if isinstance(sub, DocumentChunkWithEmbedding):
-                    self.doc_map.get(doc_id).append(sub.chunk_id)
-                    updated_sub_ids.append(sub.chunk_id)
-                    updated_embeddings.append(sub.embedding)
-                elif isinstance(sub, SingleConversation):
-                    updated_sub_ids.append(hash(sub))
-                    assert isinstance(bundle, MultipleConversation)
-                    updated_embeddings.append(bundle.embedding.embeddings.get(sub))
-        existed_cnt = self._remove_existed(versioned_sub_ids)
-        print(f"removed found {existed_cnt} existed id(s)")
-        self._add(updated_embeddings, updated_sub_ids)
-
-    async def _query(self, vectors: List[List[float]], k: int = 3):
-        if not self.raw_storage:
-            # raise ValueError("raw storage (dict-like) not initialized")
-            return []
-        if self.has_queried_since_update is False:
-            self.storage = np.array(list(self.raw_storage.values()), dtype=np.float32)
-            self.stored_ids = list(self.raw_storage.keys())
-            self.has_queried_since_update = True
-        candidates: List[List[int]] = []
-        queries = np.array(vectors, dtype=np.float32)
-        for query in queries:
-            candidates.append(self._find_topk(query, k))
-        return candidates
+        versioned_sub_ids, updated_sub_ids, updated_embeddings, updated_meta = self._collect_upsert(bundle)
+        if updated_embeddings:
+            # may swap the buffer, so before the write group opened on it
+            self._maybe_train_projection(np.asarray(updated_embeddings, dtype=np.float32))
+        with self._writing():
+            existed_cnt = self._remove_existed(versioned_sub_ids)
+            print(f"removed found {existed_cnt} existed id(s)")
+            self._add(updated_embeddings, updated_sub_ids)
+            if updated_meta:
+                self.metadata.upsert(*map(list, zip(*updated_meta)))
+
+    async def _query_with_scores(self,
+                                 vectors: List[List[float]],
+                                 k: Optional[int] = 3,
+                                 threshold: Optional[float] = None,
+                                 filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        return self._search_scores(vectors, k, threshold, filter)
+
+    def _search_scores(self,
+                       vectors: List[List[float]],
+                       k: Optional[int] = 3,
+                       threshold: Optional[float] = None,
+                       filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.buffer is None or len(self.buffer) == 0:
+            return [[] for _ in range(queries.shape[0])]
+        allowed_ids = None if filter is None else self.metadata.select(filter)
+        return self._find_topk(queries, k, threshold, allowed_ids)
     
     async def serializing(self, save_root: str, is_doc: bool):
+        await asyncio.to_thread(self._locked, self._serialize, save_root, is_doc)
+
+    def _serialize(self, save_root: str, is_doc: bool):
         os.makedirs(save_root, exist_ok=True)
-        index_save_to = os.path.join(save_root, "vectors.json")
-        import json
-        if self.raw_storage:
+        if self.id_registry is not None:
+            # dense ids must be durable before an index refers to them
+            self.id_registry.flush()
+        self._save_index(save_root)
+        if is_doc:
+            self._save_doc_map(save_root)
+
+    def _save_index(self, save_root: str):
+        index_save_to = os.path.join(save_root, self.INDEX_NAME)
+        if self.buffer is not None and len(self.buffer) > 0:
             try:
-                with open(index_save_to, 'w') as f:
-                    json.dump(self.raw_storage, f)
-                print(f"JSON index written to {index_save_to}")
+                if self.projection is not None:
+                    # before the vectors, which are only readable with it
+                    self.projection.save(projection_path(index_save_to))
+                if isinstance(self.buffer, QuantizedVectorBuffer):
+                    matrix, ids, codes = self.buffer.live_with_codes()
+                    header = write_matrix(index_save_to, matrix, np.asarray(ids, dtype=np.int64), arrays={"codes": codes},
+                                          normalized=True, quantization=self.quantization,
+                                          scale=self.buffer.quantizer.scale)
+                else:
+                    matrix, ids = self.buffer.live()
+                    header = write_matrix(index_save_to, matrix, np.asarray(ids, dtype=np.int64), normalized=True)
+                print(f"binary index written to {index_save_to} (generation {header['generation']})")
             except Exception as e:
-                print(f"JSON index saving to {index_save_to} failed")
+                print(f"binary index saving to {index_save_to} failed")
                 raise e
         else:
-            raise ValueError("JSON index has not been initialized")
-        if is_doc:
-            if self.doc_map:
-                map_save_to = os.path.join(save_root, "mappings.json")
-                with open(map_save_to, 'w') as f:
-                    json.dump(self.doc_map, f)
-                print(f"document ID mapping written to {map_save_to}")
-            else:
-                print(f"document mapping has not been initialized")
\ No newline at end of file
+            raise ValueError("vector index has not been initialized")
+
+    def _save_doc_map(self, save_root: str):
+        import json
+        if self.doc_map:
+            map_save_to = os.path.join(save_root, "mappings.json")
+            with open(map_save_to, 'w') as f:
+                json.dump(self.doc_map, f)
+            print(f"document ID mapping written to {map_save_to}")
+            meta_save_to = os.path.join(save_root, "metadata.npz")
+            self.metadata.save(meta_save_to)
+            print(f"chunk metadata written to {meta_save_to}")
+        else:
+            print(f"document mapping has not been initialized")
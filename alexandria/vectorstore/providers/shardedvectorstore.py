@@ -0,0 +1,177 @@
+import contextlib
+import heapq
+import os
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.persistence import has_matrix, read_matrix, write_json, write_matrix
+from alexandria.vectorstore.providers.naivevectorstore import NaiveVectorStore
+from alexandria.vectorstore.shard import ShardPool, shard_of
+from models.document import DocumentFilter
+
+
+class ShardedVectorStore(NaiveVectorStore):
+    INDEX_NAME = "shards"
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(self,
+                 session_id: int,
+                 transient: bool,
+                 n_shards: Optional[int] = None,
+                 restore_index_from: Optional[str] = None,
+                 restore_map_from: Optional[str] = None,
+                 restore_meta_from: Optional[str] = None,
+                 compact_threshold: float = 0.3
+                 ):
+        """
+        Initializes a vector store whose vectors are partitioned by id hash across worker processes, each holding
+        one shard as a memory-mapped `VectorBuffer`. Upserts and removals are routed to the shard owning each id,
+        queries are scattered to every shard at once and the per-shard top-k lists merged. The doc map and the
+        metadata columns stay in this process, so filters are evaluated once and only the allowed ids are sent.
+
+        Args:
+        - session_id: An integer representing the session this store belongs to.
+        - transient: A boolean indicating whether the store belongs to a transient session.
+        - n_shards: An optional integer representing the number of worker processes, the number of cores if None.
+            A library restored from disk keeps the number of shards it was saved with.
+        - restore_index_from: An optional string representing the directory of previously saved shards.
+        - restore_map_from: An optional string representing the path to a previously saved doc map.
+        - restore_meta_from: An optional string representing the path to previously saved chunk metadata.
+        - compact_threshold: A float representing the fraction of dead rows that triggers compaction in a shard.
+        """
+        self.n_shards: int = n_shards or os.cpu_count() or 1
+        self.pool: Optional[ShardPool] = None
+        super().__init__(session_id=session_id,
+                         transient=transient,
+                         restore_index_from=restore_index_from,
+                         restore_map_from=restore_map_from,
+                         restore_meta_from=restore_meta_from,
+                         compact_threshold=compact_threshold)
+
+    @staticmethod
+    def _shard_base(root: str, shard: int) -> str:
+        return os.path.join(root, f"shard-{shard}")
+
+    def _setup_index(self):
+        restore_from = None
+        if self.restore_index_from is not None:
+            manifest_path = os.path.join(self.restore_index_from, self.MANIFEST_NAME)
+            if os.path.isfile(manifest_path):
+                import json
+                with open(manifest_path, 'r') as f:
+                    saved_shards = json.load(f)["n_shards"]
+                if saved_shards != self.n_shards:
+                    print(f"library was saved with {saved_shards} shard(s), using {saved_shards} "
+                          f"instead of {self.n_shards}")
+                    self.n_shards = saved_shards
+                restore_from = [self._shard_base(self.restore_index_from, shard) for shard in range(self.n_shards)]
+        self.pool = ShardPool(self.n_shards, restore_from=restore_from, compact_threshold=self.compact_threshold)
+        weakref.finalize(self, self.pool.close)
+        print(f"{self.n_shards} shard worker(s) started")
+
+    @classmethod
+    def migrate_naive(cls, index_base: str, shards_root: str, n_shards: int) -> bool:
+        """
+        Splits a binary index saved by `NaiveVectorStore` at index_base into n_shards shards under shards_root, once.
+
+        Returns:
+        - True if an index was split.
+        """
+        if not has_matrix(index_base) or os.path.isfile(os.path.join(shards_root, cls.MANIFEST_NAME)):
+            return False
+        matrix, ids, _ = read_matrix(index_base)
+        owners = shard_of(ids, n_shards)
+        for shard in range(n_shards):
+            rows = np.flatnonzero(owners == shard)
+            write_matrix(cls._shard_base(shards_root, shard), matrix[rows], ids[rows], normalized=True)
+        write_json(os.path.join(shards_root, cls.MANIFEST_NAME), {"n_shards": n_shards})
+        print(f"binary index {index_base} split into {n_shards} shard(s) under {shards_root}")
+        return True
+
+    def _route(self, ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        Groups positions of the given ids by the shard owning them.
+        """
+        owners = shard_of(ids, self.n_shards)
+        return {int(shard): np.flatnonzero(owners == shard) for shard in np.unique(owners)}
+
+    def _writing(self):
+        # every shard publishes its own versions, its pipe serializes its reads and writes
+        return contextlib.nullcontext()
+
+    def _remove_existed(self, ids: Optional[List[int]]) -> int:
+        if self.pool is None:
+            raise ValueError("shard workers not started")
+        if not ids:
+            return 0
+        self.metadata.remove(ids)
+        ids = np.asarray(ids, dtype=np.int64)
+        requests = {shard: ("remove", (ids[pos].tolist(),)) for shard, pos in self._route(ids).items()}
+        return sum(self.pool.scatter(requests).values())
+
+    def _add(self, vectors: List[List[float]], ids: List[int]):
+        if self.pool is None:
+            raise ValueError("shard workers not started")
+        assert len(vectors) == len(ids), "vectors and ids to be inserted not aligned"
+        if not ids:
+            return
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        ids = np.asarray(ids, dtype=np.int64)
+        requests = {shard: ("add", (vectors[pos], ids[pos].tolist())) for shard, pos in self._route(ids).items()}
+        self.pool.scatter(requests)
+
+    def _find_topk(self,
+                   queries: np.ndarray,
+                   k: Optional[int],
+                   threshold: Optional[float] = None,
+                   allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Scatters the queries to the shards (only to those owning allowed ids when filtered), then merges the
+        per-shard lists, each already sorted by descending score, into the global top-k.
+        """
+        if self.pool is None:
+            raise ValueError("shard workers not started")
+        if allowed_ids is None:
+            requests = {shard: ("search", (queries, k, threshold, None)) for shard in range(self.n_shards)}
+        else:
+            requests = {shard: ("search", (queries, k, threshold, allowed_ids[pos]))
+                        for shard, pos in self._route(allowed_ids).items()}
+        if not requests:
+            return [[] for _ in range(queries.shape[0])]
+        answers = self.pool.scatter(requests).values()
+        results = []
+        for per_shard in zip(*answers):
+            merged = heapq.merge(*per_shard, key=lambda hit: hit[1], reverse=True)
+            results.append(list(merged) if k is None else [hit for _, hit in zip(range(k), merged)])
+        return results
+
+    def _search_scores(self,
+                       vectors: List[List[float]],
+                       k: Optional[int] = 3,
+                       threshold: Optional[float] = None,
+                       filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        allowed_ids = None if filter is None else self.metadata.select(filter)
+        return self._find_topk(queries, k, threshold, allowed_ids)
+
+    def quantization_report(self, queries: np.ndarray, k: int = 3) -> Dict[str, float]:
+        raise ValueError("vector store is not quantized")
+
+    def _save_index(self, save_root: str):
+        shards_root = os.path.join(save_root, self.INDEX_NAME)
+        os.makedirs(shards_root, exist_ok=True)
+        # every worker writes its own shard, in parallel
+        self.pool.scatter({shard: ("save", (self._shard_base(shards_root, shard),))
+                           for shard in range(self.n_shards)})
+        write_json(os.path.join(shards_root, self.MANIFEST_NAME), {"n_shards": self.n_shards})
+        print(f"{self.n_shards} shard(s) written to {shards_root}")
+
+    def close(self):
+        """
+        Stops the shard workers; the store cannot be used afterwards.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
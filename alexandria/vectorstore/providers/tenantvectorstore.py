@@ -0,0 +1,95 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.metadata import MetadataColumns
+from alexandria.vectorstore.providers.naivevectorstore import NaiveVectorStore
+from alexandria.vectorstore.tenancy import MultiTenantIndex, shared_tenant_index
+from models.document import DocumentFilter
+
+
+class TenantVectorStore(NaiveVectorStore):
+
+    def __init__(self,
+                 session_id: int,
+                 transient: bool,
+                 index: Optional[MultiTenantIndex] = None,
+                 tenant_root: Optional[str] = None,
+                 restore_map_from: Optional[str] = None,
+                 restore_meta_from: Optional[str] = None
+                 ):
+        """
+        Initializes the vector store of one transient session as a view over a `MultiTenantIndex` shared by every
+        session of the process, instead of a buffer of its own. The session id is its tenant: upserts tag the rows
+        with it, searches only score its rows, and `drop` releases all of them at once when the session ends.
+        The doc map and the metadata columns stay per session, next to its document store.
+
+        Args:
+        - session_id: An integer representing the session this store belongs to, used as its tenant.
+        - transient: A boolean indicating whether the store belongs to a transient session.
+        - index: An optional `MultiTenantIndex`, the process-wide one saved under tenant_root if None.
+        - tenant_root: An optional string representing the directory the shared index is saved to, kept in memory
+            only if None.
+        - restore_map_from: An optional string representing the path to a previously saved doc map.
+        - restore_meta_from: An optional string representing the path to previously saved chunk metadata.
+        """
+        self.index: MultiTenantIndex = index if index is not None else shared_tenant_index(tenant_root)
+        super().__init__(session_id=session_id,
+                         transient=transient,
+                         restore_map_from=restore_map_from,
+                         restore_meta_from=restore_meta_from)
+
+    def _setup_index(self):
+        # the vectors live in the shared index
+        pass
+
+    def _writing(self):
+        return self.index.writing()
+
+    def _remove_existed(self, ids: Optional[List[int]]) -> int:
+        if not ids:
+            return 0
+        self.metadata.remove(ids)
+        return self.index.remove(self.session_id, ids)
+
+    def _add(self, vectors: List[List[float]], ids: List[int]):
+        assert len(vectors) == len(ids), "vectors and ids to be inserted not aligned"
+        self.index.add(self.session_id, vectors, ids)
+
+    def _find_topk(self,
+                   queries: np.ndarray,
+                   k: Optional[int],
+                   threshold: Optional[float] = None,
+                   allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        return self.index.search(self.session_id, queries, k, threshold, allowed_ids)
+
+    def _search_scores(self,
+                       vectors: List[List[float]],
+                       k: Optional[int] = 3,
+                       threshold: Optional[float] = None,
+                       filter: Optional[DocumentFilter] = None) -> List[List[Tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        allowed_ids = None if filter is None else self.metadata.select(filter)
+        return self._find_topk(queries, k, threshold, allowed_ids)
+
+    def quantization_report(self, queries: np.ndarray, k: int = 3) -> Dict[str, float]:
+        raise ValueError("vector store is not quantized")
+
+    def _save_index(self, save_root: str):
+        # only the segments changed since the last save are written, whichever session they belong to
+        written = self.index.save()
+        print(f"{written} tenant segment(s) written to {self.index.root}")
+
+    def drop(self) -> int:
+        """
+        Releases the vectors, doc map and metadata of the session; the store is empty afterwards.
+        """
+        with self._write_lock:
+            cnt = self.index.drop(self.session_id)
+            if self.dedup is not None:
+                self.dedup.discard([id for ids in self.doc_map.values() for id in ids])
+                self.dedup.save()
+            self.doc_map = {}
+            self._refs = None
+            self.metadata = MetadataColumns.from_doc_map({})
+            return cnt
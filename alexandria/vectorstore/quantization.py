@@ -0,0 +1,266 @@
+import itertools
+import os
+import tempfile
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer, select_topk
+
+# float16 bits shifted into a float32 keep sign and magnitude bits, the value scaled by 2^-112 (subnormals included)
+_HALF_MASK = np.array([0x8FFFE000], dtype=np.uint32).view(np.int32)[0]
+_HALF_SCALE = np.float32(2.0 ** 112)
+
+
+class ScalarQuantizer:
+    ALLOWED_DTYPE = {
+        "float16": np.float16,
+        "int8": np.int8,
+    }
+
+    def __init__(self, dtype: str, scale: Optional[float] = None):
+        """
+        Initializes a scalar quantizer turning L2-normalized float32 vectors into float16 or int8 codes.
+
+        Args:
+        - dtype: A string representing the code type, "float16" or "int8".
+        - scale: An optional float representing the int8 step, learned from the first vectors encoded if None.
+        """
+        if dtype not in self.ALLOWED_DTYPE:
+            raise ValueError(f"quantization {dtype} not allowed")
+        self.dtype: str = dtype
+        self.scale: Optional[float] = scale
+
+    @property
+    def code_dtype(self):
+        return self.ALLOWED_DTYPE[self.dtype]
+
+    def train(self, vectors: np.ndarray):
+        if self.dtype == "int8" and self.scale is None and vectors.size:
+            # components of normalized vectors concentrate far below 1, clip the rare outliers instead
+            self.scale = float(np.quantile(np.abs(vectors), 0.999)) / 127 or 1 / 127
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == "float16":
+            return vectors.astype(np.float16)
+        self.train(vectors)
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def score(self, queries: np.ndarray, codes: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """
+        Returns the dot products of float32 queries with a block of codes, widening the block into `out` (a reused
+        float32 buffer of at least as many rows) instead of decoding it into a new array. Scales go onto the
+        queries or the scores rather than the block: the int8 step, and for float16 the 2^-112 left by moving the
+        half-precision bits into place with integer shifts, much faster than numpy's float16 conversion.
+        """
+        widened = out[:codes.shape[0]]
+        if self.dtype == "float16":
+            bits = widened.view(np.int32)
+            np.copyto(bits, codes.view(np.int16), casting="unsafe")
+            bits <<= 13
+            bits &= _HALF_MASK
+            return (queries * _HALF_SCALE) @ widened.T
+        np.copyto(widened, codes, casting="unsafe")
+        scores = queries @ widened.T
+        scores *= np.float32(self.scale)
+        return scores
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        if self.dtype == "float16":
+            return codes.astype(np.float32)
+        return codes.astype(np.float32) * np.float32(self.scale)
+
+    def error_bound(self, dim: int) -> float:
+        """
+        Returns a bound of the error quantization adds to the dot product of two unit vectors, ignoring the few
+        int8 components clipped at the training quantile.
+        """
+        step = self.scale if self.dtype == "int8" else 2.0 ** -11
+        return 0.5 * step * np.sqrt(dim)
+
+
+class QuantizedVectorBuffer(VectorBuffer):
+    ROW_ARRAYS = ("matrix", "alive", "codes")
+
+    def __init__(self,
+                 quantization: str,
+                 scale: Optional[float] = None,
+                 rerank_factor: int = 4,
+                 block_size: int = 2048,
+                 spill_dir: Optional[str] = None,
+                 codes: Optional[np.ndarray] = None,
+                 **kwargs):
+        """
+        Initializes a vector buffer that keeps only float16 or int8 codes in memory. The exact float32 rows live
+        in memory-mapped files under `spill_dir` (a temporary directory by default) and are only read to re-rank
+        the small candidate pool the code scan returns.
+
+        Args:
+        - quantization: A string representing the code type, "float16" or "int8".
+        - scale: An optional float representing a previously learned int8 step.
+        - rerank_factor: An integer representing how many candidates per requested hit are re-ranked exactly.
+        - block_size: An integer representing how many rows of codes are scored at a time while scanning, small
+            enough for the float32 copy of a block to stay in cache.
+        - spill_dir: An optional string representing the directory holding the float32 rows.
+        - codes: An optional numpy array of codes previously saved for the matrix adopted by `from_arrays`.
+        """
+        self.quantizer = ScalarQuantizer(quantization, scale)
+        self.rerank_factor: int = rerank_factor
+        self.block_size: int = block_size
+        self._spill_tmp = None
+        if spill_dir is None:
+            self._spill_tmp = tempfile.TemporaryDirectory(prefix="alexandria-")
+            spill_dir = self._spill_tmp.name
+        self.spill_dir: str = spill_dir
+        self._spill_seq = itertools.count()
+        self.codes: Optional[np.ndarray] = None
+        self._restored_codes: Optional[np.ndarray] = codes
+        super().__init__(**kwargs)
+
+    def _new_rows(self, name: str, capacity: int) -> np.ndarray:
+        if name == "codes":
+            return np.empty((capacity, self.d), dtype=self.quantizer.code_dtype)
+        if name == "matrix":
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = os.path.join(self.spill_dir, f"exact-{os.getpid()}-{next(self._spill_seq)}.f32")
+            matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(capacity, self.d))
+            # the mapping keeps the pages reachable, the name is not needed anymore
+            os.remove(path)
+            return matrix
+        return super()._new_rows(name, capacity)
+
+    def _write_rows(self, start: int, vectors: np.ndarray):
+        super()._write_rows(start, vectors)
+        self.codes[start:start + vectors.shape[0]] = self.quantizer.encode(vectors)
+
+    def _adopt(self, matrix: np.ndarray):
+        codes, self._restored_codes = self._restored_codes, None
+        if codes is not None and codes.shape == matrix.shape and codes.dtype == self.quantizer.code_dtype:
+            self.codes = np.array(codes)
+            return
+        self.codes = np.empty(matrix.shape, dtype=self.quantizer.code_dtype)
+        for start in range(0, matrix.shape[0], self.block_size):
+            self.codes[start:start + self.block_size] = self.quantizer.encode(matrix[start:start + self.block_size])
+
+    def live_with_codes(self) -> Tuple[np.ndarray, List[Hashable], np.ndarray]:
+        """
+        Like `live`, but also returns the codes of the live rows, taken from the same snapshot.
+        """
+        snapshot = self.snapshot()
+        matrix, alive, ids = self.view(snapshot)
+        codes = snapshot[2].get("codes")
+        if codes is None:
+            return matrix, [], np.empty((0, self.d or 0), dtype=self.quantizer.code_dtype)
+        rows = np.flatnonzero(alive)
+        return matrix[rows], [ids[row] for row in rows.tolist()], codes[rows]
+
+    def _coarse(self,
+                queries: np.ndarray,
+                codes: np.ndarray,
+                rows: np.ndarray,
+                pool: Optional[int],
+                floor: Optional[float]) -> List[np.ndarray]:
+        """
+        Scans the codes block by block and returns, per query, the rows worth re-ranking: the `pool` best ones,
+        or every row whose approximate score reaches `floor` when pool is None.
+        """
+        nq = queries.shape[0]
+        widened = np.empty((min(self.block_size, rows.shape[0]), codes.shape[1]), dtype=np.float32)
+        best_rows = np.empty((nq, 0), dtype=np.int64)
+        best_scores = np.empty((nq, 0), dtype=np.float32)
+        hits: List[Tuple[np.ndarray, np.ndarray]] = []
+        for start in range(0, rows.shape[0], self.block_size):
+            block = rows[start:start + self.block_size]
+            # live rows mostly come in runs, a contiguous block is scored in place
+            contiguous = block[-1] - block[0] + 1 == block.shape[0]
+            scores = self.quantizer.score(queries, codes[block[0]:block[-1] + 1] if contiguous else codes[block],
+                                          widened)
+            if pool is None:
+                queried, columns = np.nonzero(scores >= floor)
+                hits.append((queried, block[columns]))
+                continue
+            # one top-k over the running pools and the block, for every query at once
+            merged_rows = np.concatenate([best_rows, np.broadcast_to(block, (nq, block.shape[0]))], axis=1)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            if merged_rows.shape[1] > pool:
+                top = np.argpartition(-merged_scores, pool - 1, axis=1)[:, :pool]
+                merged_rows = np.take_along_axis(merged_rows, top, axis=1)
+                merged_scores = np.take_along_axis(merged_scores, top, axis=1)
+            best_rows, best_scores = merged_rows, merged_scores
+        if pool is not None:
+            return list(best_rows)
+        queried = np.concatenate([q for q, _ in hits]) if hits else np.empty(0, dtype=np.int64)
+        found = np.concatenate([r for _, r in hits]) if hits else np.empty(0, dtype=np.int64)
+        order = np.argsort(queried, kind="stable")
+        return np.split(found[order], np.searchsorted(queried[order], np.arange(1, nq)))
+
+    def search(self,
+               queries: np.ndarray,
+               k: Optional[int],
+               threshold: Optional[float] = None,
+               allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[Hashable, float]]]:
+        """
+        Scans the in-memory codes for `k * rerank_factor` candidates per query, then re-ranks them against the
+        exact float32 rows. With k None, every row whose approximate score may reach `threshold` is re-ranked.
+        """
+        queries = self.normalize(queries)
+        snapshot = self.snapshot()
+        codes = snapshot[2].get("codes")
+        if allowed_ids is None:
+            exact, alive, ids = self.view(snapshot)
+            rows = np.flatnonzero(alive)
+        else:
+            exact, rows, ids = self.view_rows(allowed_ids.tolist(), snapshot)
+        if codes is None or rows.shape[0] == 0:
+            return [[] for _ in range(queries.shape[0])]
+        if k is None:
+            if threshold is None:
+                raise ValueError("range search needs a threshold")
+            candidates = self._coarse(queries, codes, rows, None, threshold - self.quantizer.error_bound(self.d))
+        else:
+            pool = min(rows.shape[0], max(k, k * self.rerank_factor))
+            candidates = self._coarse(queries, codes, rows, pool, None)
+        results = []
+        for query, cand in zip(queries, candidates):
+            cand = np.sort(cand)
+            scores = exact[cand] @ query
+            if threshold is not None:
+                keep = scores >= threshold
+                cand, scores = cand[keep], scores[keep]
+            if cand.shape[0] == 0:
+                results.append([])
+                continue
+            top, top_scores = select_topk(scores[None, :], cand.shape[0] if k is None else min(k, cand.shape[0]))
+            results.append([(ids[row], score) for row, score in zip(cand[top[0]].tolist(), top_scores[0].tolist())])
+        return results
+
+    def memory_report(self) -> Dict[str, float]:
+        """
+        Reports the resident bytes of the codes against what the same rows take as float32.
+        """
+        n, _, arrays, _, _, _ = self.snapshot()
+        codes = arrays.get("codes")
+        codes_bytes = 0 if codes is None else int(codes[:n].nbytes)
+        float32_bytes = n * (self.d or 0) * 4
+        return {"rows": n,
+                "codes_bytes": codes_bytes,
+                "float32_bytes": float32_bytes,
+                "saved_bytes": float32_bytes - codes_bytes,
+                "ratio": float32_bytes / codes_bytes if codes_bytes else 0.0}
+
+    def recall_at_k(self, queries: np.ndarray, k: int) -> float:
+        """
+        Returns the fraction of the exact float32 top-k that the quantized search also returns.
+        """
+        queries = self.normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        exact, alive, ids = self.view(self.snapshot())
+        n_alive = int(alive.sum())
+        if n_alive == 0:
+            return 1.0
+        k = min(k, n_alive)
+        similarities = queries @ exact.T
+        similarities[:, ~alive] = -np.inf
+        truth, _ = select_topk(similarities, k)
+        approx = self.search(queries, k)
+        hits = sum(len({ids[row] for row in t} & {id for id, _ in a}) for t, a in zip(truth.tolist(), approx))
+        return hits / (k * queries.shape[0])
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from alexandria.vectorstore.router import get_vecstore
+from alexandria.vectorstore.vectorstore import VectorStore
+
+
+def files_version(root: str) -> Tuple[Tuple[str, int, int], ...]:
+    """
+    Returns a cheap fingerprint of the persisted files under root: name, size and modification time of each.
+    """
+    if not os.path.isdir(root):
+        return ()
+    version = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                version.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(version))
+
+
+class LibraryRegistry:
+    def __init__(self, check_interval: float = 5.0):
+        """
+        Initializes a process-wide registry of read-only library vector stores.
+
+        Stores are keyed by restore root, store type, index options and the version of the library, so every
+        session reading the same library shares a single in-memory copy. Handed out stores are reference counted;
+        a store is loaded again only once the library changes, and an outdated one is dropped when its last holder
+        releases it. Shared stores must only be queried, never upserted into.
+
+        The version is a generation bumped by `written` whenever this process writes the library, plus the
+        fingerprint of its files, which only catches the writes of other processes and is therefore taken at most
+        once per check_interval rather than on every lookup.
+
+        Args:
+        - check_interval: A float representing the seconds between two checks of the files of a library.
+        """
+        self.check_interval: float = check_interval
+        self._entries: Dict[tuple, List[Any]] = {}
+        self._lock = threading.Lock()
+        # per library root: [generation, files fingerprint, monotonic time the fingerprint was taken]
+        self._versions: Dict[str, List[Any]] = {}
+        self._versions_lock = threading.Lock()
+
+    @staticmethod
+    def _options(vecstore: str, restore_root: str, kwargs: Dict[str, Any]) -> tuple:
+        return (os.path.normpath(restore_root), vecstore, tuple(sorted(kwargs.items())))
+
+    def _version(self, root: str) -> Tuple[int, tuple]:
+        with self._versions_lock:
+            state = self._versions.get(root)
+            now = time.monotonic()
+            if state is None:
+                state = [0, files_version(root), now]
+                self._versions[root] = state
+            elif now - state[2] >= self.check_interval:
+                state[1], state[2] = files_version(root), now
+            return state[0], state[1]
+
+    def written(self, restore_root: str):
+        """
+        Records that this process has just written the library at restore_root, so that the next lookups see the
+        new version at once.
+        """
+        root = os.path.normpath(restore_root)
+        with self._versions_lock:
+            state = self._versions.get(root)
+            generation = 0 if state is None else state[0] + 1
+            self._versions[root] = [generation, files_version(root), time.monotonic()]
+
+    def acquire(self, vecstore: str, restore_root: str, **kwargs) -> Tuple[tuple, VectorStore]:
+        """
+        Returns a (key, store) pair for the current version of the library at restore_root, loading it only if no
+        session holds that version yet. The key must be handed back to `release`.
+        """
+        options = self._options(vecstore, restore_root, kwargs)
+        key = options + (self._version(options[0]),)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                store = get_vecstore(session_id=None,
+                                     transient=False,
+                                     vecstore=vecstore,
+                                     restore_root=restore_root,
+                                     **kwargs)
+                entry = [store, 0]
+                self._entries[key] = entry
+                print(f"library at {restore_root} loaded into the shared registry")
+                self._evict(options, keep=key)
+            entry[1] += 1
+            return key, entry[0]
+
+    def release(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0 and not self.is_current(key):
+                del self._entries[key]
+
+    def is_current(self, key: tuple) -> bool:
+        return key[-1] == self._version(key[0])
+
+    def _evict(self, options: tuple, keep: tuple):
+        # outdated versions nobody holds anymore
+        for key, (_, refs) in list(self._entries.items()):
+            if key != keep and key[:-1] == options and refs <= 0:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "references": sum(refs for _, refs in self._entries.values())}
+
+
+LIBRARY_REGISTRY = LibraryRegistry()
@@ -13,20 +13,80 @@ def get_vecstore(session_id: str,
             dim = kwargs.get("dim", None)
             if dim is None:
                 raise ValueError("dimension should be specified for FAISS")
-            index_key = kwargs.get("index_key", "Flat")
+            index_key = kwargs.get("index_key", None) or "Flat"
             restore_index_from = os.path.join(restore_root, "vectors.index") if restore_root else None
             restore_map_from = os.path.join(restore_root, "mappings.json") if restore_root else None
+            restore_meta_from = os.path.join(restore_root, "metadata.npz") if restore_root else None
             return FaissVectorStore(dim=dim,
                                     session_id=session_id,
                                     transient=transient,
                                     index_key=index_key,
                                     restore_index_from=restore_index_from,
-                                    restore_map_from=restore_map_from)
+                                    restore_map_from=restore_map_from,
+                                    restore_meta_from=restore_meta_from,
+                                    metric=kwargs.get("metric", None) or "L2",
+                                    nprobe=kwargs.get("nprobe", None),
+                                    ef_search=kwargs.get("ef_search", None),
+                                    projection_dim=kwargs.get("projection_dim", None),
+                                    projection_kind=kwargs.get("projection_kind", None) or "pca")
+        case "sharded" if transient:
+            # every store spawns its own shard workers, only the library is sharded, session stores stay naive
+            return get_vecstore(session_id, transient, "naive", **kwargs)
+        case "sharded":
+            from alexandria.vectorstore.providers.shardedvectorstore import ShardedVectorStore
+            n_shards = kwargs.get("n_shards", None) or os.cpu_count() or 1
+            restore_index_from = os.path.join(restore_root, ShardedVectorStore.INDEX_NAME) if restore_root else None
+            if restore_root:
+                ShardedVectorStore.migrate_naive(os.path.join(restore_root, "vectors"), restore_index_from, n_shards)
+            restore_map_from = os.path.join(restore_root, "mappings.json") if restore_root else None
+            restore_meta_from = os.path.join(restore_root, "metadata.npz") if restore_root else None
+            return ShardedVectorStore(session_id=session_id,
+                                      transient=transient,
+                                      n_shards=n_shards,
+                                      restore_index_from=restore_index_from,
+                                      restore_map_from=restore_map_from,
+                                      restore_meta_from=restore_meta_from)
+        case "disk":
+            from alexandria.vectorstore.providers.diskvectorstore import DiskVectorStore
+            restore_index_from = os.path.join(restore_root, DiskVectorStore.INDEX_NAME) if restore_root else None
+            ram_budget = kwargs.get("ram_budget", None) or 256 << 20
+            if restore_root:
+                DiskVectorStore.migrate_naive(os.path.join(restore_root, "vectors"), restore_index_from,
+                                              ram_budget=ram_budget)
+            restore_map_from = os.path.join(restore_root, "mappings.json") if restore_root else None
+            restore_meta_from = os.path.join(restore_root, "metadata.npz") if restore_root else None
+            return DiskVectorStore(session_id=session_id,
+                                   transient=transient,
+                                   restore_index_from=restore_index_from,
+                                   restore_map_from=restore_map_from,
+                                   restore_meta_from=restore_meta_from,
+                                   ram_budget=ram_budget,
+                                   nprobe=kwargs.get("disk_nprobe", None) or 16,
+                                   nlist=kwargs.get("disk_nlist", None),
+                                   build_min=kwargs.get("disk_build_min", None) or 65536)
+        case "tenant":
+            from alexandria.vectorstore.providers.tenantvectorstore import TenantVectorStore
+            restore_map_from = os.path.join(restore_root, "mappings.json") if restore_root else None
+            restore_meta_from = os.path.join(restore_root, "metadata.npz") if restore_root else None
+            return TenantVectorStore(session_id=session_id,
+                                     transient=transient,
+                                     tenant_root=kwargs.get("tenant_root", None),
+                                     restore_map_from=restore_map_from,
+                                     restore_meta_from=restore_meta_from)
         case _:
             from alexandria.vectorstore.providers.naivevectorstore import NaiveVectorStore
-            restore_index_from = os.path.join(restore_root, "vectors.json") if restore_root else None
+            restore_index_from = os.path.join(restore_root, NaiveVectorStore.INDEX_NAME) if restore_root else None
+            if restore_root:
+                NaiveVectorStore.migrate_json(os.path.join(restore_root, NaiveVectorStore.LEGACY_INDEX_NAME),
+                                              restore_index_from)
             restore_map_from = os.path.join(restore_root, "mappings.json") if restore_root else None
+            restore_meta_from = os.path.join(restore_root, "metadata.npz") if restore_root else None
             return NaiveVectorStore(session_id=session_id,
                                     transient=transient,
                                     restore_index_from=restore_index_from,
-                                    restore_map_from=restore_map_from)
+                                    restore_map_from=restore_map_from,
+                                    restore_meta_from=restore_meta_from,
+                                    quantization=kwargs.get("quantization", None),
+                                    rerank_factor=kwargs.get("rerank_factor", None) or 4,
+                                    projection_dim=kwargs.get("projection_dim", None),
+                                    projection_kind=kwargs.get("projection_kind", None) or "pca")
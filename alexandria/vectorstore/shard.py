@@ -0,0 +1,143 @@
+import multiprocessing
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer
+from alexandria.vectorstore.persistence import read_matrix, write_matrix
+
+# odd 64-bit multiplier (Fibonacci hashing), spreads dense ids as well as 48-bit hashes
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def shard_of(ids: Any, n_shards: int) -> np.ndarray:
+    """
+    Returns the shard owning each int64 id.
+    """
+    ids = np.asarray(ids, dtype=np.int64).view(np.uint64)
+    with np.errstate(over="ignore"):
+        return ((ids * _MIX) >> np.uint64(32)) % np.uint64(n_shards)
+
+
+def _serve(conn, restore_from: Optional[str], compact_threshold: float):
+    """
+    Worker loop holding one shard. Its rows are memory-mapped from `restore_from` when a shard was saved there.
+    Every request is an (op, args) tuple answered with (True, result) or (False, error message).
+    """
+    buffer = VectorBuffer(compact_threshold=compact_threshold)
+    restored = read_matrix(restore_from) if restore_from is not None else None
+    if restored is not None:
+        matrix, ids, _ = restored
+        buffer = VectorBuffer.from_arrays(matrix, ids, compact_threshold=compact_threshold)
+    while True:
+        try:
+            op, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            match op:
+                case "add":
+                    result = buffer.add(*args)
+                case "remove":
+                    result = buffer.remove(*args)
+                case "search":
+                    result = buffer.search(*args)
+                case "save":
+                    matrix, ids = buffer.live()
+                    result = write_matrix(args[0], matrix, np.asarray(ids, dtype=np.int64), normalized=True)
+                case "len":
+                    result = len(buffer)
+                case "close":
+                    conn.send((True, None))
+                    return
+                case _:
+                    raise ValueError(f"unknown shard operation {op}")
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, f"{type(e).__name__}: {e}"))
+
+
+class ShardPool:
+    def __init__(self,
+                 n_shards: int,
+                 restore_from: Optional[List[Optional[str]]] = None,
+                 compact_threshold: float = 0.3):
+        """
+        Starts one worker process per shard, each holding its own `VectorBuffer`.
+
+        Requests are written to every involved worker before any answer is read, so the shards work on a
+        scattered request in parallel. Each pipe has a lock of its own, so that requests involving different shards
+        do not wait for each other, and a shard is free again as soon as its answer has been read. Workers are started with "spawn" so that they do not inherit the
+        threads and sockets of the server process.
+
+        Args:
+        - n_shards: An integer representing the number of worker processes.
+        - restore_from: An optional list of n_shards paths (without extension) of previously saved shards.
+        - compact_threshold: A float representing the fraction of dead rows that triggers compaction in a shard.
+        """
+        if n_shards < 1:
+            raise ValueError("at least one shard is needed")
+        restore_from = restore_from or [None] * n_shards
+        assert len(restore_from) == n_shards, "restore paths not aligned with shards"
+        context = multiprocessing.get_context("spawn")
+        self.n_shards: int = n_shards
+        self.conns = []
+        self.processes = []
+        for path in restore_from:
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(child, path, compact_threshold), daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+        # a pipe carries one conversation at a time
+        self._locks = [threading.Lock() for _ in range(n_shards)]
+
+    def scatter(self, requests: Dict[int, Tuple[str, tuple]]) -> Dict[int, Any]:
+        """
+        Sends each shard its (op, args) request, then gathers the answers. Raises the first error reported.
+        """
+        shards = sorted(requests)
+        # taken in shard order, so that two scatters never wait for each other's locks
+        for shard in shards:
+            self._locks[shard].acquire()
+        answers = {}
+        try:
+            for shard in shards:
+                self.conns[shard].send(requests[shard])
+            for shard in shards:
+                answers[shard] = self.conns[shard].recv()
+                self._locks[shard].release()
+        finally:
+            for shard in shards:
+                if shard not in answers:
+                    self._locks[shard].release()
+        for shard, (ok, result) in answers.items():
+            if not ok:
+                raise ValueError(f"shard {shard} failed: {result}")
+        return {shard: result for shard, (_, result) in answers.items()}
+
+    def broadcast(self, op: str, *args) -> List[Any]:
+        answers = self.scatter({shard: (op, args) for shard in range(self.n_shards)})
+        return [answers[shard] for shard in range(self.n_shards)]
+
+    def close(self):
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            for conn, process in zip(self.conns, self.processes):
+                if process.is_alive():
+                    try:
+                        conn.send(("close", ()))
+                        conn.recv()
+                    except (EOFError, OSError):
+                        pass
+                conn.close()
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self.conns, self.processes = [], []
+        finally:
+            for lock in self._locks:
+                lock.release()
@@ -0,0 +1,515 @@
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer
+from alexandria.vectorstore.persistence import matrix_files, read_array, read_matrix, replace_file, write_json, \
+    write_matrix
+
+
+class TenantSegment(VectorBuffer):
+    ROW_ARRAYS = ("matrix", "alive", "tenant")
+
+    def __init__(self, tenant: Optional[np.ndarray] = None, **kwargs):
+        """
+        Initializes a vector buffer shared by many tenants. Every row is tagged with the code of the tenant it
+        belongs to and keyed by a (tenant code, id) pair, so two tenants may store the same id. A posting list per
+        tenant holds its rows, a search only gathers and scores those.
+
+        Dropping a tenant forgets its posting list, which is O(1): its rows become unreachable at once and are
+        reclaimed by the next compaction.
+
+        Args:
+        - tenant: An optional numpy array of the tenant codes of the matrix adopted by `from_arrays`.
+        - kwargs: The arguments of `VectorBuffer`.
+        """
+        self.tenant: Optional[np.ndarray] = None
+        self.postings: Dict[int, List[int]] = {}
+        # live rows per tenant, so that dropping one keeps the dead row count exact
+        self.counts: Dict[int, int] = {}
+        # tenants dropped since the last compaction
+        self.dropped: Set[int] = set()
+        # changed since it was last saved
+        self.dirty: bool = True
+        # bumped by every compaction, which renumbers the rows
+        self.epoch: int = 0
+        # the files holding the saved rows: a base of (name, rows) and parts of (name, first row, rows) appended
+        # after it, valid while the epoch they were written in lasts, and the tombstone bitmap of those rows
+        self.base: Optional[Tuple[str, int]] = None
+        self.parts: List[Tuple[str, int, int]] = []
+        self.alive_name: Optional[str] = None
+        self.saved_rows: int = 0
+        self.saved_epoch: int = 0
+        self._restored_tenant: Optional[np.ndarray] = tenant
+        self._pending_tenant: int = -1
+        self._postings_view: Tuple[tuple, Dict[int, List[int]]] = ((0, 0, {}, [], {}, {}), {})
+        super().__init__(**kwargs)
+
+    def _new_rows(self, name: str, capacity: int) -> np.ndarray:
+        if name == "tenant":
+            return np.full(capacity, -1, dtype=np.int64)
+        return super()._new_rows(name, capacity)
+
+    def _write_rows(self, start: int, vectors: np.ndarray):
+        super()._write_rows(start, vectors)
+        self.tenant[start:start + vectors.shape[0]] = self._pending_tenant
+
+    def _adopt(self, matrix: np.ndarray):
+        tenant, self._restored_tenant = self._restored_tenant, None
+        assert tenant is not None and tenant.shape[0] == matrix.shape[0], "tenant codes not aligned with matrix"
+        self.tenant = np.array(tenant, dtype=np.int64)
+        self._index_tenants()
+        self.dirty = False
+
+    def _index_tenants(self):
+        """
+        Rebuilds the posting lists and live counts from the tenant column.
+        """
+        n = self.size if self.size else self.tenant.shape[0]
+        rows = np.flatnonzero(self.alive[:n]) if self.alive.shape[0] else np.arange(n)
+        rows = rows[~np.isin(self.tenant[rows], list(self.dropped))]
+        order = np.argsort(self.tenant[rows], kind="stable")
+        codes, starts = np.unique(self.tenant[rows[order]], return_index=True)
+        self.postings = {code: group.tolist()
+                         for code, group in zip(codes.tolist(), np.split(rows[order], starts[1:]))}
+        self.counts = {code: len(group) for code, group in self.postings.items()}
+
+    def _publish(self):
+        super()._publish()
+        if not self._deferred:
+            self._postings_view = (self._snapshot, self.postings)
+
+    def _retained(self, alive: np.ndarray, arrays: Dict[str, np.ndarray]) -> np.ndarray:
+        if not self.dropped:
+            return alive
+        return alive & ~np.isin(arrays["tenant"][:alive.shape[0]], list(self.dropped))
+
+    def _compacted(self):
+        self.epoch += 1
+        self._index_tenants()
+        # rows of tenants dropped while compacting may have been kept, they stay dead
+        self.dead = self.size - sum(self.counts.values())
+        self.dropped = set(np.unique(self.tenant[:self.size]).tolist()) & self.dropped
+
+    def add_rows(self, code: int, vectors: np.ndarray, ids: List[Hashable]):
+        if len(ids) == 0:
+            return
+        with self.writing():
+            # the published live count lags behind inside `writing()`
+            start, live = self.size, self.size - self.dead
+            self._pending_tenant = code
+            self.add(vectors, [(code, id) for id in ids])
+            self.postings.setdefault(code, []).extend(range(start, self.size))
+            self.counts[code] = self.counts.get(code, 0) + self.size - self.dead - live
+            self.dirty = True
+
+    def remove_rows(self, code: int, ids: List[Hashable]) -> int:
+        if code not in self.postings or len(ids) == 0:
+            return 0
+        with self.writing():
+            cnt = self.remove([(code, id) for id in ids])
+            if cnt:
+                self.counts[code] -= cnt
+                self.dirty = True
+            return cnt
+
+    def drop(self, code: int) -> int:
+        """
+        Makes every row of a tenant unreachable and returns how many were live.
+        """
+        with self.writing():
+            if self.postings.pop(code, None) is None:
+                return 0
+            cnt = self.counts.pop(code, 0)
+            self.dropped.add(code)
+            self.dead += cnt
+            self.dirty = True
+        self._maybe_compact()
+        return cnt
+
+    def search_tenant(self,
+                      code: int,
+                      queries: np.ndarray,
+                      k: Optional[int],
+                      threshold: Optional[float] = None,
+                      allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[Hashable, float]]]:
+        """
+        Like `search`, restricted to the rows of one tenant. Returns (id, score) pairs, without the tenant code.
+        """
+        snapshot, postings = self._postings_view
+        if allowed_ids is not None:
+            _, rows, _ = self.view_rows([(code, id) for id in allowed_ids.tolist()], snapshot)
+        else:
+            rows = np.asarray(postings.get(code, ()), dtype=np.int64)
+            # rows appended after the snapshot, or tombstoned in it
+            n, _, arrays, _, _, _ = snapshot
+            rows = rows[rows < n]
+            rows = rows[arrays["alive"][rows]]
+        results = self.search_rows(queries, k, threshold, rows, snapshot)
+        return [[(key[1], score) for key, score in hits] for hits in results]
+
+    def rows_between(self, snapshot: tuple, start: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the rows of a snapshot from start on, dead or alive, with their ids and tenant codes.
+        """
+        n, _, arrays, keys, _, _ = snapshot
+        ids = np.fromiter((key[1] for key in keys[start:n]), dtype=np.int64, count=n - start)
+        return arrays["matrix"][start:n].reshape(n - start, self.d or 0), ids, arrays["tenant"][start:n]
+
+
+class MultiTenantIndex:
+    TENANTS_NAME = "tenants.json"
+
+    def __init__(self,
+                 root: Optional[str] = None,
+                 segment_rows: int = 1 << 18,
+                 compact_threshold: float = 0.3,
+                 idle_seconds: Optional[float] = 24 * 3600,
+                 max_parts: int = 8):
+        """
+        Initializes an index holding the vectors of many transient sessions (tenants) in a few shared segments
+        instead of one store per session, so memory, files and serialization work grow with the number of vectors
+        rather than with the number of sessions.
+
+        Each session is given a tenant code when it first stores vectors; a session ending drops its code, its
+        vectors are reclaimed by compaction. Sessions that expire or are abandoned never say so, hence saving also
+        drops the tenants left untouched for `idle_seconds`. Appends go to the newest segment, a new one is opened
+        once it holds `segment_rows` rows.
+
+        Saving costs what changed since the last save, not the size of the segments: the rows appended to a
+        segment are written to a part file of their own next to its base file, along with its tombstone bitmap
+        (one bit per row). Once a segment has `max_parts` parts, a background thread merges them into a new base.
+        Only a compaction, which renumbers the rows, makes the next save write the whole segment again.
+
+        Args:
+        - root: An optional string representing the directory the segments are saved to and loaded from, the
+            index is kept in memory only if None.
+        - segment_rows: An integer representing the number of rows past which a new segment is opened.
+        - compact_threshold: A float representing the fraction of dead rows that triggers compaction in a segment.
+        - idle_seconds: An optional float representing how long a tenant may go without being written or searched
+            before saving drops it, longer than a session lasts; tenants are only dropped explicitly if None.
+        - max_parts: An integer representing the number of part files past which a segment's parts are merged.
+        """
+        self.root: Optional[str] = root
+        self.segment_rows: int = segment_rows
+        self.compact_threshold: float = compact_threshold
+        self.segments: List[TenantSegment] = []
+        self.codes: Dict[int, int] = {}
+        self.next_code: int = 0
+        self.idle_seconds: Optional[float] = idle_seconds
+        # wall-clock time each tenant was last written or searched, saved along the codes
+        self.touched: Dict[int, float] = {}
+        self.max_parts: int = max_parts
+        # numbers the segment files, so that a file is never rewritten in place
+        self.next_file: int = 0
+        # files no longer listed, removed once the tenant codes no longer list them either
+        self._obsolete: List[str] = []
+        self._merging: Optional[threading.Thread] = None
+        # serializes writers; searches read the segments' published snapshots
+        self._lock = threading.RLock()
+        if root is not None:
+            self._load()
+        if not self.segments:
+            self.segments.append(self._new_segment())
+
+    def _new_segment(self) -> TenantSegment:
+        return TenantSegment(compact_threshold=self.compact_threshold)
+
+    def _file_name(self, segment: int, kind: str) -> str:
+        name = f"segment-{segment}-{kind}{self.next_file}"
+        self.next_file += 1
+        return name
+
+    def _files_of(self, name: str) -> List[str]:
+        return matrix_files(os.path.join(self.root, name))
+
+    def _load(self):
+        tenants_path = os.path.join(self.root, self.TENANTS_NAME)
+        if not os.path.isfile(tenants_path):
+            return
+        with open(tenants_path, 'r') as f:
+            saved = json.load(f)
+        self.codes = {int(tenant): code for tenant, code in saved["codes"].items()}
+        self.next_code = saved["next_code"]
+        self.next_file = saved.get("next_file", 0)
+        # tenants saved before their use was recorded are counted from now
+        now = time.time()
+        touched = saved.get("touched", {})
+        self.touched = {tenant: touched.get(str(tenant), now) for tenant in self.codes}
+        segments = saved["segments"]
+        if isinstance(segments, int):
+            # one file per segment, rewritten by every save
+            segments = [{"base": [f"segment-{segment}", None], "parts": [], "alive": None}
+                        for segment in range(segments)]
+        for layout in segments:
+            self.segments.append(self._load_segment(layout))
+        print(f"{len(self.codes)} tenant(s) in {len(self.segments)} segment(s) loaded from {self.root}")
+
+    def _load_segment(self, layout: Dict[str, Any]) -> TenantSegment:
+        names = ([layout["base"][0]] if layout["base"] else []) + [name for name, _, _ in layout["parts"]]
+        matrices, ids, tenants = [], [], []
+        for name in names:
+            base = os.path.join(self.root, name)
+            restored = read_matrix(base, mmap=len(names) == 1)
+            if restored is None:
+                raise ValueError(f"tenant segment file {base} listed but missing")
+            matrices.append(restored[0])
+            ids.append(restored[1])
+            tenants.append(read_array(base, "tenant", restored[2]))
+        rows = sum(matrix.shape[0] for matrix in matrices)
+        if rows == 0:
+            return self._new_segment()
+        matrix = matrices[0] if len(matrices) == 1 else np.concatenate(matrices)
+        ids, tenant = np.concatenate(ids), np.concatenate(tenants)
+        alive = np.ones(rows, dtype=bool)
+        if layout["alive"] is not None:
+            alive[:] = np.unpackbits(np.load(os.path.join(self.root, layout["alive"])), count=rows).astype(bool)
+        # rows of the tenants dropped since
+        alive &= np.isin(tenant, list(self.codes.values()))
+        keep = np.flatnonzero(alive)
+        if keep.shape[0] < rows:
+            matrix, ids, tenant = matrix[keep], ids[keep], tenant[keep]
+        segment = TenantSegment.from_arrays(matrix, list(zip(tenant.tolist(), ids.tolist())), tenant=tenant,
+                                            compact_threshold=self.compact_threshold)
+        if keep.shape[0] == rows and layout["alive"] is not None:
+            # the rows on disk are those in memory, later saves append to them
+            segment.base = tuple(layout["base"]) if layout["base"] else None
+            segment.parts = [tuple(part) for part in layout["parts"]]
+            segment.alive_name = layout["alive"]
+            segment.saved_rows = rows
+        else:
+            # renumbered, the next save writes it anew
+            self._obsolete.extend(path for name in names for path in self._files_of(name))
+            if layout["alive"] is not None:
+                self._obsolete.append(os.path.join(self.root, layout["alive"]))
+            segment.dirty = True
+        return segment
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def tenants(self) -> int:
+        return len(self.codes)
+
+    def _code(self, tenant: int) -> int:
+        self.touched[tenant] = time.time()
+        code = self.codes.get(tenant)
+        if code is None:
+            code = self.next_code
+            self.next_code += 1
+            self.codes[tenant] = code
+        return code
+
+    @contextmanager
+    def writing(self):
+        """
+        Groups the removals and insertions of one upsert into one published version of the newest segment, and
+        opens a new segment afterwards if it has grown past `segment_rows`.
+        """
+        with self._lock:
+            active = self.segments[-1]
+            with active.writing():
+                yield self
+            if active.size >= self.segment_rows:
+                self.segments.append(self._new_segment())
+
+    def remove(self, tenant: int, ids: List[Hashable]) -> int:
+        """
+        Removes the vectors stored under ids for a tenant from every segment and returns how many were found.
+        """
+        with self._lock:
+            code = self.codes.get(tenant)
+            if code is None:
+                return 0
+            self.touched[tenant] = time.time()
+            return sum(segment.remove_rows(code, ids) for segment in self.segments)
+
+    def add(self, tenant: int, vectors: Any, ids: List[Hashable]):
+        """
+        Stores the vectors under ids for a tenant in the newest segment, copies held by older segments are removed.
+        """
+        if len(ids) == 0:
+            return
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        with self._lock:
+            code = self._code(tenant)
+            *sealed, active = self.segments
+            for segment in sealed:
+                segment.remove_rows(code, ids)
+            active.add_rows(code, vectors, ids)
+
+    def search(self,
+               tenant: int,
+               queries: np.ndarray,
+               k: Optional[int],
+               threshold: Optional[float] = None,
+               allowed_ids: Optional[np.ndarray] = None) -> List[List[Tuple[Hashable, float]]]:
+        """
+        Searches the vectors of one tenant in every segment and merges the per-segment top-k lists.
+        """
+        code = self.codes.get(tenant)
+        if code is None:
+            return [[] for _ in range(queries.shape[0])]
+        self.touched[tenant] = time.time()
+        answers = [segment.search_tenant(code, queries, k, threshold, allowed_ids) for segment in self.segments]
+        results = []
+        for per_segment in zip(*answers):
+            merged = heapq.merge(*per_segment, key=lambda hit: hit[1], reverse=True)
+            results.append(list(merged) if k is None else [hit for _, hit in zip(range(k), merged)])
+        return results
+
+    def drop(self, tenant: int) -> int:
+        """
+        Drops every vector of a tenant, in time independent of their number. Returns how many there were.
+        """
+        with self._lock:
+            code = self.codes.pop(tenant, None)
+            self.touched.pop(tenant, None)
+            if code is None:
+                return 0
+            cnt = sum(segment.drop(code) for segment in self.segments)
+        print(f"tenant {tenant} dropped, {cnt} vector(s) released")
+        return cnt
+
+    def sweep(self) -> int:
+        """
+        Drops the tenants left untouched for `idle_seconds`, whose sessions are gone without logging out. Returns
+        how many were dropped.
+        """
+        if self.idle_seconds is None:
+            return 0
+        with self._lock:
+            deadline = time.time() - self.idle_seconds
+            idle = [tenant for tenant in self.codes if self.touched.get(tenant, 0.0) < deadline]
+            for tenant in idle:
+                self.drop(tenant)
+            return len(idle)
+
+    def save(self) -> int:
+        """
+        Drops the idle tenants, then writes what changed in each segment since it was last saved and the tenant
+        codes listing the files. Returns how many segments were written.
+        """
+        if self.root is None:
+            return 0
+        with self._lock:
+            self.sweep()
+            written = 0
+            for i, segment in enumerate(self.segments):
+                if segment.dirty:
+                    self._save_segment(i, segment)
+                    written += 1
+            self._write_tenants()
+            if any(len(segment.parts) >= self.max_parts for segment in self.segments) \
+                    and (self._merging is None or not self._merging.is_alive()):
+                self._merging = threading.Thread(target=self._merge_parts, daemon=True)
+                self._merging.start()
+            return written
+
+    def _save_segment(self, i: int, segment: TenantSegment):
+        """
+        Writes the rows appended to a segment since it was last saved as a new part, or the whole segment as a
+        new base if a compaction renumbered its rows since, then its tombstone bitmap. Every file gets a new name,
+        the files listed by the saved tenant codes stay valid until the new ones are listed. Called with the lock
+        held.
+        """
+        with segment._lock:
+            # a compaction running in the background swaps the arrays and bumps the epoch under this lock
+            snapshot, epoch = segment.snapshot(), segment.epoch
+            segment.dirty = False
+        n = snapshot[0]
+        if segment.base is None or epoch != segment.saved_epoch:
+            for name in ([segment.base[0]] if segment.base else []) + [name for name, _, _ in segment.parts]:
+                self._obsolete.extend(self._files_of(name))
+            segment.base, segment.parts, segment.saved_rows, segment.saved_epoch = None, [], 0, epoch
+        if n > segment.saved_rows:
+            start = segment.saved_rows
+            name = self._file_name(i, "g" if start == 0 else "p")
+            matrix, ids, tenant = segment.rows_between(snapshot, start)
+            write_matrix(os.path.join(self.root, name), matrix, ids, arrays={"tenant": tenant}, normalized=True)
+            if start == 0:
+                segment.base = (name, n)
+            else:
+                segment.parts.append((name, start, n - start))
+            segment.saved_rows = n
+        if segment.alive_name is not None:
+            self._obsolete.append(os.path.join(self.root, segment.alive_name))
+        segment.alive_name = self._file_name(i, "a") + ".npy"
+        tmp_path = os.path.join(self.root, segment.alive_name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.packbits(snapshot[2]["alive"][:n]) if n else np.zeros(0, dtype=np.uint8))
+        replace_file(tmp_path, os.path.join(self.root, segment.alive_name))
+
+    def _write_tenants(self):
+        write_json(os.path.join(self.root, self.TENANTS_NAME),
+                   {"codes": {str(tenant): code for tenant, code in self.codes.items()},
+                    "next_code": self.next_code,
+                    "next_file": self.next_file,
+                    "touched": {str(tenant): at for tenant, at in self.touched.items()},
+                    "segments": [{"base": list(segment.base) if segment.base else None,
+                                  "parts": [list(part) for part in segment.parts],
+                                  "alive": segment.alive_name}
+                                 for segment in self.segments]})
+        # files of the previous layout, no longer listed
+        for path in self._obsolete:
+            if os.path.isfile(path):
+                os.remove(path)
+        self._obsolete = []
+
+    def _merge_parts(self):
+        """
+        Merges the base and parts of every segment with `max_parts` parts into a new base, reading and writing
+        the files outside the lock. A segment rewritten meanwhile keeps its new files and the merge is dropped.
+        """
+        for i, segment in enumerate(list(self.segments)):
+            with self._lock:
+                if len(segment.parts) < self.max_parts:
+                    continue
+                base, parts, name = segment.base, list(segment.parts), self._file_name(i, "g")
+            names = [base[0]] + [part[0] for part in parts]
+            matrices, ids, tenants = [], [], []
+            for file in names:
+                matrix, file_ids, header = read_matrix(os.path.join(self.root, file))
+                matrices.append(matrix)
+                ids.append(file_ids)
+                tenants.append(read_array(os.path.join(self.root, file), "tenant", header))
+            merged = np.concatenate(matrices)
+            write_matrix(os.path.join(self.root, name), merged, np.concatenate(ids),
+                         arrays={"tenant": np.concatenate(tenants)}, normalized=True)
+            with self._lock:
+                if segment.base != base or segment.parts[:len(parts)] != parts:
+                    self._obsolete.extend(self._files_of(name))
+                else:
+                    self._obsolete.extend(path for file in names for path in self._files_of(file))
+                    segment.base, segment.parts = (name, merged.shape[0]), segment.parts[len(parts):]
+                self._write_tenants()
+            print(f"{len(parts)} part(s) of tenant segment {i} merged into {name}")
+
+    def wait_merging(self):
+        thread = self._merging
+        if thread is not None:
+            thread.join()
+
+
+_SHARED: Dict[Optional[str], MultiTenantIndex] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_tenant_index(root: Optional[str]) -> MultiTenantIndex:
+    """
+    Returns the process-wide multi-tenant index saved under root (kept in memory only if None), so that every
+    transient session of the process shares the same segments.
+    """
+    root = None if root is None else os.path.normpath(root)
+    with _SHARED_LOCK:
+        index = _SHARED.get(root)
+        if index is None:
+            index = MultiTenantIndex(root)
+            _SHARED[root] = index
+        return index
@@ -1,18 +1,126 @@
+import os
+import numpy as np
 from abc import ABC, abstractmethod
-from typing import List
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from alexandria.vectorstore.idregistry import IdRegistry
+from alexandria.vectorstore.metadata import MetadataColumns
+from alexandria.vectorstore.projection import Projection
+from handler.dedup import NearDuplicateIndex
 from handler.embedding.vectorize import Vectorize, embed_bundle
+from models.conversation import MultipleConversation, SingleConversation
+from models.document import DocumentChunkWithEmbedding, DocumentFilter, SingleDocumentWithChunks
 
 from models.generic import Bundle
 
 class VectorStore(ABC):
+    # maps conversation ids to dense int64 ids when set, see `alexandria.vectorstore.idregistry`
+    id_registry: Optional[IdRegistry] = None
+    # number of documents of the doc map referring to each chunk id, see `_chunk_refs`
+    _refs: Optional[Counter] = None
+    # projects full-dimension embeddings onto the stored dimensions when set, see `alexandria.vectorstore.projection`
+    projection: Optional[Projection] = None
+    # the near-duplicate index of the document store when it collapses chunks, see `handler.dedup`
+    dedup: Optional[NearDuplicateIndex] = None
+
     async def upsert(
             self,
             bundle: Bundle,
-            emb_method: Vectorize
+            emb_method: Vectorize,
+            batch_size: Optional[int] = None
+    ):
+        # near-duplicates collapsed onto a chunk already indexed, e.g. of another document, are not embedded
+        indexed = self._chunk_refs() if self.dedup is not None else None
+        _bundle = await embed_bundle(bundle, emb_method, indexed=indexed, batch_size=batch_size)
+        await self._upsert(_bundle)
+        if self.dedup is not None:
+            self.dedup.save()
+
+    async def reembed(
+            self,
+            bundle: Bundle,
+            emb_method: Vectorize,
+            batch_size: Optional[int] = None
     ):
-        _bundle = await embed_bundle(bundle, emb_method)
+        """
+        Embeds every chunk of the given documents again, near-duplicates already indexed included, and replaces the
+        vectors stored under their chunk ids; e.g. the whole library after the embedding method was refitted.
+        """
+        _bundle = await embed_bundle(bundle, emb_method, batch_size=batch_size)
         await self._upsert(_bundle)
 
+    def _chunk_refs(self) -> Counter:
+        """
+        Returns how many documents refer to each chunk id. Collapsed near-duplicate chunks are shared by several
+        documents, a chunk stays indexed while any of them refers to it. Counted from the doc map on first use.
+        """
+        if self._refs is None:
+            self._refs = Counter(id for ids in (getattr(self, "doc_map", None) or {}).values() for id in ids)
+        return self._refs
+
+    def _collect_upsert(self, bundle: Bundle) -> Tuple[List[int], List[int], List[List[float]], List[tuple]]:
+        """
+        Walks an embedded bundle and points the doc map at the new chunks of its documents.
+
+        Returns:
+        - A tuple of (ids no document refers to anymore, ids to add, their embeddings, metadata rows to upsert).
+            Chunks left without an embedding are already indexed and only gain a reference; the document that
+            upserted a shared chunk last owns its metadata row.
+        """
+        refs = self._chunk_refs()
+        rewritten: Dict[str, set] = {}
+        versioned_sub_ids: List[int] = []
+        updated_sub_ids: List[int] = []
+        updated_embeddings: List[List[float]] = []
+        updated_meta: List[tuple] = []
+        for elem in bundle.contents:
+            if isinstance(elem, SingleDocumentWithChunks):
+                doc_id = elem.doc_id
+                versioned = self.doc_map.get(doc_id, [])
+                refs.subtract(versioned)
+                versioned_sub_ids.extend(versioned)
+                self.doc_map.update({doc_id: []})
+                for sub in elem.chunks:
+                    self.doc_map.get(doc_id).append(sub.chunk_id)
+                    refs[sub.chunk_id] += 1
+                    updated_meta.append((sub.chunk_id, doc_id, elem.metadata.created_by, elem.metadata.created_at))
+                    if isinstance(sub, DocumentChunkWithEmbedding):
+                        updated_sub_ids.append(sub.chunk_id)
+                        updated_embeddings.append(sub.embedding)
+                rewritten[doc_id] = set(self.doc_map[doc_id])
+            elif isinstance(elem, SingleConversation):
+                updated_sub_ids.extend(self._conversation_ids([elem]))
+                assert isinstance(bundle, MultipleConversation)
+                updated_embeddings.append(bundle.embedding.embeddings.get(elem))
+            else:
+                raise ValueError
+        versioned_sub_ids = list(dict.fromkeys(versioned_sub_ids))
+        shared = [id for id in versioned_sub_ids if refs[id] > 0]
+        if shared and self.metadata is not None:
+            self._hand_over(shared, rewritten)
+        versioned_sub_ids = [id for id in versioned_sub_ids if refs[id] <= 0]
+        for id in versioned_sub_ids:
+            del refs[id]
+        if self.dedup is not None:
+            # later chunks must not collapse onto chunks that are no longer indexed
+            self.dedup.discard(versioned_sub_ids)
+        return versioned_sub_ids, updated_sub_ids, updated_embeddings, updated_meta
+
+    def _hand_over(self, shared: List[int], rewritten: Dict[str, set]):
+        """
+        Moves the metadata rows of shared chunks whose owner was just rewritten without them to another document
+        still referring to them, so that their chunks can still be retrieved from the DocStore.
+        """
+        orphans = {id for id, owner in zip(shared, self.metadata.doc_of(shared))
+                   if owner in rewritten and id not in rewritten[owner]}
+        if not orphans:
+            return
+        heirs = {}
+        for doc_id, ids in self.doc_map.items():
+            for id in orphans.intersection(ids):
+                heirs.setdefault(id, doc_id)
+        self.metadata.move(list(heirs), list(heirs.values()))
+
     @abstractmethod
     async def _upsert(
             self,
@@ -23,18 +131,52 @@ class VectorStore(ABC):
     async def query(
             self,
             texts: List[str],
-            emb_method: Vectorize
-    ):
+            emb_method: Vectorize,
+            k: Optional[int] = 3,
+            threshold: Optional[float] = None,
+            filter: Optional[DocumentFilter] = None
+    ) -> List[List[Tuple[int, float]]]:
         q_emb = await emb_method.embed_text_bundle(texts)
-        await self._query(q_emb, k=3)
+        return await self._query_with_scores(q_emb, k=k, threshold=threshold, filter=filter)
     
-    @abstractmethod
     async def _query(
             self,
             vectors: List[List[float]],
-            k: int = 3
+            k: Optional[int] = 3,
+            **kwargs
     ) -> List[List[int]]:
+        scored = await self._query_with_scores(vectors, k=k, **kwargs)
+        return [[id for id, _ in hits] for hits in scored]
+
+    @abstractmethod
+    async def _query_with_scores(
+            self,
+            vectors: List[List[float]],
+            k: Optional[int] = 3,
+            threshold: Optional[float] = None,
+            filter: Optional[DocumentFilter] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Returns, for each query vector, up to k (id, score) pairs ordered from the most to the least similar.
+        Scores are similarities (higher is closer): cosine similarity, or the negated squared distance for L2
+        indexes. Hits scoring below `threshold` are dropped; with k None it becomes a range search returning
+        every hit above the threshold. Padding ids of underfull results are never returned. With a filter, only
+        vectors whose metadata matches it are scanned.
+        """
         raise NotImplemented
+
+    def _search_scores(
+            self,
+            vectors: List[List[float]],
+            k: Optional[int] = 3,
+            threshold: Optional[float] = None,
+            filter: Optional[DocumentFilter] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        The synchronous search behind `_query_with_scores`, for callers already running off the event loop (e.g.
+        in worker threads); the stores search synchronously anyway.
+        """
+        raise NotImplementedError("vector store cannot be searched synchronously")
     
     @abstractmethod
     async def serializing(
@@ -51,6 +193,44 @@ class VectorStore(ABC):
     ):
         raise NotImplemented
 
+    def _setup_metadata(self):
+        """
+        Sets up the metadata columns used by filtered searches, from `restore_meta_from` if it was saved, otherwise
+        backfilled with the document ids found in the doc map.
+        """
+        if self.restore_meta_from is not None and os.path.isfile(self.restore_meta_from):
+            self.metadata = MetadataColumns.load(self.restore_meta_from)
+        else:
+            self.metadata = MetadataColumns.from_doc_map(self.doc_map or {})
+
+    def _projected(self, vectors: np.ndarray, dim: Optional[int]) -> np.ndarray:
+        """
+        Returns the vectors in the space of an index of dimension dim: projected if they are full-dimension
+        embeddings and the index holds projected ones, as they are otherwise.
+        """
+        if self.projection is None or dim is None or vectors.shape[1] == dim:
+            return vectors
+        return self.projection.apply(vectors)
+
+    def _conversation_ids(self, conversations: List[SingleConversation]) -> List[int]:
+        """
+        Returns the int64 ids the given conversations are stored under: their dense ids in the id registry, or the
+        48-bit hash of their conv_id when the store has no registry.
+        """
+        if self.id_registry is None:
+            return [hash(conv) for conv in conversations]
+        return self.id_registry.assign([conv.conv_id for conv in conversations]).tolist()
+
+    def docs_of_chunks(self, chunk_ids: List[int]) -> List[Tuple[str, int]]:
+        """
+        Returns the (doc_id, chunk_id) pair of every given chunk id known to the store, in order. Looked up in the
+        incrementally maintained metadata columns, so the cost is O(1) per chunk whatever the library size.
+        """
+        if self.metadata is None:
+            raise ValueError("chunk-doc mapping not initialized")
+        return [(doc_id, chunk_id) for doc_id, chunk_id in zip(self.metadata.doc_of(chunk_ids), chunk_ids)
+                if doc_id is not None]
+
     def reverse_doc_map(self):
         if self.doc_map:
             chunk_map = {v: k for k, vs in self.doc_map.items() for v in vs}
@@ -0,0 +1,99 @@
+import json
+import os
+import struct
+import zlib
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+OP_ADD = 1
+OP_REMOVE = 2
+# a JSON object of document-level changes (doc map entries, metadata rows) applied along with the vectors
+OP_DOCS = 3
+# op, number of ids (of payload bytes for OP_DOCS), vector dimension (0 for the others), crc32 of the payload
+_HEADER = struct.Struct("<BIII")
+
+
+class WriteAheadLog:
+    def __init__(self, path: str):
+        """
+        Initializes an append-only log of added and removed (id, vector) records, interleaved with the document
+        changes of the same writes.
+
+        Each record is a fixed header followed by the int64 ids and, for additions, the float32 vectors. The
+        header carries a CRC32 of the payload so that a record torn by a crash is detected and cut off on replay.
+
+        Args:
+        - path: A string representing the path of the log file.
+        """
+        self.path: str = path
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    def _append(self, records: bytes):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def encode(op: int, ids: np.ndarray, vectors: Optional[np.ndarray] = None) -> bytes:
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        payload = ids.tobytes()
+        dim = 0
+        if vectors is not None:
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            assert vectors.shape[0] == ids.shape[0], "vectors and ids to be logged not aligned"
+            dim = vectors.shape[1]
+            payload += vectors.tobytes()
+        return _HEADER.pack(op, ids.shape[0], dim, zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def encode_docs(changes: dict) -> bytes:
+        payload = json.dumps(changes).encode("utf-8")
+        return _HEADER.pack(OP_DOCS, len(payload), 0, zlib.crc32(payload)) + payload
+
+    def append(self, records: list):
+        """
+        Appends encoded records (see `encode`) and fsyncs them as one write.
+        """
+        if records:
+            self._append(b"".join(records))
+
+    def replay(self) -> Iterator[Tuple[int, np.ndarray, Optional[np.ndarray]]]:
+        """
+        Yields (op, ids, vectors) for every intact record in order, (OP_DOCS, None, changes) for document changes.
+        A torn or corrupted tail is truncated away.
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            op, count, dim, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            end = start + (count if op == OP_DOCS else count * 8 + count * dim * 4)
+            if op not in (OP_ADD, OP_REMOVE, OP_DOCS) or end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break
+            if op == OP_DOCS:
+                yield op, None, json.loads(data[start:end].decode("utf-8"))
+                offset = end
+                continue
+            ids = np.frombuffer(data, dtype=np.int64, count=count, offset=start)
+            vectors = None
+            if op == OP_ADD:
+                vectors = np.frombuffer(data, dtype=np.float32, count=count * dim,
+                                        offset=start + count * 8).reshape(count, dim)
+            yield op, ids, vectors
+            offset = end
+        if offset < len(data):
+            print(f"write-ahead log {self.path} has a torn tail of {len(data) - offset} byte(s), truncating")
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def reset(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
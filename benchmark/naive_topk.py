@@ -0,0 +1,59 @@
+"""
+Compares the per-row scipy cosine search that NaiveVectorStore used to run against the batched,
+pre-normalized matrix-multiply search, checking that both return the same ids.
+
+Usage: python -m benchmark.naive_topk --size 200000 --dim 1536 --queries 2 --k 3
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+import numpy as np
+from scipy.spatial.distance import cosine
+
+from alexandria.vectorstore.providers.naivevectorstore import NaiveVectorStore
+
+
+def _legacy_topk(storage: np.ndarray, ids: List[int], query: np.ndarray, k: int) -> List[int]:
+    similarities = np.apply_along_axis(lambda v: 1 - cosine(query, v), axis=1, arr=storage)
+    indices = np.argpartition(-similarities, min(similarities.shape[0] - 1, k))[:k]
+    _subset = sorted([(i, similarities[i]) for i in indices], key=lambda x: x[1], reverse=True)
+    return [ids[x[0]] for x in _subset]
+
+
+async def main(size: int, dim: int, n_queries: int, k: int, seed: int):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, dim), dtype=np.float32)
+    ids = rng.choice(2 ** 48, size=size, replace=False).tolist()
+    queries = rng.standard_normal((n_queries, dim), dtype=np.float32)
+
+    store = NaiveVectorStore(session_id=0, transient=True)
+    store._add(vectors, ids)
+    # first query materializes the normalized matrix, keep it out of the timing
+    await store._query(queries, k=k)
+
+    start = time.perf_counter()
+    legacy = [_legacy_topk(vectors, ids, q, k) for q in queries]
+    legacy_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = await store._query(queries, k=k)
+    batched_elapsed = time.perf_counter() - start
+
+    print(f"corpus: {size} x {dim}, queries: {n_queries}, k: {k}")
+    print(f"legacy  per-row cosine: {legacy_elapsed * 1000:10.2f} ms")
+    print(f"batched matmul top-k : {batched_elapsed * 1000:10.2f} ms")
+    print(f"speedup: {legacy_elapsed / max(batched_elapsed, 1e-9):.1f}x")
+    print(f"same ids: {legacy == batched}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=2)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args.size, args.dim, args.queries, args.k, args.seed))
@@ -0,0 +1,294 @@
+"""
+Benchmarks every vector store provider and index key on the same corpora: insert throughput, query latency
+(p50/p99), QPS at batch sizes 1 and 32, peak RSS, size on disk, serialize/restore time and recall@k against an
+exact cosine search. Each run happens in a fresh process so that its peak RSS is its own.
+
+Corpora are synthetic (clustered Gaussian vectors, regenerated from the seed in every run) or a saved library:
+the binary index of NaiveVectorStore (`vectors.npy`) or a FAISS `vectors.index`.
+
+Usage: python -m benchmark.suite --sizes 10000 100000 1000000 --dims 512 1536 --output results.json
+       python -m benchmark.suite --library .data/reserve/_session/docs/embeddings/ --output library.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alexandria.vectorstore.buffer import VectorBuffer, select_topk
+from alexandria.vectorstore.persistence import read_matrix
+from alexandria.vectorstore.projection import DEFAULT_TRAIN_SIZE
+from alexandria.vectorstore.router import get_vecstore
+
+
+def providers(size: int, dim: int, n_shards: int) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Returns the (name, vecstore, kwargs) runs for a corpus: every provider of `get_vecstore` and every index key
+    of FAISS, with IVF sized for the corpus.
+    """
+    nlist = max(1, int(min(4 * math.sqrt(size), size // 78)))
+    m = next(m for m in (dim // 16, dim // 8, dim // 4, 1) if m > 0 and dim % m == 0)
+    faiss_keys = ["Flat", "HNSW32", f"IVF{nlist},Flat", f"IVF{nlist},PQ{m}"]
+    runs = [("naive", "naive", {}),
+            ("naive-float16", "naive", {"quantization": "float16"}),
+            ("naive-int8", "naive", {"quantization": "int8"}),
+            (f"sharded-{n_shards}", "sharded", {"n_shards": n_shards}),
+            # built from the first rows, so that queries go through the on-disk IVF and not the delta only
+            ("disk", "disk", {"disk_build_min": min(size, 1024)})]
+    runs.extend((f"FAISS-{key}", "FAISS", {"index_key": key, "metric": "cosine"}) for key in faiss_keys)
+    if dim > 256 and size >= DEFAULT_TRAIN_SIZE:
+        # recall@k of these runs is the recall kept against full-dimension search; smaller corpora never train
+        # the projection and would be measured at full dimension
+        runs.extend([("naive-pca256", "naive", {"projection_dim": 256}),
+                     ("FAISS-Flat-pca256", "FAISS", {"index_key": "Flat", "metric": "cosine", "projection_dim": 256})])
+    return runs
+
+
+def synthetic_corpus(size: int, dim: int, n_queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clustered vectors, closer to real embeddings than isotropic noise, with 48-bit ids like chunk ids. Queries are
+    perturbed corpus vectors.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, int(math.sqrt(size)))
+    centers = rng.standard_normal((n_clusters, dim), dtype=np.float32)
+    vectors = np.empty((size, dim), dtype=np.float32)
+    block = 65536
+    for start in range(0, size, block):
+        end = min(size, start + block)
+        labels = rng.integers(0, n_clusters, end - start)
+        vectors[start:end] = centers[labels] + 0.5 * rng.standard_normal((end - start, dim), dtype=np.float32)
+    ids = rng.choice(2 ** 48, size=size, replace=False).astype(np.int64)
+    picks = rng.integers(0, size, n_queries)
+    queries = vectors[picks] + 0.5 * rng.standard_normal((n_queries, dim), dtype=np.float32)
+    return vectors, ids, queries
+
+
+def library_corpus(root: str, n_queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loads the vectors of a saved library, queries are perturbed library vectors.
+    """
+    restored = read_matrix(os.path.join(root, "vectors"))
+    if restored is not None:
+        vectors, ids, _ = restored
+        vectors = np.asarray(vectors)
+    elif os.path.isfile(os.path.join(root, "vectors.index")):
+        import faiss
+        index = faiss.read_index(os.path.join(root, "vectors.index"))
+        if isinstance(index, faiss.IndexIDMap2):
+            ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+            vectors = index.index.reconstruct_n(0, index.ntotal)
+        else:
+            ivf = faiss.extract_index_ivf(index)
+            ivf.make_direct_map()
+            ids = np.concatenate([faiss.rev_swig_ptr(ivf.invlists.get_ids(l), ivf.invlists.list_size(l)).copy()
+                                  for l in range(ivf.nlist)]).astype(np.int64)
+            vectors = np.vstack([index.reconstruct(int(id)) for id in ids]) if ids.shape[0] else \
+                np.empty((0, index.d), dtype=np.float32)
+    else:
+        raise ValueError(f"no saved library found at {root}")
+    if vectors.shape[0] == 0:
+        raise ValueError(f"library at {root} is empty")
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, vectors.shape[0], n_queries)
+    scale = 0.1 * float(np.abs(vectors[picks]).mean())
+    queries = vectors[picks] + scale * rng.standard_normal((n_queries, vectors.shape[1]), dtype=np.float32)
+    return np.ascontiguousarray(vectors, dtype=np.float32), ids, queries.astype(np.float32)
+
+
+def exact_topk(vectors: np.ndarray, queries: np.ndarray, k: int, block: int = 65536) -> np.ndarray:
+    """
+    Ground truth: row indices of the k most cosine-similar vectors per query, scanned blockwise.
+    """
+    queries = VectorBuffer.normalize(queries)
+    best_rows = np.empty((queries.shape[0], 0), dtype=np.int64)
+    best_scores = np.empty((queries.shape[0], 0), dtype=np.float32)
+    for start in range(0, vectors.shape[0], block):
+        scores = queries @ VectorBuffer.normalize(vectors[start:start + block]).T
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)],
+                              axis=1)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        top, best_scores = select_topk(scores, min(k, scores.shape[1]))
+        best_rows = np.take_along_axis(rows, top, axis=1)
+    return best_rows
+
+
+def recall_at_k(truth_ids: List[set], results: List[List[Tuple[int, float]]], k: int) -> float:
+    hits = sum(len(truth & {id for id, _ in hits[:k]}) for truth, hits in zip(truth_ids, results))
+    return hits / max(1, sum(len(truth) for truth in truth_ids))
+
+
+def _dir_size(root: str) -> int:
+    size = 0
+    for dirpath, _, files in os.walk(root):
+        size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in files)
+    return size
+
+
+def _peak_rss_mb(who: int) -> float:
+    # kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * unit / 2 ** 20
+
+
+async def _run(name: str, vecstore: str, kwargs: Dict[str, Any], corpus: Dict[str, Any],
+               k: int, batch_size: int, nprobe: int, ef_search: int) -> Dict[str, Any]:
+    if corpus["library"] is not None:
+        vectors, ids, queries = library_corpus(corpus["library"], corpus["queries"], corpus["seed"])
+    else:
+        vectors, ids, queries = synthetic_corpus(corpus["size"], corpus["dim"], corpus["queries"], corpus["seed"])
+    truth = exact_topk(vectors, queries, k)
+    truth_ids = [set(ids[row].tolist()) for row in truth]
+    dim = vectors.shape[1]
+    if vecstore == "FAISS":
+        kwargs = dict(kwargs, dim=dim, nprobe=nprobe, ef_search=ef_search)
+    elif vecstore == "disk":
+        kwargs = dict(kwargs, disk_nprobe=nprobe)
+    # the disk store keeps its index files where it is serialized, it is built, saved and restored in one root
+    save_root = tempfile.mkdtemp(prefix="alexandria-bench-")
+    try:
+        # measured as the library, which is where every provider applies (session stores are never sharded)
+        store = get_vecstore(session_id=0, transient=False, vecstore=vecstore, **kwargs)
+        result: Dict[str, Any] = {"provider": name, "vecstore": vecstore, "options": kwargs,
+                                  "size": int(vectors.shape[0]), "dim": int(dim), "k": k}
+
+        start = time.perf_counter()
+        for offset in range(0, vectors.shape[0], batch_size):
+            store._add(vectors[offset:offset + batch_size], ids[offset:offset + batch_size].tolist())
+        elapsed = time.perf_counter() - start
+        result["insert_seconds"] = elapsed
+        result["insert_per_second"] = vectors.shape[0] / elapsed
+        if vecstore == "disk":
+            # the delta is folded into the on-disk index when saved
+            start = time.perf_counter()
+            await store.serializing(save_root, is_doc=False)
+            result["build_seconds"] = time.perf_counter() - start
+        if kwargs.get("projection_dim") is not None:
+            if store.projection is None:
+                raise ValueError(f"projection not trained on {vectors.shape[0]} vector(s)")
+            result["projection"] = store.projection.report()
+
+        latencies = []
+        results = []
+        for query in queries:
+            start = time.perf_counter()
+            results.extend(await store._query_with_scores(query[None, :], k=k))
+            latencies.append(time.perf_counter() - start)
+        result["latency_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+        result["latency_p99_ms"] = float(np.percentile(latencies, 99) * 1000)
+        result["qps_batch_1"] = len(latencies) / sum(latencies)
+        result[f"recall@{k}"] = recall_at_k(truth_ids, results, k)
+
+        start = time.perf_counter()
+        for offset in range(0, queries.shape[0], 32):
+            await store._query_with_scores(queries[offset:offset + 32], k=k)
+        result["qps_batch_32"] = queries.shape[0] / (time.perf_counter() - start)
+
+        if vecstore == "disk":
+            result["pages"] = store.page_report()
+
+        start = time.perf_counter()
+        await store.serializing(save_root, is_doc=False)
+        result["serialize_seconds"] = time.perf_counter() - start
+        result["file_bytes"] = _dir_size(save_root)
+        if hasattr(store, "close"):
+            store.close()
+        del store
+        start = time.perf_counter()
+        restored = get_vecstore(session_id=0, transient=False, vecstore=vecstore, restore_root=save_root, **kwargs)
+        result["restore_seconds"] = time.perf_counter() - start
+        restored_results = await restored._query_with_scores(queries, k=k)
+        result[f"restored_recall@{k}"] = recall_at_k(truth_ids, restored_results, k)
+        if hasattr(restored, "close"):
+            restored.close()
+    finally:
+        shutil.rmtree(save_root, ignore_errors=True)
+    result["peak_rss_self_mb"] = _peak_rss_mb(resource.RUSAGE_SELF)
+    # the largest of the terminated children, i.e. shard workers; not added to the above, their peaks need not overlap
+    result["peak_rss_children_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def _run_in_process(queue, *args):
+    try:
+        queue.put(asyncio.run(_run(*args)))
+    except Exception as e:
+        queue.put({"provider": args[0], "error": f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(*args) -> Dict[str, Any]:
+    """
+    Runs one benchmark in a fresh process, so that peak RSS and allocator state do not leak between runs.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_in_process, args=(queue,) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(sizes: List[int], dims: List[int], library: Optional[str], n_queries: int, k: int, batch_size: int,
+         nprobe: int, ef_search: int, n_shards: int, only: Optional[List[str]], seed: int) -> Dict[str, Any]:
+    corpora = []
+    if library is not None:
+        vectors, _, _ = library_corpus(library, 1, seed)
+        corpora.append({"library": library, "size": vectors.shape[0], "dim": vectors.shape[1],
+                        "queries": n_queries, "seed": seed})
+        del vectors
+    else:
+        corpora.extend({"library": None, "size": size, "dim": dim, "queries": n_queries, "seed": seed}
+                       for size in sizes for dim in dims)
+    runs = []
+    for corpus in corpora:
+        for name, vecstore, kwargs in providers(corpus["size"], corpus["dim"], n_shards):
+            if only and name not in only and vecstore not in only:
+                continue
+            print(f"{name} on {corpus['size']} x {corpus['dim']} ...", file=sys.stderr)
+            result = run_isolated(name, vecstore, kwargs, corpus, k, batch_size, nprobe, ef_search)
+            result["corpus"] = "library" if corpus["library"] is not None else "synthetic"
+            print(json.dumps(result), file=sys.stderr)
+            runs.append(result)
+    return {"environment": {"python": platform.python_version(),
+                            "machine": platform.machine(),
+                            "cpus": os.cpu_count(),
+                            "numpy": np.__version__},
+            "settings": {"queries": n_queries, "k": k, "batch_size": batch_size, "nprobe": nprobe,
+                         "ef_search": ef_search, "seed": seed},
+            "runs": runs}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dims", type=int, nargs="+", default=[512, 1536])
+    parser.add_argument("--library", type=str, default=None, help="saved library root, replaces the synthetic corpora")
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1000, help="vectors per upsert batch")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--only", type=str, nargs="+", default=None, help="provider names or vecstore types to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON file to write, stdout if omitted")
+    args = parser.parse_args()
+    report = main(args.sizes, args.dims, args.library, args.queries, args.k, args.batch_size,
+                  args.nprobe, args.ef_search, args.shards, args.only, args.seed)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}", file=sys.stderr)
@@ -1,6 +1,8 @@
 from typing import Dict, List, Optional
 
 import tiktoken
+from alexandria.vectorstore.idregistry import IdRegistry
+from handler.dedup import NearDuplicateIndex
 from handler.utils import hash_int
 
 from models.document import DocumentChunk, DocumentChunkMetadata, SingleDocument, SingleDocumentWithChunks
@@ -59,7 +61,9 @@ def _chunkify(
 
 def _add_chunks_to_doc(
         document: SingleDocument,
-        chunk_token_len: Optional[int]
+        chunk_token_len: Optional[int],
+        dedup: Optional[NearDuplicateIndex] = None,
+        id_registry: Optional[IdRegistry] = None
 ) -> Optional[SingleDocumentWithChunks]:
     if document.text is None or document.text.isspace():
         return None
@@ -71,6 +75,16 @@ def _add_chunks_to_doc(
     # note that chunk_id of a chunk in different versions of a document
     # won't change if the texts are the same
     chunk_ids = [hash_int(text + str(hash(document))) for text in chunk_texts]
+    if id_registry is not None:
+        # the scattered 48-bit hashes become dense int64 ids, the same hash always getting the same id
+        chunk_ids = id_registry.assign(chunk_ids).tolist()
+    if dedup is not None:
+        # near-identical chunks (templates, disclaimers) share the id of the first one seen, so they are
+        # embedded and indexed once; a document keeps one chunk per id
+        kept: Dict[int, str] = {}
+        for chunk_id, text in zip(dedup.canonical_ids(chunk_ids, chunk_texts), chunk_texts):
+            kept.setdefault(chunk_id, text)
+        chunk_ids, chunk_texts = list(kept), list(kept.values())
     chunks = [DocumentChunk(chunk_id=chunk_id,
                             text=chunk_text,
                             metadata=chunk_metadata)
@@ -82,11 +96,13 @@ def _add_chunks_to_doc(
 
 def get_document_chunks(
         documents: List[SingleDocument],
-        chunk_token_len: Optional[int]
+        chunk_token_len: Optional[int],
+        dedup: Optional[NearDuplicateIndex] = None,
+        id_registry: Optional[IdRegistry] = None
 ) -> List[SingleDocumentWithChunks]:
     docs_with_chunks: List[SingleDocumentWithChunks] = []
     for doc in documents:
-        doc_with_chunks = _add_chunks_to_doc(doc, chunk_token_len)
+        doc_with_chunks = _add_chunks_to_doc(doc, chunk_token_len, dedup, id_registry)
         if not doc_with_chunks:
             continue
         docs_with_chunks.append(doc_with_chunks)
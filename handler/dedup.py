@@ -0,0 +1,190 @@
+import os
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# largest Mersenne prime below 2^64, modulus of the permutations
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def shingles(text: str, width: int = 3) -> np.ndarray:
+    """
+    Returns the 32-bit hashes of the word `width`-grams of a whitespace- and case-normalized text (of the whole text
+    if it has fewer words).
+    """
+    words = re.sub(r"\s+", " ", text).strip().lower().split(" ")
+    grams = [" ".join(words[i:i + width]) for i in range(max(1, len(words) - width + 1))]
+    return np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, width: int = 3, seed: int = 1):
+        """
+        Initializes MinHash signatures of `num_perm` random permutations of shingle hashes. The fraction of equal
+        components of two signatures estimates the Jaccard similarity of the shingle sets of their texts.
+        """
+        rng = np.random.default_rng(seed)
+        self.num_perm: int = num_perm
+        self.width: int = width
+        self.a: np.ndarray = rng.integers(1, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self.b: np.ndarray = rng.integers(0, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text, self.width)
+        with np.errstate(over="ignore"):
+            permuted = (hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+
+class NearDuplicateIndex:
+    def __init__(self,
+                 path: Optional[str] = None,
+                 threshold: float = 0.8,
+                 num_perm: int = 64,
+                 bands: int = 8):
+        """
+        Initializes an LSH index of MinHash signatures mapping every chunk to a canonical chunk: the first chunk
+        seen whose text is near-identical to it, or itself. Signatures are split into `bands` bands, chunks sharing
+        one band are candidates, and a candidate is accepted when the signatures estimate a Jaccard similarity of
+        at least `threshold`. Only canonical chunks are indexed, so memory grows with the number of distinct texts;
+        a canonical chunk no document refers to anymore is discarded, its row is reclaimed when the index is loaded.
+
+        Args:
+        - path: An optional string representing the `.npz` file the index is saved to and loaded from.
+        - threshold: A float representing the estimated Jaccard similarity from which two chunks are collapsed.
+        - num_perm: An integer representing the length of the signatures.
+        - bands: An integer representing the number of LSH bands, dividing num_perm.
+        """
+        if num_perm % bands:
+            raise ValueError("signature length must be a multiple of the number of bands")
+        self.path: Optional[str] = path
+        self.threshold: float = threshold
+        self.bands: int = bands
+        self.hasher = MinHasher(num_perm)
+        self.keys: List[int] = []
+        # row of every canonical chunk still indexed
+        self.rows: Dict[int, int] = {}
+        self.signatures: np.ndarray = np.empty((0, num_perm), dtype=np.uint64)
+        self._size: int = 0
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.stats: Dict[str, int] = {"checked": 0, "collapsed": 0}
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            self._load(path)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in np.split(signature, self.bands)]
+
+    def _register(self, key: int, signature: np.ndarray):
+        if self._size == self.signatures.shape[0]:
+            grown = np.empty((max(1024, 2 * self._size), self.signatures.shape[1]), dtype=np.uint64)
+            grown[:self._size] = self.signatures[:self._size]
+            self.signatures = grown
+        row = self._size
+        self.signatures[row] = signature
+        self.keys.append(key)
+        self.rows[key] = row
+        self._size += 1
+        for bucket, band_key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(band_key, []).append(row)
+
+    def canonical_ids(self, chunk_ids: List[int], texts: List[str]) -> List[int]:
+        """
+        Returns the id of the canonical chunk of each given chunk, registering as canonical those with no
+        near-duplicate indexed yet.
+        """
+        assert len(chunk_ids) == len(texts), "chunk ids and texts not aligned"
+        canonical = []
+        with self._lock:
+            for chunk_id, text in zip(chunk_ids, texts):
+                signature = self.hasher.signature(text)
+                candidates = {row for bucket, band_key in zip(self.buckets, self._band_keys(signature))
+                              for row in bucket.get(band_key, ())}
+                best, best_similarity = None, self.threshold
+                for row in candidates:
+                    similarity = float(np.mean(self.signatures[row] == signature))
+                    if similarity >= best_similarity:
+                        best, best_similarity = row, similarity
+                self.stats["checked"] += 1
+                if best is None:
+                    self._register(chunk_id, signature)
+                    canonical.append(chunk_id)
+                    continue
+                if self.keys[best] != chunk_id:
+                    self.stats["collapsed"] += 1
+                canonical.append(self.keys[best])
+        return canonical
+
+    def discard(self, chunk_ids: List[int]) -> int:
+        """
+        Removes canonical chunks from the LSH bands, so that later chunks are no longer collapsed onto them. Returns
+        how many were indexed.
+        """
+        discarded = 0
+        with self._lock:
+            for chunk_id in chunk_ids:
+                row = self.rows.pop(chunk_id, None)
+                if row is None:
+                    continue
+                for bucket, band_key in zip(self.buckets, self._band_keys(self.signatures[row])):
+                    rows = bucket.get(band_key, [])
+                    if row in rows:
+                        rows.remove(row)
+                    if not rows:
+                        bucket.pop(band_key, None)
+                discarded += 1
+        return discarded
+
+    def report(self) -> Dict[str, float]:
+        """
+        Reports how many chunks were checked, how many were collapsed onto another chunk and how many canonical
+        chunks are indexed.
+        """
+        with self._lock:
+            checked = self.stats["checked"]
+            return {"checked": checked,
+                    "collapsed": self.stats["collapsed"],
+                    "collapse_rate": self.stats["collapsed"] / max(1, checked),
+                    "canonical": len(self.rows)}
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            live = np.fromiter(sorted(self.rows.values()), dtype=np.int64, count=len(self.rows))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, keys=np.asarray(self.keys, dtype=np.int64)[live], signatures=self.signatures[live])
+            os.replace(tmp_path, self.path)
+
+    def _load(self, path: str):
+        with np.load(path) as saved:
+            keys, signatures = saved["keys"], saved["signatures"]
+        if signatures.shape[1] != self.signatures.shape[1]:
+            print(f"near-duplicate index at {path} has signatures of another length, starting afresh")
+            return
+        for key, signature in zip(keys.tolist(), signatures):
+            self._register(key, signature)
+        print(f"near-duplicate index of {self._size} canonical chunk(s) loaded from {path}")
+
+
+_SHARED: Dict[str, NearDuplicateIndex] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_dedup_index(path: str) -> NearDuplicateIndex:
+    """
+    Returns the process-wide near-duplicate index saved at path, so every upsert into the same library collapses
+    chunks against the same canonical chunks.
+    """
+    path = os.path.normpath(path)
+    with _SHARED_LOCK:
+        index = _SHARED.get(path)
+        if index is None:
+            index = NearDuplicateIndex(path)
+            _SHARED[path] = index
+        return index
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from handler.embedding.vectorize import Vectorize
+
+KEY_BYTES = 16
+
+
+def normalize_text(text: str) -> str:
+    # texts differing only in whitespace embed alike
+    return " ".join(text.split())
+
+
+class _Space:
+    KEYS_NAME = "keys.bin"
+    VECTORS_NAME = "vectors.f32"
+    SPACE_NAME = "space.json"
+
+    def __init__(self, root: str, namespace: str):
+        """
+        The cached embeddings of one model: two append-only files, the float32 vectors and their keys, row by
+        row. A vector is appended before its key, so a crash leaves at most a vector without a key, cut off on the
+        next open.
+        """
+        self.root: str = root
+        self.namespace: str = namespace
+        self.dim: Optional[int] = None
+        self.rows: Dict[bytes, int] = {}
+        self._fd: Optional[int] = None
+        space_path = os.path.join(root, self.SPACE_NAME)
+        if not os.path.isfile(space_path):
+            return
+        with open(space_path, 'r') as f:
+            self.dim = json.load(f)["dim"]
+        keys_path, vectors_path = self._paths()
+        with open(keys_path, 'rb') as f:
+            keys = f.read()
+        n = min(len(keys) // KEY_BYTES, os.path.getsize(vectors_path) // (4 * self.dim))
+        for row in range(n):
+            self.rows[keys[row * KEY_BYTES:(row + 1) * KEY_BYTES]] = row
+        for path, size in ((keys_path, n * KEY_BYTES), (vectors_path, n * 4 * self.dim)):
+            if os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _paths(self) -> Tuple[str, str]:
+        return os.path.join(self.root, self.KEYS_NAME), os.path.join(self.root, self.VECTORS_NAME)
+
+    def read(self, row: int) -> np.ndarray:
+        if self._fd is None:
+            self._fd = os.open(self._paths()[1], os.O_RDONLY)
+        size = 4 * self.dim
+        return np.frombuffer(os.pread(self._fd, size, row * size), dtype=np.float32)
+
+    def append(self, keys: List[bytes], vectors: np.ndarray):
+        if self.dim is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.dim = vectors.shape[1]
+            with open(os.path.join(self.root, self.SPACE_NAME), 'w') as f:
+                json.dump({"namespace": self.namespace, "dim": self.dim}, f)
+        if vectors.shape[1] != self.dim:
+            print(f"embeddings of {vectors.shape[1]} dimension(s) not cached in a space of {self.dim}")
+            return
+        keys_path, vectors_path = self._paths()
+        with open(vectors_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(keys_path, 'ab') as f:
+            f.write(b"".join(keys))
+        start = len(self.rows)
+        for i, key in enumerate(keys):
+            self.rows[key] = start + i
+
+
+class EmbeddingCache:
+    def __init__(self, root: str, capacity: int = 65536):
+        """
+        Initializes a persistent, content-addressed cache of embeddings. An embedding is keyed by the model that
+        made it and the hash of its whitespace-normalized text, so a chunk is embedded once whatever the document,
+        version or session it comes from. Each model has its own append-only space on disk under root, with an
+        in-memory LRU of the most recently used embeddings in front of them.
+
+        Args:
+        - root: A string representing the directory holding one subdirectory per model.
+        - capacity: An integer representing how many embeddings the LRU holds.
+        """
+        self.root: str = root
+        self.capacity: int = capacity
+        self._spaces: Dict[str, _Space] = {}
+        self._lru: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"lookups": 0, "memory_hits": 0, "disk_hits": 0, "stored": 0}
+
+    @staticmethod
+    def key(namespace: str, text: str) -> bytes:
+        return hashlib.sha256(f"{namespace}\0{normalize_text(text)}".encode()).digest()[:KEY_BYTES]
+
+    def _space(self, namespace: str) -> _Space:
+        space = self._spaces.get(namespace)
+        if space is None:
+            digest = hashlib.sha256(namespace.encode()).hexdigest()[:16]
+            space = _Space(os.path.join(self.root, digest), namespace)
+            self._spaces[namespace] = space
+        return space
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def get_many(self, namespace: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Returns the cached embedding of each text, None for those never embedded with that model.
+        """
+        found: List[Optional[np.ndarray]] = []
+        with self._lock:
+            space = self._space(namespace)
+            for text in texts:
+                key = self.key(namespace, text)
+                self.stats["lookups"] += 1
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                else:
+                    row = space.rows.get(key)
+                    if row is not None:
+                        vector = space.read(row)
+                        self._remember(key, vector)
+                        self.stats["disk_hits"] += 1
+                found.append(vector)
+        return found
+
+    def put_many(self, namespace: str, texts: List[str], vectors: List[List[float]]) -> int:
+        """
+        Stores the embeddings of texts made by a model, skipping those already cached.
+
+        Returns:
+        - An integer representing the number of embeddings stored.
+        """
+        assert len(texts) == len(vectors), "texts and embeddings to be cached not aligned"
+        with self._lock:
+            space = self._space(namespace)
+            keys, rows, seen = [], [], set()
+            for text, vector in zip(texts, vectors):
+                key = self.key(namespace, text)
+                if key in space.rows or key in seen:
+                    continue
+                seen.add(key)
+                keys.append(key)
+                rows.append(vector)
+            if not keys:
+                return 0
+            matrix = np.asarray(rows, dtype=np.float32).reshape(len(keys), -1)
+            space.append(keys, matrix)
+            for key, vector in zip(keys, matrix):
+                self._remember(key, vector)
+            self.stats["stored"] += len(keys)
+            return len(keys)
+
+    def report(self) -> Dict[str, float]:
+        """
+        Reports the lookups so far, how many were served from memory and from disk, and the overall hit rate.
+        """
+        with self._lock:
+            report = dict(self.stats)
+            report["cached"] = sum(len(space.rows) for space in self._spaces.values())
+        hits = report["memory_hits"] + report["disk_hits"]
+        report["hit_rate"] = hits / report["lookups"] if report["lookups"] else 0.0
+        return report
+
+
+class CachedVectorize(Vectorize):
+    def __init__(self, vectorize: Vectorize, cache: EmbeddingCache):
+        """
+        Wraps an embedding method so that every text is looked up in the embedding cache first, and only the
+        misses reach the wrapped method (once per distinct text); what it returns is cached in turn.
+
+        Args:
+        - vectorize: A `Vectorize` whose `cache_namespace` identifies its embedding space.
+        - cache: An `EmbeddingCache` to look embeddings up in and store them to.
+        """
+        if vectorize.cache_namespace() is None:
+            raise ValueError("embedding method cannot be cached")
+        self.vectorize: Vectorize = vectorize
+        self.cache: EmbeddingCache = cache
+
+    def __getattr__(self, name: str):
+        # e.g. limiter_stats of the wrapped method
+        if name == "vectorize":
+            raise AttributeError(name)
+        return getattr(self.vectorize, name)
+
+    def cache_namespace(self) -> Optional[str]:
+        return self.vectorize.cache_namespace()
+
+    async def embed_text_bundle(self, text: List[str]) -> List[List[float]]:
+        namespace = self.cache_namespace()
+        found = self.cache.get_many(namespace, text)
+        # distinct missing texts, by normalized text, to their first position
+        missing: Dict[str, int] = {}
+        for i, vector in enumerate(found):
+            if vector is None:
+                missing.setdefault(normalize_text(text[i]), i)
+        if missing:
+            to_embed = [text[i] for i in missing.values()]
+            embedded = await self.vectorize.embed_text_bundle(to_embed)
+            self.cache.put_many(namespace, to_embed, embedded)
+            fresh = dict(zip(missing, embedded))
+            found = [vector if vector is not None else fresh[normalize_text(t)] for t, vector in zip(text, found)]
+        return [vector if isinstance(vector, list) else vector.tolist() for vector in found]
+
+    async def embed_text(self, text: str) -> List[float]:
+        namespace = self.cache_namespace()
+        vector = self.cache.get_many(namespace, [text])[0]
+        if vector is not None:
+            return vector.tolist()
+        embedding = await self.vectorize.embed_text(text)
+        self.cache.put_many(namespace, [text], [embedding])
+        return embedding
+
+    def cache_report(self) -> Dict[str, float]:
+        report = self.cache.report()
+        print(f"embedding cache: {report['hit_rate']:.1%} of {report['lookups']} lookup(s) hit "
+              f"({report['memory_hits']} in memory, {report['disk_hits']} on disk), {report['cached']} cached")
+        return report
+
+
+async def warm_from_library(cache: EmbeddingCache, namespace: str, vecstore, docstore, batch_size: int = 512) -> int:
+    """
+    Fills the cache with the embeddings of a library, made with the model of namespace: chunk texts are read from
+    the DocStore and their vectors from the vector store, which must keep them at full dimension (a
+    `NaiveVectorStore` without projection; its rows are L2-normalized like the embeddings of OpenAI models).
+
+    Returns:
+    - An integer representing the number of embeddings stored.
+    """
+    buffer = getattr(vecstore, "buffer", None)
+    if buffer is None or getattr(vecstore, "projection", None) is not None:
+        raise ValueError("vector store does not keep full-dimension vectors to warm the cache from")
+    pairs = [(doc_id, chunk_id) for doc_id, chunk_ids in (vecstore.doc_map or {}).items() for chunk_id in chunk_ids]
+    stored = 0
+    for start in range(0, len(pairs), batch_size):
+        chunks = await docstore.retrieve(pairs[start:start + batch_size])
+        texts, vectors = [], []
+        for chunk in chunks:
+            vector = buffer.get(chunk.chunk_id)
+            if vector is not None:
+                texts.append(chunk.text)
+                vectors.append(vector)
+        if texts:
+            stored += cache.put_many(namespace, texts, vectors)
+    print(f"embedding cache warmed with {stored} embedding(s) of {len(pairs)} library chunk(s)")
+    return stored
+
+
+_SHARED: Dict[str, EmbeddingCache] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_embedding_cache(root: str) -> EmbeddingCache:
+    """
+    Returns the process-wide embedding cache saved under root, so that every session reads and fills the same one.
+    """
+    root = os.path.normpath(root)
+    with _SHARED_LOCK:
+        cache = _SHARED.get(root)
+        if cache is None:
+            cache = EmbeddingCache(root)
+            _SHARED[root] = cache
+        return cache
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import re
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from handler.embedding.vectorize import Vectorize
+
+_WORD = re.compile(r"\w+")
+# odd 64-bit constants of the splitmix64 finalizer, hashing features onto projection columns
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+# bundles from which embedding moves off the event loop
+_THREAD_THRESHOLD = 256
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * _MIX1
+        x = (x ^ (x >> np.uint64(27))) * _MIX2
+        return x ^ (x >> np.uint64(31))
+
+
+class HashedTfidfVectorize(Vectorize):
+    def __init__(self,
+                 dim: int = 512,
+                 n_features: int = 1 << 20,
+                 ngrams: int = 2,
+                 density: int = 8,
+                 seed: int = 0,
+                 idf_path: Optional[str] = None):
+        """
+        Initializes a local embedding method, needing no network nor GPU and deterministic across processes: the
+        word n-grams of a text are hashed onto `n_features` buckets, weighted by sublinear term frequency and
+        inverse document frequency, then sent onto `dim` dimensions by a sparse random projection (each bucket
+        adds to `density` columns with random signs) and L2-normalized. Texts sharing vocabulary get close vectors,
+        which makes it a lexical retriever and a reproducible stand-in for a model in load tests.
+
+        Args:
+        - dim: An integer representing the dimension of the embeddings.
+        - n_features: An integer representing the number of hash buckets of n-grams.
+        - ngrams: An integer representing the longest word n-gram hashed, 1 for words only.
+        - density: An integer representing the number of columns each bucket is projected onto.
+        - seed: An integer seeding the hashing and the projection.
+        - idf_path: An optional string representing the `.npz` file of document frequencies fitted on a corpus
+            (see `fit` and `save`), every bucket weighs the same if None or missing. It is loaded again whenever its
+            modification time changes, so every instance embeds with the weights fitted last, by any process.
+        """
+        if dim <= 0 or n_features <= 0 or ngrams <= 0 or not 0 < density <= dim:
+            raise ValueError("dimension, number of features, n-grams and density must be positive, density at most dim")
+        self.dim: int = dim
+        self.n_features: int = n_features
+        self.ngrams: int = ngrams
+        self.density: int = density
+        self.seed: int = seed
+        self.idf_path: Optional[str] = idf_path
+        self.idf: Optional[np.ndarray] = None
+        # modification time of the idf file last loaded or saved
+        self._idf_mtime: Optional[float] = None
+        self._refresh()
+
+    def _refresh(self):
+        if self.idf_path is None:
+            return
+        try:
+            mtime = os.path.getmtime(self.idf_path)
+        except OSError:
+            return
+        if mtime != self._idf_mtime:
+            self._idf_mtime = mtime
+            self._load(self.idf_path)
+
+    def _features(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the rows, buckets and sublinear term frequencies of the distinct (text, n-gram bucket) pairs.
+        """
+        words = [_WORD.findall(text.lower()) for text in texts]
+        lengths = np.fromiter((len(w) for w in words), dtype=np.int64, count=len(words))
+        hashes = np.fromiter((zlib.crc32(word.encode()) for text_words in words for word in text_words),
+                             dtype=np.uint64, count=int(lengths.sum()))
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+        all_rows, all_hashes = [rows], [hashes]
+        gram = hashes
+        for n in range(1, self.ngrams):
+            # n-grams never straddle two texts
+            same = rows[n:] == rows[:-n]
+            with np.errstate(over="ignore"):
+                gram = gram[:-1] * _GOLDEN + hashes[n:]
+            all_rows.append(rows[n:][same])
+            all_hashes.append(gram[same])
+        rows, hashes = np.concatenate(all_rows), np.concatenate(all_hashes)
+        buckets = (_mix(hashes ^ np.uint64(self.seed)) % np.uint64(self.n_features)).astype(np.int64)
+        keys, counts = np.unique(rows * self.n_features + buckets, return_counts=True)
+        return keys // self.n_features, keys % self.n_features, 1.0 + np.log(counts)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        self._refresh()
+        rows, buckets, weights = self._features(texts)
+        if self.idf is not None:
+            weights = weights * self.idf[buckets]
+        out = np.zeros(len(texts) * self.dim, dtype=np.float64)
+        for j in range(self.density):
+            mixed = _mix(buckets.astype(np.uint64) * _GOLDEN + np.uint64(self.seed * self.density + j + 1))
+            columns = (mixed % np.uint64(self.dim)).astype(np.int64)
+            signs = np.where(mixed >> np.uint64(63), -1.0, 1.0)
+            out += np.bincount(rows * self.dim + columns, weights=weights * signs, minlength=out.size)
+        out = out.reshape(len(texts), self.dim)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return (out / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+    def fit(self, texts: List[str], batch_size: int = 4096) -> "HashedTfidfVectorize":
+        """
+        Fits the inverse document frequency of every bucket on a corpus, e.g. the chunks of the library, so that
+        frequent n-grams weigh less. Embeddings made before and after fitting are not comparable, the library must
+        be embedded again (see `server.router.file.fit_idf`).
+        """
+        df = np.zeros(self.n_features, dtype=np.int64)
+        for start in range(0, len(texts), batch_size):
+            _, buckets, _ = self._features(texts[start:start + batch_size])
+            df += np.bincount(buckets, minlength=self.n_features)
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1.0).astype(np.float32)
+        print(f"idf of {self.n_features} bucket(s) fitted on {len(texts)} text(s)")
+        return self
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.idf_path
+        if path is None or self.idf is None:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, idf=self.idf)
+        os.replace(tmp_path, path)
+        if path == self.idf_path:
+            self._idf_mtime = os.path.getmtime(path)
+
+    def _load(self, path: str):
+        with np.load(path) as saved:
+            idf = saved["idf"]
+        if idf.shape[0] != self.n_features:
+            print(f"idf at {path} has {idf.shape[0]} bucket(s) instead of {self.n_features}, not used")
+            return
+        self.idf = idf.astype(np.float32)
+
+    async def embed_text_bundle(self, text: List[str]) -> List[List[float]]:
+        if not text:
+            return []
+        if len(text) >= _THREAD_THRESHOLD:
+            return (await asyncio.to_thread(self._embed, text)).tolist()
+        return self._embed(text).tolist()
+
+    async def embed_text(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+    def cache_namespace(self) -> Optional[str]:
+        # embedding locally costs less than a cache lookup
+        return None
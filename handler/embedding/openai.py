@@ -1,6 +1,7 @@
 """Wrapper around OpenAI embedding models."""
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 from typing import (
@@ -25,6 +26,7 @@ from tenacity import (
     wait_exponential,
 )
 
+from handler.embedding.ratelimit import shared_rate_limiter
 from handler.embedding.vectorize import Vectorize
 
 logger = logging.getLogger(__name__)
@@ -63,6 +65,19 @@ def embed_with_retry(embeddings: OpenAIEmbeddings, **kwargs: Any) -> Any:
     return _embed_with_retry(**kwargs)
 
 
+async def aembed_with_retry(embeddings: OpenAIEmbeddings, n_tokens: int = 0, **kwargs: Any) -> Any:
+    """Like `embed_with_retry`, without blocking the event loop: every attempt waits for the rate limiter of the
+    client, and the backoff between attempts sleeps asynchronously."""
+    retry_decorator = _create_retry_decorator(embeddings)
+
+    @retry_decorator
+    async def _aembed_with_retry(**kwargs: Any) -> Any:
+        async with embeddings.limiter.slot(n_tokens):
+            return await embeddings.client.acreate(**kwargs)
+
+    return await _aembed_with_retry(**kwargs)
+
+
 class OpenAIEmbeddings(BaseModel, Vectorize):
     client: Any  #: :meta private:
     model: str = "text-embedding-ada-002"
@@ -77,10 +92,19 @@ class OpenAIEmbeddings(BaseModel, Vectorize):
     openai_organization: Optional[str] = None
     allowed_special: Union[Literal["all"], Set[str]] = set()
     disallowed_special: Union[Literal["all"], Set[str], Tuple[()]] = "all"
-    chunk_size: int = 1000
-    """Maximum number of texts to embed in each batch"""
+    chunk_size: Optional[int] = None
+    """Maximum number of texts to embed in each request, 16 for Azure deployments and 2048 otherwise if None"""
+    max_tokens_per_request: Optional[int] = None
+    """Maximum number of tokens summed over the texts of a request, only bounded by `chunk_size` if None"""
     max_retries: int = 6
     """Maximum number of retries to make when generating."""
+    max_concurrency: int = 4
+    """Maximum number of requests in flight at once"""
+    requests_per_minute: Optional[int] = None
+    """Requests per minute allowed by the quota of the deployment, unlimited if None"""
+    tokens_per_minute: Optional[int] = None
+    """Tokens per minute allowed by the quota of the deployment, unlimited if None"""
+    limiter: Any  #: :meta private:
 
     class Config:
         """Configuration for this pydantic object."""
@@ -96,6 +120,9 @@ class OpenAIEmbeddings(BaseModel, Vectorize):
         openai_api_version = values["openai_api_version"] or os.environ.get("OPENAI_API_VERSION", "2023-03-15-preview")
         if openai_api_type == "azure":
             values["deployment"] = values["deployment"] if values["deployment"] is not None else values["model"]
+        if values["chunk_size"] is None:
+            # Azure deployments accept at most 16 inputs per request, OpenAI 2048
+            values["chunk_size"] = 16 if openai_api_type == "azure" else 2048
         try:
             import openai
             openai.api_key = openai_api_key
@@ -110,28 +137,104 @@ class OpenAIEmbeddings(BaseModel, Vectorize):
                 "Could not import openai python package. "
                 "Please install it with `pip install openai`."
             )
+        # the quota belongs to the deployment, every client of the process shares its limiter
+        values["limiter"] = shared_rate_limiter((openai_api_base, values["deployment"] or values["model"]),
+                                                values["max_concurrency"],
+                                                values["requests_per_minute"],
+                                                values["tokens_per_minute"])
         return values
 
-    def _embedding_func(self, text: str, *, engine: str) -> List[float]:
-        """Call out to OpenAI's embedding endpoint."""
-        # handle large input text
-        assert len(text) <= self.embedding_ctx_length
+    def _prepared(self, text: str) -> Tuple[str, int]:
+        """Returns the text as it is sent, cut to the context length, and its number of tokens."""
+        from handler.chunkify import tokenizer
         if self.model.endswith("001"):
             text = text.replace("\n", " ")
-        return embed_with_retry(self, input=[text], engine=engine)["data"][0][
-            "embedding"
-        ]
+        tokens = tokenizer.encode(text, disallowed_special=())
+        if len(tokens) > self.embedding_ctx_length:
+            logger.warning(f"text of {len(tokens)} tokens cut to the {self.embedding_ctx_length} the model reads")
+            tokens = tokens[:self.embedding_ctx_length]
+            text = tokenizer.decode(tokens)
+        return text, len(tokens)
+
+    def _batches(self, n_tokens: List[int]) -> List[List[int]]:
+        """
+        Packs consecutive texts into batches of at most `chunk_size` texts and `max_tokens_per_request` tokens,
+        returned as lists of positions in the input. `embedding_ctx_length` bounds each text, see `_prepared`;
+        a text longer than the request budget is sent alone.
+        """
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_tokens = 0
+        for i, tokens in enumerate(n_tokens):
+            over_budget = self.max_tokens_per_request is not None \
+                and batch_tokens + tokens > self.max_tokens_per_request
+            if batch and (len(batch) >= self.chunk_size or over_budget):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _embed_batch(self, texts: List[str], n_tokens: List[int], *, engine: str) -> List[List[float]]:
+        """Embeds texts in one request, in input order whatever the order of the response."""
+        response = await aembed_with_retry(self, sum(n_tokens), input=texts, engine=engine)
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+    async def _embed_split(self, texts: List[str], n_tokens: List[int], *, engine: str) -> List[List[float]]:
+        """
+        Embeds a batch; if the request is rejected as invalid (too many inputs or tokens for the deployment, or
+        one bad text), the batch is split in halves embedded separately, so that only the offending text fails.
+        Any other error (rate limit, authentication, timeout, outage) has nothing to do with the batch and is
+        raised as is, once the retries of the request are exhausted.
+        """
+        import openai
+        try:
+            return await self._embed_batch(texts, n_tokens, engine=engine)
+        except openai.error.InvalidRequestError as e:
+            if len(texts) == 1:
+                raise e
+            half = len(texts) // 2
+            logger.warning(f"batch of {len(texts)} text(s) rejected ({e}), retrying its halves")
+            halves = await asyncio.gather(self._embed_split(texts[:half], n_tokens[:half], engine=engine),
+                                          self._embed_split(texts[half:], n_tokens[half:], engine=engine))
+            return halves[0] + halves[1]
 
     async def embed_text_bundle(
         self, 
         texts: List[str]
     ) -> List[List[float]]:
-        embeddings: List[List[float]] = []
-        for text in texts:
-            embedding = self._embedding_func(text, engine=self.deployment)
-            embeddings.append(embedding)
+        """
+        Embeds texts with as few requests as possible: each text is cut to the context length of the model and texts
+        are packed into batches bounded by `chunk_size` and `max_tokens_per_request`, counted with the tokenizer of
+        `handler.chunkify`. Batches are sent
+        concurrently, as far as the rate limiter of the deployment admits them. Embeddings are returned in the
+        order of texts.
+        """
+        prepared = [self._prepared(text) for text in texts]
+        batches = self._batches([n_tokens for _, n_tokens in prepared])
+        answers = await asyncio.gather(*(
+            self._embed_split([prepared[i][0] for i in batch], [prepared[i][1] for i in batch],
+                              engine=self.deployment)
+            for batch in batches))
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, answers):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
         return embeddings
 
     async def embed_text(self, text: str) -> List[float]:
-        embedding = self._embedding_func(text, engine=self.deployment)
-        return embedding
\ No newline at end of file
+        text, n_tokens = self._prepared(text)
+        embedding = (await self._embed_batch([text], [n_tokens], engine=self.deployment))[0]
+        return embedding
+
+    def limiter_stats(self) -> Dict[str, float]:
+        """
+        Reports the queue depth, requests in flight and wait times of the rate limiter of the deployment.
+        """
+        return self.limiter.stats()
+
+    def cache_namespace(self) -> Optional[str]:
+        # a deployment serves one model, embeddings of the same text through it are interchangeable
+        return f"openai/{self.model}/{self.deployment}"
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        """
+        Initializes a bucket refilled at `per_minute` units per minute and holding at most one minute's worth.
+        Reservations may drive it below zero: the caller then waits until the refill covers its share, so that
+        callers are served in the order they reserved.
+        """
+        self.capacity: float = float(per_minute)
+        self.rate: float = per_minute / 60.0
+        self.level: float = self.capacity
+        self.updated: float = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Takes amount out of the bucket and returns the seconds to wait before using it. Called with the lock of
+        the limiter held.
+        """
+        self.level = min(self.capacity, self.level + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        # a request larger than the bucket would never fit, it waits for a full bucket instead
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimiter:
+    def __init__(self,
+                 max_concurrency: int = 4,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        """
+        Initializes a limiter admitting at most `max_concurrency` requests at once, throttled by a
+        requests-per-minute and a tokens-per-minute token bucket (e.g. the quota of an Azure OpenAI deployment).
+        Waiting never blocks the event loop, and one limiter can be shared by every event loop of the process.
+
+        Args:
+        - max_concurrency: An integer representing the number of requests in flight at once.
+        - requests_per_minute: An optional integer representing the request quota, unlimited if None.
+        - tokens_per_minute: An optional integer representing the token quota, unlimited if None.
+        """
+        self.max_concurrency: int = max_concurrency
+        self.requests: Optional[TokenBucket] = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens: Optional[TokenBucket] = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        # asyncio semaphores belong to one loop, one per loop using the limiter
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+        self.counters: Dict[str, float] = {"queued": 0, "in_flight": 0, "requests": 0, "tokens": 0,
+                                           "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._semaphores[loop] = semaphore
+            return semaphore
+
+    def _reserve(self, tokens: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return delay
+
+    def _count(self, **deltas: float):
+        with self._lock:
+            for key, delta in deltas.items():
+                self.counters[key] += delta
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        """
+        Waits, without blocking the event loop, for a free request slot and for the quota of one request of the
+        given number of tokens, then holds the slot until the context exits.
+        """
+        started = time.monotonic()
+        self._count(queued=1)
+        try:
+            semaphore = self._semaphore()
+            await semaphore.acquire()
+            try:
+                delay = self._reserve(tokens)
+                if delay:
+                    await asyncio.sleep(delay)
+            except BaseException:
+                semaphore.release()
+                raise
+        finally:
+            self._count(queued=-1)
+        waited = time.monotonic() - started
+        with self._lock:
+            self.counters["in_flight"] += 1
+            self.counters["requests"] += 1
+            self.counters["tokens"] += tokens
+            self.counters["wait_seconds"] += waited
+            self.counters["max_wait_seconds"] = max(self.counters["max_wait_seconds"], waited)
+        try:
+            yield
+        finally:
+            self._count(in_flight=-1)
+            semaphore.release()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Reports the requests waiting (queue depth) and in flight, the requests and tokens admitted so far and the
+        time they waited for a slot and for the quota.
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats["mean_wait_seconds"] = stats["wait_seconds"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+
+_SHARED: Dict[Tuple, RateLimiter] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_rate_limiter(key: Tuple,
+                        max_concurrency: int = 4,
+                        requests_per_minute: Optional[int] = None,
+                        tokens_per_minute: Optional[int] = None) -> RateLimiter:
+    """
+    Returns the process-wide limiter of a quota, e.g. keyed by endpoint and deployment, so that every client
+    embedding with the same deployment draws from the same buckets. The limits of the first call stick.
+    """
+    with _SHARED_LOCK:
+        limiter = _SHARED.get(key)
+        if limiter is None:
+            limiter = RateLimiter(max_concurrency, requests_per_minute, tokens_per_minute)
+            _SHARED[key] = limiter
+        return limiter
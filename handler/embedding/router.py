@@ -1,11 +1,20 @@
 import os
+from typing import Optional
 
 from handler.embedding.vectorize import Vectorize
 from models.api import Settings
 
-def get_vectorize(settings: Settings) -> Vectorize:
+def get_vectorize(settings: Settings,
+                  cache_root: Optional[str] = None,
+                  idf_path: Optional[str] = None) -> Vectorize:
+    vectorize = _get_vectorize(settings, idf_path)
+    if settings.embedding_cache and cache_root is not None and vectorize.cache_namespace() is not None:
+        from handler.embedding.cache import CachedVectorize, shared_embedding_cache
+        return CachedVectorize(vectorize, shared_embedding_cache(cache_root))
+    return vectorize
+
+def _get_vectorize(settings: Settings, idf_path: Optional[str] = None) -> Vectorize:
     embedding_method = settings.embedding_method
-    chunk_size = settings.chunk_size
     match embedding_method:
         case "openai":
             from handler.embedding.openai import OpenAIEmbeddings
@@ -17,7 +26,11 @@ def get_vectorize(settings: Settings) -> Vectorize:
                                     openai_api_base=api_base,
                                     openai_api_type=api_type,
                                     openai_api_version=api_version,
-                                    chunk_size=chunk_size)
+                                    chunk_size=settings.embedding_batch_size,
+                                    max_tokens_per_request=settings.embedding_request_tokens,
+                                    max_concurrency=settings.embedding_concurrency,
+                                    requests_per_minute=settings.embedding_rpm,
+                                    tokens_per_minute=settings.embedding_tpm)
         case _:
-            from handler.embedding.vectorize import MockVectorize
-            return MockVectorize()
\ No newline at end of file
+            from handler.embedding.local import HashedTfidfVectorize
+            return HashedTfidfVectorize(idf_path=idf_path)
\ No newline at end of file
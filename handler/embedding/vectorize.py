@@ -1,5 +1,6 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
 from models.conversation import ConversationEmbeddings, MultipleConversation, SingleConversation
 from models.document import DocumentChunkWithEmbedding, MultipleDocuments, SingleDocumentWithChunks
 
@@ -19,7 +20,34 @@ class Vectorize(ABC):
         text: str
     ) -> List[float]:
         raise NotImplemented
+
+    def cache_namespace(self) -> Optional[str]:
+        """
+        Returns what identifies the embedding space of the method (e.g. the model), under which its embeddings can
+        be cached, or None if they must not be.
+        """
+        return None
     
+async def embed_texts(
+        texts: List[str],
+        emb_method: Vectorize,
+        batch_size: Optional[int] = None
+) -> List[List[float]]:
+    """
+    Embeds a stream of texts in as few calls to the embedding method as possible: one call, left to batch by
+    itself, or calls of `batch_size` texts sent concurrently.
+    """
+    if not texts:
+        return []
+    if batch_size is None or len(texts) <= batch_size:
+        embeddings = await emb_method.embed_text_bundle(texts)
+    else:
+        batches = await asyncio.gather(*(emb_method.embed_text_bundle(texts[start:start + batch_size])
+                                         for start in range(0, len(texts), batch_size)))
+        embeddings = [embedding for batch in batches for embedding in batch]
+    assert len(embeddings) == len(texts)
+    return embeddings
+
 async def embed_bundle(
         bundle: Bundle,
         emb_method: Vectorize,
@@ -27,28 +55,36 @@ async def embed_bundle(
 ) -> Bundle:
     contents = bundle.contents
     assert contents is not None
-    _generated = []
-    for elem in contents:
-        if isinstance(elem, SingleDocumentWithChunks):
-            texts = [chunk.text for chunk in elem.chunks]
-            embedding = await emb_method.embed_text_bundle(texts)
-            assert len(embedding) == len(elem.chunks)
-            _chunks = [DocumentChunkWithEmbedding(**chunk.dict(), embedding=emb) 
-                        for chunk, emb 
-                        in zip(elem.chunks, embedding)]
-            _generated.append(SingleDocumentWithChunks(**elem.dict(exclude={"chunks"}), chunks=_chunks))
-        elif isinstance(elem, SingleConversation):
-            prompt_template = kwargs.get("prompt_template", {})
-            prompt = elem.prompt_for_embedding(prompt_template=prompt_template)
-            embedding = await emb_method.embed_text(prompt)
-            _generated.append((elem, embedding))
-        else:
-            raise ValueError
+    batch_size = kwargs.get("batch_size", None)
     if isinstance(bundle, MultipleDocuments):
+        # chunk ids already indexed by the store, or met earlier in this bundle, keep their existing vector
+        indexed = kwargs.get("indexed", None) or {}
+        to_embed = {}
+        for elem in contents:
+            if not isinstance(elem, SingleDocumentWithChunks):
+                raise ValueError
+            for chunk in elem.chunks:
+                if indexed.get(chunk.chunk_id, 0) <= 0 and chunk.chunk_id not in to_embed:
+                    to_embed[chunk.chunk_id] = chunk.text
+        # the chunks of every document embedded as one stream, the vectors scattered back to their chunks
+        embedding = await embed_texts(list(to_embed.values()), emb_method, batch_size)
+        embeddings = dict(zip(to_embed, embedding))
+        _generated = []
+        for elem in contents:
+            _chunks = [DocumentChunkWithEmbedding(**chunk.dict(), embedding=embeddings.pop(chunk.chunk_id))
+                       if chunk.chunk_id in embeddings else chunk
+                       for chunk in elem.chunks]
+            _generated.append(SingleDocumentWithChunks(**elem.dict(exclude={"chunks"}), chunks=_chunks))
         return MultipleDocuments(theme=bundle.theme,
                                  contents=_generated)
     elif isinstance(bundle, MultipleConversation):
-        conv_emb = ConversationEmbeddings(embeddings={k: v for k, v in _generated})
+        prompt_template = kwargs.get("prompt_template", {})
+        for elem in contents:
+            if not isinstance(elem, SingleConversation):
+                raise ValueError
+        prompts = [elem.prompt_for_embedding(prompt_template=prompt_template) for elem in contents]
+        embedding = await embed_texts(prompts, emb_method, batch_size)
+        conv_emb = ConversationEmbeddings(embeddings={k: v for k, v in zip(contents, embedding)})
         return MultipleConversation(theme=bundle.theme,
                                     contents=contents,
                                     embedding=conv_emb)
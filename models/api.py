@@ -1,7 +1,8 @@
 from fastapi import HTTPException, status
 from pydantic import BaseModel, BaseSettings, root_validator, validator
 from typing import List, Optional
-from models.document import SingleDocument
+from alexandria.vectorstore.providers.faissconstants import ALLOWED_INDEX_TYPE, ALLOWED_METRIC
+from models.document import DocumentFilter, SingleDocument
 # from models.generic import Query, QueryResult
 
 class UpsertRequest(BaseModel):
@@ -14,6 +15,7 @@ class UpsertResponse(BaseModel):
 class QueryRequest(BaseModel):
     query: str
     top_k: int
+    filter: Optional[DocumentFilter] = None
 
 # class QueryResponse(BaseModel):
 #     results: List[QueryResult]
@@ -23,6 +25,27 @@ class Settings(BaseSettings):
     chunk_size: int
     embedding_method: str
     vectorstore: str
+    faiss_index_key: str = "Flat"
+    faiss_metric: str = "L2"
+    faiss_nprobe: Optional[int] = None
+    faiss_ef_search: Optional[int] = None
+    n_shards: Optional[int] = None
+    naive_quantization: Optional[str] = None
+    naive_rerank_factor: int = 4
+    multitenant: bool = False
+    federated: bool = False
+    dedup: bool = False
+    disk_ram_budget_mb: int = 256
+    disk_nprobe: int = 16
+    projection_dim: Optional[int] = None
+    projection_kind: str = "pca"
+    embedding_batch_size: Optional[int] = None
+    embedding_request_tokens: Optional[int] = None
+    embedding_concurrency: int = 4
+    embedding_rpm: Optional[int] = None
+    embedding_tpm: Optional[int] = None
+    embedding_cache: bool = False
+    relevance_threshold: Optional[float] = None
     openai_api_key: Optional[str] = None
     openai_api_base: Optional[str] = None
     openai_api_type: Optional[str] = None
@@ -54,7 +77,105 @@ class Settings(BaseSettings):
     
     @validator("vectorstore")
     def check_vectorstore(cls, v):
-        if v not in {"FAISS", "naive"}:
+        if v not in {"FAISS", "naive", "sharded", "disk"}:
             v = "naive"
             print(f"vector store not allowed, fall back to naive storage")
-        return v
\ No newline at end of file
+        return v
+    
+    @validator("faiss_index_key")
+    def check_faiss_index_key(cls, v):
+        import re
+        if not any(re.fullmatch(pattern, v) for pattern in ALLOWED_INDEX_TYPE):
+            v = "Flat"
+            print(f"FAISS index key not allowed, fall back to Flat index")
+        return v
+    
+    @validator("faiss_metric")
+    def check_faiss_metric(cls, v):
+        if v not in ALLOWED_METRIC:
+            v = "L2"
+            print(f"FAISS metric not allowed, fall back to L2")
+        return v
+    
+    @validator("n_shards")
+    def check_n_shards(cls, v):
+        if v is not None and v < 1:
+            v = None
+            print(f"number of shards not allowed, fall back to one shard per core")
+        return v
+    
+    @validator("naive_quantization")
+    def check_naive_quantization(cls, v):
+        if v is not None and v not in {"float16", "int8"}:
+            v = None
+            print(f"quantization not allowed, fall back to float32 storage")
+        return v
+    
+    @validator("naive_rerank_factor")
+    def check_naive_rerank_factor(cls, v):
+        if v < 1:
+            v = 1
+            print(f"too small re-rank factor, forced set to {v}")
+        return v
+    
+    @validator("disk_ram_budget_mb")
+    def check_disk_ram_budget_mb(cls, v):
+        if v < 16:
+            v = 16
+            print(f"too small RAM budget for the on-disk index, forced set to {v} MB")
+        return v
+    
+    @validator("disk_nprobe")
+    def check_disk_nprobe(cls, v):
+        if v < 1:
+            v = 1
+            print(f"too few probed lists for the on-disk index, forced set to {v}")
+        return v
+    
+    @validator("projection_dim")
+    def check_projection_dim(cls, v):
+        if v is not None and v < 16:
+            v = None
+            print(f"too small projection dimension, fall back to full-dimension storage")
+        return v
+    
+    @validator("projection_kind")
+    def check_projection_kind(cls, v):
+        if v not in {"pca", "rotation"}:
+            v = "pca"
+            print(f"projection not allowed, fall back to PCA")
+        return v
+    
+    @validator("embedding_batch_size")
+    def check_embedding_batch_size(cls, v):
+        if v is not None and v < 1:
+            v = None
+            print(f"embedding batch size not allowed, fall back to the default of the provider")
+        return v
+    
+    @validator("embedding_concurrency")
+    def check_embedding_concurrency(cls, v):
+        if v < 1:
+            v = 1
+            print(f"too few concurrent embedding requests, forced set to {v}")
+        return v
+    
+    @validator("embedding_request_tokens", "embedding_rpm", "embedding_tpm")
+    def check_embedding_quota(cls, v):
+        if v is not None and v < 1:
+            v = None
+            print(f"embedding quota not allowed, fall back to unlimited")
+        return v
+    
+    def vecstore_kwargs(self):
+        return {"index_key": self.faiss_index_key,
+                "metric": self.faiss_metric,
+                "nprobe": self.faiss_nprobe,
+                "ef_search": self.faiss_ef_search,
+                "n_shards": self.n_shards,
+                "quantization": self.naive_quantization,
+                "rerank_factor": self.naive_rerank_factor,
+                "ram_budget": self.disk_ram_budget_mb << 20,
+                "disk_nprobe": self.disk_nprobe,
+                "projection_dim": self.projection_dim,
+                "projection_kind": self.projection_kind}
\ No newline at end of file
@@ -14,6 +14,12 @@ VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN = ".data/reserve/_session/docs/embeddings/"
 VECTORSTORE_DOC_SAVE_ROOT_FOR_USER = ".data/transient/_session-%s/docs/embeddings/"
 VECTORSTORE_CONV_SAVE_ROOT_FOR_ADMIN = ".data/reserve/_session/chat/embeddings/"
 VECTORSTORE_CONV_SAVE_ROOT_FOR_USER = ".data/transient/_session-%s/chat/embeddings/"
+VECTORSTORE_TENANT_SAVE_ROOT = ".data/transient/_tenants/embeddings/"
+DEDUP_SAVE_PATH_FOR_ADMIN = ".data/reserve/_session/docs/dedup.npz"
+DEDUP_SAVE_PATH_FOR_USER = ".data/transient/_session-%s/docs/dedup.npz"
+ID_REGISTRY_SAVE_PATH = ".data/reserve/_session/ids.log"
+EMBEDDING_CACHE_ROOT = ".data/reserve/_cache/embeddings"
+LOCAL_IDF_SAVE_PATH = ".data/reserve/_session/docs/idf.npz"
 PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
 AUTH = OAuth2PasswordBearer(tokenUrl="token")
 
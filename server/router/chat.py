@@ -31,7 +31,7 @@ async def query(
     transient = True if mode == "upsert-and-query" else False
     chatstore = _init_chatstore(session_id=session_id, transient=transient, holdings=holdings, settings=_settings)
     q = request.query
-    messages, srcs = await chatstore.eloquence(q)
+    messages, srcs = await chatstore.eloquence(q, top_k=request.top_k, filter=request.filter)
     response = await chatstore.chat(msgs=messages)
     await chatstore.echo_response((q, response))
     return {'msg': response, 'src': [s.dict() for s in srcs]}
@@ -1,7 +1,11 @@
 from typing import Any, Dict, List
 
 from fastapi import APIRouter, HTTPException, Request, UploadFile, status
+from alexandria.vectorstore.idregistry import IdRegistry, shared_id_registry
+from alexandria.vectorstore.registry import LIBRARY_REGISTRY
 from alexandria.vectorstore.router import get_vecstore
+from handler.dedup import shared_dedup_index
+from handler.embedding.local import HashedTfidfVectorize
 from handler.embedding.router import get_vectorize
 from handler.utils import hash_int
 from models.document import MultipleDocuments, SingleDocument
@@ -10,7 +14,8 @@ from handler.file_handler import get_document_from_file
 from alexandria.vectorstore.vectorstore import VectorStore
 from alexandria.docstore.docstore import DocStore
 from alexandria.docstore.router import get_docstore
-from server.constants import VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN, VECTORSTORE_DOC_SAVE_ROOT_FOR_USER
+from server.constants import DEDUP_SAVE_PATH_FOR_ADMIN, DEDUP_SAVE_PATH_FOR_USER, EMBEDDING_CACHE_ROOT, ID_REGISTRY_SAVE_PATH, \
+    LOCAL_IDF_SAVE_PATH, VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN, VECTORSTORE_DOC_SAVE_ROOT_FOR_USER, VECTORSTORE_TENANT_SAVE_ROOT
 from server.utils import get_user_belongings_from_cookies
 
 file_router = APIRouter()
@@ -44,7 +49,8 @@ async def upsert_file(
     documents, docstore = await _init_docstore(session_id,
                                                transient,
                                                files,
-                                               holdings)
+                                               holdings,
+                                               _settings)
     documents = list(filter(lambda doc: doc.text != '', documents))
     if len(documents) == 0:
         return UpsertResponse(ids=[], urls=[])
@@ -58,17 +64,63 @@ async def upsert_file(
                                                transient, 
                                                holdings, 
                                                _settings)
-    await vecstore.upsert(bundle, vectorize)
+    vecstore.dedup = docstore.dedup
+    await vecstore.upsert(bundle, vectorize, batch_size=_settings.embedding_batch_size)
     await vecstore.serializing(save_root=restore_root, is_doc=True)
+    if not transient:
+        LIBRARY_REGISTRY.written(restore_root)
     bundle_ids = [x.doc_id for x in bundle.contents]
     bundle_urls = [x.metadata.version.version_url for x in bundle.contents]
     return UpsertResponse(ids=bundle_ids, urls=bundle_urls)
 
+@file_router.post(
+    "/fit-idf",
+    response_model=UpsertResponse
+)
+async def fit_idf(
+    request: Request
+):
+    """
+    Fits the idf of the local embedding method on every chunk of the library and embeds the library again with
+    it; vectors embedded before and after fitting are not comparable. Every embedder of the local method reloads
+    the new weights from LOCAL_IDF_SAVE_PATH on its next call.
+    """
+    cookies = request.cookies
+    if not cookies:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="not authorized or invalid cookies")
+    session_id = hash_int(cookies.get("stage1"))
+    user, holdings = get_user_belongings_from_cookies(cookies)
+    if user.username != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="only the admin fits the library")
+    _settings = holdings.get("settings", None)
+    if _settings is None or not isinstance(_settings, Settings):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="incorrect configuration")
+    vecstore, vectorize = await _init_vecstore(session_id, False, holdings, _settings)
+    if not isinstance(vectorize, HashedTfidfVectorize):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="embedding method has no idf to fit")
+    documents = await get_docstore(session_id=session_id, transient=False).documents()
+    if len(documents) == 0:
+        return UpsertResponse(ids=[], urls=[])
+    vectorize.fit([chunk.text for doc in documents for chunk in doc.chunks]).save()
+    await vecstore.reembed(MultipleDocuments(theme=str(session_id), contents=documents), vectorize,
+                           batch_size=_settings.embedding_batch_size)
+    await vecstore.serializing(save_root=VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN, is_doc=True)
+    LIBRARY_REGISTRY.written(VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN)
+    return UpsertResponse(ids=[doc.doc_id for doc in documents],
+                          urls=[doc.metadata.version.version_url for doc in documents])
+
 async def _init_vecstore(session_id: int, 
                          transient: bool, 
                          holdings: Dict[str, Any], 
                          settings: Settings):
     vectorstore = settings.vectorstore
+    if transient and settings.multitenant:
+        # transient sessions share one multi-tenant index instead of a store each
+        vectorstore = "tenant"
     restore_root = VECTORSTORE_DOC_SAVE_ROOT_FOR_USER % (str(session_id)) if transient \
     else VECTORSTORE_DOC_SAVE_ROOT_FOR_ADMIN
     if "_vecstore" not in holdings:
@@ -76,17 +128,20 @@ async def _init_vecstore(session_id: int,
                                        transient=transient,
                                        vecstore=vectorstore,
                                        restore_root=restore_root,
-                                       dim=512)
+                                       tenant_root=VECTORSTORE_TENANT_SAVE_ROOT,
+                                       dim=512,
+                                       **settings.vecstore_kwargs())
         holdings.update({"_vecstore": _vecstore})
     vecstore = holdings.get("_vecstore")
     assert isinstance(vecstore, VectorStore)
-    vectorize = get_vectorize(settings)
+    vectorize = get_vectorize(settings, cache_root=EMBEDDING_CACHE_ROOT, idf_path=LOCAL_IDF_SAVE_PATH)
     return vecstore, vectorize
 
 async def _init_docstore(session_id: int,
                          transient: bool,
                          files: List[UploadFile], 
-                         holdings: Dict[str, Any]) -> tuple[List[SingleDocument], DocStore]:
+                         holdings: Dict[str, Any],
+                         settings: Settings) -> tuple[List[SingleDocument], DocStore]:
     documents: List[SingleDocument] = []
     for file in files:
         document = await get_document_from_file(file)
@@ -99,4 +154,12 @@ async def _init_docstore(session_id: int,
         holdings.update({"_docstore": _docstore})
     docstore = holdings.get("_docstore")
     assert isinstance(docstore, DocStore)
+    if docstore.id_registry is None:
+        # library chunk ids share the persisted dense id space of conversation ids, those of a transient session
+        # only mean something to its own stores and are kept in memory for its lifetime
+        docstore.id_registry = IdRegistry() if transient else shared_id_registry(ID_REGISTRY_SAVE_PATH)
+    if settings.dedup and docstore.dedup is None:
+        # near-duplicate chunks collapse onto chunks of the same vector store only
+        dedup_path = DEDUP_SAVE_PATH_FOR_USER % (str(session_id)) if transient else DEDUP_SAVE_PATH_FOR_ADMIN
+        docstore.dedup = shared_dedup_index(dedup_path)
     return documents, docstore
\ No newline at end of file
@@ -1,4 +1,5 @@
 from datetime import timedelta, datetime
+from typing import Optional
 from fastapi import APIRouter, HTTPException, Request, Response, Depends, status
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt
@@ -8,7 +9,7 @@ from server.constants import (ACCESS_TOKEN_EXPIRE_HOURS,
                               ALGORITHM)
 
 from server.utils import (authenticate_user, get_current_user_from_cookies,
-                          create_access_token, get_user_belongings)
+                          create_access_token, get_user_belongings, release_tenant)
 inout_router = APIRouter()
 
 @inout_router.post("/login")
@@ -38,6 +39,11 @@ def resign_cookie(prev_cookie):
 @inout_router.get("/logout")
 async def logout(request: Request, response: Response):
     if request.cookies:
+        try:
+            _, belongings = get_user_belongings(request)
+            release_tenant(belongings)
+        except HTTPException:
+            pass
         response.delete_cookie(key="stage1", samesite='none', secure=True)
     return "logout successful"
 
@@ -48,7 +54,28 @@ async def configuring(
     mode: str,
     chunk_token_length: int,
     embedding_method: str,
-    vectorstore: str
+    vectorstore: str,
+    faiss_index_key: str = "Flat",
+    faiss_metric: str = "L2",
+    faiss_nprobe: Optional[int] = None,
+    faiss_ef_search: Optional[int] = None,
+    n_shards: Optional[int] = None,
+    naive_quantization: Optional[str] = None,
+    naive_rerank_factor: int = 4,
+    multitenant: bool = False,
+    federated: bool = False,
+    dedup: bool = False,
+    disk_ram_budget_mb: int = 256,
+    disk_nprobe: int = 16,
+    projection_dim: Optional[int] = None,
+    projection_kind: str = "pca",
+    embedding_batch_size: Optional[int] = None,
+    embedding_request_tokens: Optional[int] = None,
+    embedding_concurrency: int = 4,
+    embedding_rpm: Optional[int] = None,
+    embedding_tpm: Optional[int] = None,
+    embedding_cache: bool = False,
+    relevance_threshold: Optional[float] = None
 ):  
     cookies = request.cookies
     if not cookies:
@@ -57,12 +84,34 @@ async def configuring(
     cookie = cookies["stage1"]
     user, belongings = get_user_belongings(request)
     if belongings:
+        release_tenant(belongings)
         belongings.clear()
         cookie = resign_cookie(cookie)
     settings = Settings(mode=mode,
                         chunk_size=chunk_token_length,
                         embedding_method=embedding_method,
-                        vectorstore=vectorstore)
+                        vectorstore=vectorstore,
+                        faiss_index_key=faiss_index_key,
+                        faiss_metric=faiss_metric,
+                        faiss_nprobe=faiss_nprobe,
+                        faiss_ef_search=faiss_ef_search,
+                        n_shards=n_shards,
+                        naive_quantization=naive_quantization,
+                        naive_rerank_factor=naive_rerank_factor,
+                        multitenant=multitenant,
+                        federated=federated,
+                        dedup=dedup,
+                        disk_ram_budget_mb=disk_ram_budget_mb,
+                        disk_nprobe=disk_nprobe,
+                        projection_dim=projection_dim,
+                        projection_kind=projection_kind,
+                        embedding_batch_size=embedding_batch_size,
+                        embedding_request_tokens=embedding_request_tokens,
+                        embedding_concurrency=embedding_concurrency,
+                        embedding_rpm=embedding_rpm,
+                        embedding_tpm=embedding_tpm,
+                        embedding_cache=embedding_cache,
+                        relevance_threshold=relevance_threshold)
     belongings.update({"settings": settings})
     response.delete_cookie(key="stage1", samesite='none', secure=True)
     response.set_cookie(key="stage1", value=cookie, max_age=1800, samesite='none', secure=True)
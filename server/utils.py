@@ -2,6 +2,7 @@ from datetime import timedelta, datetime
 from typing import Dict, Optional
 from fastapi import HTTPException, Request, status
 from jose import ExpiredSignatureError, JWTError, jwt
+from alexandria.vectorstore.providers.tenantvectorstore import TenantVectorStore
 from server.constants import *
 
 def authenticate_user(username: str, password: str) -> Optional[User]:
@@ -36,12 +37,22 @@ def get_current_user_from_cookies(cookies: Dict[str, str]):
     try:
         info = jwt.decode(token=implicit_token, key=STAGE2_SECRET_KEY, algorithms=ALGORITHM)
     except ExpiredSignatureError:
+        # the session is over, its vectors in the shared multi-tenant index go with it
+        expired = jwt.decode(token=implicit_token, key=STAGE2_SECRET_KEY, algorithms=ALGORITHM,
+                             options={"verify_exp": False})
+        release_tenant(USER_BELONGINGS.get(USER_BASIC.get(expired["sub"])))
         raise token_timeout_exception
     except JWTError as je:
         raise je
     username = info["sub"]
     return USER_BASIC.get(username)
 
+def release_tenant(belongings):
+    # the vectors of a session kept in the shared multi-tenant index are dropped with it
+    vecstore = belongings.pop("_vecstore", None) if belongings else None
+    if isinstance(vecstore, TenantVectorStore):
+        vecstore.drop()
+
 def get_user_belongings(request: Request):
     cookies = request.cookies
     return get_user_belongings_from_cookies(cookies)